@@ -7,28 +7,46 @@ import json
 import threading
 import datetime
 from datetime import timezone # Ensure timezone is imported
-import inquirer
 import logging
 import time # Added for auto-restart delay
+import contextvars
+import weakref
+import collections
+import unicodedata
+import os
+import sqlite3
+import queue
+import atexit
+import bisect
+import functools
+import types
+import traceback
+import http.server
+import heapq
+import argparse
+import signal
+import itertools
+import multiprocessing
+import multiprocessing.connection
 
 # Global bot name
 BOT_NAME = "MudaRemote"
 
-# Load presets from JSON file
+# Presets are loaded from JSON by load_presets() at startup, so the module can be imported without them
+PRESETS_FILE = "presets.json"
+presets_path = PRESETS_FILE # Set from --config; the hot-reload watcher follows it
+process_started_at = time.monotonic() # Startup timing: time to first ready is measured from here
 presets = {}
-try:
-    with open("presets.json", "r", encoding="utf-8") as f:
-        presets = json.load(f)
-except FileNotFoundError:
-    print("presets.json file not found. Please create it and enter the necessary information.")
-    sys.exit(1)
-except json.JSONDecodeError:
-    print("Error decoding presets.json. Please check the file format.")
-    sys.exit(1)
+
+def load_presets(path=PRESETS_FILE):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
 
 
 # Target bot ID (Mudae's ID)
 TARGET_BOT_ID = 432610292342587392
+# Discord epoch (ms) used to read creation time out of snowflake IDs
+DISCORD_EPOCH_MS = 1420070400000
 
 # ANSI color codes
 COLORS = {
@@ -46,42 +64,1198 @@ CLAIM_EMOJIS = ['💖', '💗', '💘', '❤️', '💓', '💕', '♥️', '
 # Reverted KAKERA_EMOJIS list
 KAKERA_EMOJIS = ['kakeraY', 'kakeraO', 'kakeraR', 'kakeraW', 'kakeraL']
 
+# Log output: LOG_FORMAT is "text" or "jsonl". With LOG_PER_PRESET each preset writes LOG_DIR/<preset>.txt
+# instead of sharing LOG_FILE. Files rotate past LOG_MAX_BYTES, keeping LOG_BACKUP_COUNT old copies.
+LOG_FILE = "logs.txt"
+LOG_DIR = "logs"
+LOG_FORMAT = "text"
+LOG_PER_PRESET = False
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+# Writer thread flushes queued lines after LOG_FLUSH_INTERVAL seconds or LOG_BATCH_SIZE lines
+LOG_FLUSH_INTERVAL = 0.5
+LOG_BATCH_SIZE = 200
+
+# Metrics export: METRICS_HTTP_PORT > 0 serves Prometheus text on 127.0.0.1:<port>/metrics;
+# METRICS_JSON_PATH writes a JSON snapshot of every preset's metrics each METRICS_JSON_INTERVAL seconds.
+METRICS_HTTP_PORT = 0
+METRICS_JSON_PATH = None
+METRICS_JSON_INTERVAL = 60
+# Histogram buckets (seconds) for claim latency and $tu round-trip time
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 30)
+
+# Seconds to wait before restarting a preset whose bot instance stopped
+PRESET_RESTART_DELAY = 60
+# Seconds to wait for Mudae's $tu reply on the gateway before falling back to a history scan
+TU_RESPONSE_TIMEOUT = 6
+# Max seconds to wait for the remaining roll embeds after the last roll command was sent
+ROLL_COLLECT_TIMEOUT = 5
+# Directory holding one SQLite state file per preset (reset deadlines, handled message IDs). Writes go through a
+# per-preset writer thread, at most STATE_WRITE_BATCH_SIZE queued writes per transaction.
+STATE_DIR = "state"
+STATE_WRITE_BATCH_SIZE = 200
+# Roll history: every character roll seen is stored in ROLL_HISTORY_PATH (None disables it). A writer thread inserts
+# queued rows in one transaction per ROLL_HISTORY_BATCH_SIZE rows or ROLL_HISTORY_FLUSH_INTERVAL seconds.
+ROLL_HISTORY_PATH = os.path.join(STATE_DIR, "roll_history.sqlite3")
+ROLL_HISTORY_BATCH_SIZE = 500
+ROLL_HISTORY_FLUSH_INTERVAL = 2
+# Mudae roll commands; a roll embed without an interaction is attributed to the last user who sent one of these
+ROLL_COMMANDS = frozenset(("w", "wa", "wg", "h", "ha", "hg", "m", "ma", "mg"))
+ROLLER_MATCH_WINDOW = 10
+# Snipe dedup caches: message IDs are forgotten once older than DEDUP_TTL seconds (by snowflake time)
+# or when a cache holds more than DEDUP_MAX_SIZE IDs. Also bounds what is restored after a restart.
+DEDUP_TTL = 3600
+DEDUP_MAX_SIZE = 5000
+# Reset scheduler: the timer thread re-reads the clock at least every SCHEDULER_MAX_SLEEP seconds, which bounds
+# how late a wakeup can be after the machine was suspended
+SCHEDULER_MAX_SLEEP = 15
+# Quota model: a $tu is forced once the last one is older than QUOTA_MAX_AGE seconds, even when the model
+# is otherwise confident about the claim/roll counts
+QUOTA_MAX_AGE = 6 * 3600
+# States of the rolling lifecycle (client.roll_state); one loop in create_bot moves between them
+ROLL_STATES = ("checking", "rolling", "collecting", "wait_claim_reset", "wait_roll_reset")
+# Outbound queue: kind -> (priority, method, route path, bucket is per channel). Lower priority values go first;
+# the route is what discord.py keys its rate-limit buckets by, so the queue can read the same limits
+OUTBOUND_KINDS = {
+    "claim": (0, "POST", "/interactions", False),
+    "react": (0, "PUT", "/channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me", True),
+    "rt": (0, "POST", "/channels/{channel_id}/messages", True),
+    "kakera": (1, "POST", "/interactions", False),
+    "command": (2, "POST", "/channels/{channel_id}/messages", True),
+    "roll": (3, "POST", "/channels/{channel_id}/messages", True)}
+# AIMD spacing between sends: doubled (at least OUTBOUND_BACKOFF_MIN) on each 429/5xx, minus
+# OUTBOUND_BACKOFF_STEP per clean send, capped at OUTBOUND_MAX_BACKOFF seconds
+OUTBOUND_BACKOFF_MIN = 0.5
+OUTBOUND_BACKOFF_STEP = 0.1
+OUTBOUND_MAX_BACKOFF = 10
+# presets.json is checked for changes every PRESETS_WATCH_INTERVAL seconds while presets are running
+PRESETS_WATCH_INTERVAL = 2
+# Seconds between shared-loop resource reports (RSS / task count per preset)
+SHARED_LOOP_REPORT_INTERVAL = 300
+# Sharded mode: worker processes (0 = one per CPU core), seconds between worker status reports, and the first
+# restart delay for a crashed worker (doubled per consecutive crash, capped at PRESET_RESTART_DELAY)
+SHARD_WORKERS = 0
+SHARD_STATUS_INTERVAL = 30
+SHARD_RESTART_DELAY = 5
+# Loop watchdog: every bot loop runs a heartbeat each LOOP_HEARTBEAT_INTERVAL seconds. A heartbeat later than
+# LOOP_LAG_THRESHOLD is logged with the stack the loop is stuck in, and a handler step (the code between two
+# awaits) running longer than LOOP_LAG_THRESHOLD is logged by name.
+LOOP_HEARTBEAT_INTERVAL = 0.25
+LOOP_LAG_THRESHOLD = 0.25
+STALL_STACK_DEPTH = 12
+# Histogram buckets (seconds) for loop lag and handler timings, which are mostly well under LATENCY_BUCKETS
+HANDLER_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+# Sampling profiler: SIGUSR1 or touching PROFILE_TRIGGER_FILE (its content may give the seconds) samples every bot
+# loop's stack each PROFILE_SAMPLE_INTERVAL seconds for PROFILE_DURATION seconds and writes a report to PROFILE_DIR
+PROFILE_TRIGGER_FILE = "profile.trigger"
+PROFILE_DIR = "profiles"
+PROFILE_DURATION = 30
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_TOP = 40
+
+
+def format_log_message(message, preset_name, created=None):
+    stamp = datetime.datetime.fromtimestamp(created) if created is not None else datetime.datetime.now()
+    return f"[{stamp.strftime('%Y-%m-%d %H:%M:%S')}][{preset_name}] {message}"
+
+def color_log_line(log_message, log_type="INFO"):
+    return f"{COLORS.get(log_type.upper(), COLORS['INFO'])}{log_message}{COLORS['ENDC']}"
+
+
+# Log sink: print_log only enqueues. One writer thread per process prints to the console and appends
+# to the log file(s) in batches, flushing on size or time and rotating files past LOG_MAX_BYTES.
+class LogSink:
+    STOP = object()
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue(); self.thread = None; self.lock = threading.Lock()
+        self.files = {} # path -> open file handle
+
+    def emit(self, message, preset_name, log_type="INFO", created=None):
+        if self.thread is None: self.start()
+        self.queue.put((created or time.time(), preset_name, log_type, message))
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None: return
+            self.thread = threading.Thread(target=self._run, name="mudae-log-writer", daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    def close(self, timeout=2.0):
+        if self.thread is None: return
+        self.queue.put(self.STOP); self.thread.join(timeout)
+
+    def _path_for(self, preset_name):
+        ext = ".jsonl" if LOG_FORMAT == "jsonl" else ".txt"
+        if not LOG_PER_PRESET: return os.path.splitext(LOG_FILE)[0] + ext
+        return os.path.join(LOG_DIR, re.sub(r"[^\w.-]", "_", str(preset_name)) + ext)
+
+    def _run(self):
+        pending = {}; first_pending_at = None; stopping = False
+        while not stopping:
+            timeout = None if first_pending_at is None else max(0.0, first_pending_at + LOG_FLUSH_INTERVAL - time.monotonic())
+            try: items = [self.queue.get(timeout=timeout)]
+            except queue.Empty: items = []
+            try:
+                while len(items) < LOG_BATCH_SIZE: items.append(self.queue.get_nowait())
+            except queue.Empty: pass
+            console_lines = []
+            for item in items:
+                if item is self.STOP: stopping = True; continue
+                created, preset_name, log_type, message = item
+                line = format_log_message(message, preset_name, created)
+                console_lines.append(color_log_line(line, log_type))
+                if LOG_FORMAT == "jsonl":
+                    line = json.dumps({"ts": datetime.datetime.fromtimestamp(created).isoformat(timespec="milliseconds"), "preset": preset_name, "type": log_type, "message": message}, ensure_ascii=False)
+                pending.setdefault(self._path_for(preset_name), []).append(line)
+            if console_lines:
+                try: sys.stdout.write("\n".join(console_lines) + "\n"); sys.stdout.flush()
+                except Exception: pass
+            if pending and first_pending_at is None: first_pending_at = time.monotonic()
+            due = first_pending_at is not None and time.monotonic() - first_pending_at >= LOG_FLUSH_INTERVAL
+            if pending and (stopping or due or sum(len(lines) for lines in pending.values()) >= LOG_BATCH_SIZE):
+                self._flush(pending); pending = {}; first_pending_at = None
+        for handle in self.files.values(): handle.close()
+
+    def _flush(self, pending):
+        for path, lines in pending.items():
+            try:
+                handle = self.files.get(path)
+                if handle is None:
+                    if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+                    handle = self.files[path] = open(path, "a", encoding="utf-8")
+                handle.write("\n".join(lines) + "\n"); handle.flush()
+                if LOG_MAX_BYTES and handle.tell() >= LOG_MAX_BYTES: self._rotate(path)
+            except Exception as e:
+                timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                print(f"\033[91m[{timestamp}][System] Error writing to log file: {e}\033[0m")
+
+    def _rotate(self, path):
+        self.files.pop(path).close()
+        for i in range(LOG_BACKUP_COUNT - 1, 0, -1):
+            if os.path.exists(f"{path}.{i}"): os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+        if LOG_BACKUP_COUNT > 0: os.replace(path, f"{path}.1")
+        else: os.remove(path)
+
+log_sink = LogSink()
 
-def color_log(message, preset_name, log_type="INFO"):
-    color_code = COLORS.get(log_type.upper(), COLORS["INFO"])
-    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    log_message = f"[{timestamp}][{preset_name}] {message}"
-    print(f"{color_code}{log_message}{COLORS['ENDC']}")
-    return log_message
+def print_log(message, preset_name, log_type="INFO"):
+    log_sink.emit(message, preset_name, log_type)
+
+
+# Single-pass embed classifier: every snipe branch and the post-roll handler read this record
+# instead of re-running the kakera regex and re-scanning the buttons of the same message.
+KAKERA_VALUE_RE = re.compile(r"\*\*([\d,]+)\*\*<:kakera:")
+CLAIM_EMOJI_SET = frozenset(CLAIM_EMOJIS); KAKERA_EMOJI_SET = frozenset(KAKERA_EMOJIS)
+EmbedRecord = collections.namedtuple("EmbedRecord", "char_name char_name_l series series_l kakera claim_button kakera_button received_at")
+
+def classify_embed(message):
+    # received_at (monotonic) is when the embed was first read; claim latency is measured from it
+    embed = message.embeds[0]
+    char_name = embed.author.name if embed.author and embed.author.name else None
+    desc = embed.description or ""; series = desc.partition("\n")[0]; kakera = 0
+    match_k = KAKERA_VALUE_RE.search(desc)
+    if match_k:
+        try: kakera = int(match_k.group(1).replace(",", ""))
+        except ValueError: pass
+    claim_button = None; kakera_button = None
+    for comp in message.components:
+        for btn in getattr(comp, "children", ()):
+            emoji_name = getattr(getattr(btn, "emoji", None), "name", None)
+            if emoji_name is None: continue
+            if claim_button is None and emoji_name in CLAIM_EMOJI_SET: claim_button = btn
+            elif kakera_button is None and emoji_name in KAKERA_EMOJI_SET: kakera_button = btn
+    return EmbedRecord(char_name, char_name.lower() if char_name else "", series, series.lower(), kakera, claim_button, kakera_button, time.monotonic())
+
+
+
+# Wishlist index: exact character names live in a set, series keywords in an Aho-Corasick automaton,
+# so a Mudae embed costs one hash lookup plus one pass over its series line however long the lists are.
+def fold_text(text, fold_accents=False):
+    if not fold_accents: return text.lower()
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+class SeriesMatcher:
+    def __init__(self, keywords):
+        self.goto = [{}]; self.fail = [0]; self.out = [False]
+        for kw in keywords:
+            state = 0
+            for ch in kw:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto); self.goto[state][ch] = nxt
+                    self.goto.append({}); self.fail.append(0); self.out.append(False)
+                state = nxt
+            self.out[state] = True # An empty keyword marks the root, matching every line like `"" in s` does
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                if state:
+                    f = self.fail[state]
+                    while f and ch not in self.goto[f]: f = self.fail[f]
+                    self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] or self.out[self.fail[nxt]]
+
+    def search(self, text):
+        goto = self.goto; fail = self.fail; out = self.out; state = 0
+        if out[0]: return True
+        for ch in text:
+            while state and ch not in goto[state]: state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]: return True
+        return False
 
-def write_log_to_file(log_message):
-    try:
-        with open("logs.txt", "a", encoding='utf-8') as log_file:
-            log_file.write(log_message + "\n")
-    except Exception as e:
-        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        print(f"\033[91m[{timestamp}][System] Error writing to log file: {e}\033[0m")
+class WishlistIndex:
+    def __init__(self, wishlist, series_wishlist, fold_accents=False):
+        self.fold_accents = fold_accents
+        self.names = frozenset(fold_text(w, fold_accents) for w in wishlist)
+        self.series_count = len(series_wishlist)
+        self.series = SeriesMatcher(fold_text(sw, fold_accents) for sw in series_wishlist)
+
+    def has_name(self, char_name):
+        return bool(char_name) and fold_text(char_name, self.fold_accents) in self.names
+
+    def matches_series(self, series_line):
+        return self.series_count > 0 and self.series.search(fold_text(series_line, self.fold_accents))
+
+
+
+# $tu grammar: one phrase table per language, compiled into a single regex that reads every field of a reply
+# in one pass. Phrases set a field: "claim" (with its value, and the reset when the phrase carries one),
+# "claim_reset", "rolls", "rolls_reset", or "reset" for the subject the reply named last (PT uses one reset
+# phrase for both). {duration} is "**2h 05**" or "**45**", {count} a plain "**10**". A language is added as
+# one more table entry. Every phrase has a "**" or "__" marker, and the text before its first marker must
+# have a fixed length: the compiled scanner only stops at marker characters and checks that text behind it.
+TU_PHRASES = {
+    "en": (("claim", True, r"you __can__ claim"),
+           ("claim", False, r"can['’]t claim for another \*\*{duration}\*\* min"),
+           ("claim_reset", None, r"next claim reset is in \*\*{duration}\*\* min"),
+           ("rolls", None, r"you have \*\*{count}\*\* rolls?(?: \([^)\n]*\))? left"),
+           ("rolls_reset", None, r"next rolls? reset in \*\*{count}\*\* min")),
+    "pt": (("claim", True, r"você __pode__ se casar agora mesmo!"),
+           ("claim", False, r"calma aí, falta um tempo antes que você possa se casar novamente \*\*{duration}\*\* min"),
+           ("rolls", None, r"você tem \*\*{count}\*\* rolls? restantes"),
+           ("reset", None, r"a próxima reinicialização é em \*\*{duration}\*\* min")),
+}
+TuStatus = collections.namedtuple("TuStatus", "lang claim_available claim_reset rolls_left rolls_reset") # Minutes; None when not in the reply
+
+def optional_char_variants(prefix):
+    # "next rolls? reset" -> ["next rolls reset", "next roll reset"]: lookbehinds must be fixed-width, so "c?" becomes one per variant
+    match = re.search(r"(?<!\\)(\w)\?", prefix)
+    if not match: return [prefix]
+    return [prefix[:match.start()] + char + rest for rest in optional_char_variants(prefix[match.end():]) for char in (match.group(1), "")]
+
+def compile_tu_grammar(phrases):
+    # -> (scanner, {group name: (lang, field, value, minutes group, hours group)}); each phrase is one named alternative
+    alternatives = []; table = {}
+    for lang, entries in phrases.items():
+        for field, value, pattern in entries:
+            name = f"p{len(table)}"
+            table[name] = (lang, field, value, f"{name}_m" if "{" in pattern else None, f"{name}_h" if "{duration}" in pattern else None)
+            pattern = pattern.replace("{duration}", rf"(?:(?P<{name}_h>\d+)h\s*)?(?P<{name}_m>\d+)").replace("{count}", rf"(?P<{name}_m>\d+)")
+            marker = min(i for i in (pattern.find(r"\*\*"), pattern.find("__")) if i >= 0); first = pattern[marker:marker + (2 if pattern[marker] == "\\" else 1)]
+            # "prefix**rest" -> "*(?<=prefix*)*rest": starting on a literal lets the regex engine skip ahead to the next marker character
+            lookbehind = "|".join(f"(?<={variant}{first})" for variant in optional_char_variants(pattern[:marker]))
+            alternatives.append(f"{first}(?P<{name}>(?:{lookbehind}){pattern[marker + len(first):]})") # Group after the literal, or the skip is lost
+    return re.compile("|".join(alternatives)), table
+
+TU_SCANNER, TU_PHRASE_TABLE = compile_tu_grammar(TU_PHRASES)
+
+def parse_tu(content):
+    # TuStatus of a $tu reply, or None when no claim or rolls phrase is in it. The first occurrence of each field wins.
+    lang = claim_available = claim_reset = rolls_left = rolls_reset = subject = None
+    for match in TU_SCANNER.finditer(content.lower()):
+        phrase_lang, field, value, minutes_group, hours_group = TU_PHRASE_TABLE[match.lastgroup]
+        minutes = int(match.group(minutes_group)) if minutes_group else None
+        if hours_group and match.group(hours_group): minutes += 60 * int(match.group(hours_group))
+        if field == "reset": field = "claim_reset" if subject == "claim" else "rolls_reset" if subject == "rolls" else None
+        if field == "claim" and claim_available is None:
+            claim_available = value; lang = lang or phrase_lang; subject = "claim"
+            if minutes is not None and claim_reset is None: claim_reset = minutes
+        elif field == "rolls" and rolls_left is None: rolls_left = minutes; lang = lang or phrase_lang; subject = "rolls"
+        elif field == "claim_reset" and claim_reset is None: claim_reset = minutes
+        elif field == "rolls_reset" and rolls_reset is None: rolls_reset = minutes
+    if claim_available is None and rolls_left is None: return None
+    return TuStatus(lang, claim_available, claim_reset, rolls_left, rolls_reset)
+
+def match_tu_response(content, user_name, status=None):
+    # "en"/"pt" when the claim and rolls lines both parse, "name" when only the rolls line does and the
+    # user's name is in the first line, otherwise None
+    status = status or parse_tu(content)
+    if status is None or status.rolls_left is None: return None
+    if status.claim_available is not None: return status.lang
+    if user_name and user_name.lower() in content.partition("\n")[0].lower(): return "name"
+    return None
+
+# Response waiter: futures keyed by channel and resolved straight from on_message when a Mudae
+# reply matches the expected predicate, so command round-trips finish as soon as Mudae answers.
+class ResponseWaiter:
+    def __init__(self):
+        self.pending = {} # channel_id -> [(predicate, future)]
+
+    def expect(self, channel_id, predicate):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(channel_id, []).append((predicate, future))
+        return future
+
+    def discard(self, channel_id, future):
+        waiters = self.pending.get(channel_id)
+        if not waiters: return
+        waiters[:] = [w for w in waiters if w[1] is not future]
+        if not waiters: del self.pending[channel_id]
+
+    def feed(self, message):
+        waiters = self.pending.get(message.channel.id)
+        if not waiters: return False
+        matched = False
+        for predicate, future in list(waiters):
+            if future.done(): continue
+            try: hit = predicate(message)
+            except Exception: hit = False
+            if hit: future.set_result(message); matched = True
+        return matched
+
+    async def wait(self, channel_id, future, timeout):
+        try: return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError: return None
+
+
+
+# Roll session: buffers the embeds of one roll batch as they arrive on the gateway. Kakera is clicked
+# immediately and the claim decision runs as soon as the last expected roll reply is in.
+class RollSession:
+    def __init__(self, channel_id):
+        self.channel_id = channel_id; self.entries = []; self.seen_ids = set()
+        self.kakera_clicked = set(); self.claimed_ids = set()
+        self.expected = None; self.complete = asyncio.Event()
+
+    def add(self, message, record):
+        if message.id in self.seen_ids: return False
+        self.seen_ids.add(message.id); self.entries.append((message, record))
+        self._check_complete(); return True
+
+    def finish_sending(self, sent_count):
+        self.expected = sent_count; self._check_complete()
+
+    def take_kakera(self, message_id):
+        if message_id in self.kakera_clicked: return False
+        self.kakera_clicked.add(message_id); return True
+
+    def _check_complete(self):
+        if self.expected is not None and len(self.entries) >= self.expected: self.complete.set()
+
+
+
+# Persistent per-preset state: claim/roll reset deadlines and recently handled message IDs, so a
+# restarted bot can go straight to its wait or roll phase and does not re-snipe the same messages.
+SNIPE_MESSAGE_KINDS = {"wishlist": "sniped_messages", "series": "series_sniped_messages", "kakera": "kakera_value_sniped_messages"} # Arbiter source -> dedup cache
+HANDLED_MESSAGE_KINDS = ("sniped_messages", "series_sniped_messages", "kakera_value_sniped_messages", "kakera_reaction_sniped_messages")
+
+def snowflake_time(snowflake):
+    return ((snowflake >> 22) + DISCORD_EPOCH_MS) / 1000
+
+def reset_deadline(minutes):
+    # Epoch seconds of the reset minute, rounded the same way wait_for_reset rounds it
+    target = datetime.datetime.now() + datetime.timedelta(minutes=minutes)
+    return target.replace(second=0, microsecond=0).timestamp()
+
+class DedupCache:
+    # Insertion-ordered; snowflakes arrive roughly in time order, so expiry only has to look at the front.
+    # Expiry runs on insert and when stats are collected; membership tests are plain lookups and count nothing.
+    def __init__(self, max_size=DEDUP_MAX_SIZE, ttl=DEDUP_TTL):
+        self.max_size = max_size; self.ttl = ttl
+        self.entries = collections.OrderedDict() # message_id -> snowflake time
+        self.hits = 0; self.misses = 0; self.evictions = 0
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl; entries = self.entries
+        while entries:
+            message_id, created = next(iter(entries.items()))
+            if created >= cutoff: break
+            entries.popitem(last=False); self.evictions += 1
+
+    def __contains__(self, message_id):
+        return message_id in self.entries
+
+    def decide(self, message_id, seen=False):
+        # One dedup decision for a snipe about to fire: False (a hit) if the message was already handled
+        if seen or message_id in self.entries: self.hits += 1; return False
+        self.misses += 1; return True
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, message_id):
+        self._expire()
+        created = snowflake_time(message_id)
+        if message_id in self.entries or created < time.time() - self.ttl: return
+        self.entries[message_id] = created
+        while len(self.entries) > self.max_size: self.entries.popitem(last=False); self.evictions += 1
+
+    def update(self, message_ids):
+        for message_id in sorted(message_ids): self.add(message_id)
+
+    def stats(self):
+        self._expire()
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+def dedup_stats(client):
+    return {(kind, channel_id): getattr(state, kind).stats() for channel_id, state in client.channel_states.items() for kind in HANDLED_MESSAGE_KINDS}
+
+# Snipe settings a "channel_id" list entry may override for its channel (preset key -> ChannelState attribute)
+CHANNEL_SETTINGS = {
+    "snipe_mode": "snipe_mode", "snipe_delay": "snipe_delay", "series_snipe_mode": "series_snipe_mode", "series_snipe_delay": "series_snipe_delay",
+    "kakera_snipe_mode": "kakera_snipe_mode_active", "kakera_snipe_threshold": "kakera_snipe_threshold",
+    "kakera_reaction_snipe_mode": "kakera_reaction_snipe_mode_active", "kakera_reaction_snipe_delay": "kakera_reaction_snipe_delay_value"}
+
+def preset_channels(channel_id):
+    # "channel_id": 123, [123, 456] or [123, {"id": 456, "snipe_delay": 1}] -> [(channel id, overrides)]; rolls happen in the first
+    entries = channel_id if isinstance(channel_id, list) else [channel_id]
+    return [(entry["id"], {k: v for k, v in entry.items() if k != "id"}) if isinstance(entry, dict) else (entry, {}) for entry in entries]
+
+class ChannelState:
+    # One watched channel: its snipe settings (the preset's, with the channel's overrides on top) and its handled-message caches.
+    # The claim right, claim arbiter and wishlists stay on the client, shared by every channel.
+    def __init__(self, channel_id, overrides=None):
+        self.channel_id = channel_id; self.overrides = dict(overrides or {})
+        for kind in HANDLED_MESSAGE_KINDS: setattr(self, kind, DedupCache())
+
+    def configure(self, client):
+        for key, attr in CHANNEL_SETTINGS.items(): setattr(self, attr, self.overrides.get(key, getattr(client, attr)))
+        return self
+
+class PresetStateStore:
+    # Writes are queued from the event loop and applied by one thread per preset, like RollHistory; the in-memory
+    # dedup caches stay authoritative, so a snipe never waits on SQLite. Reads (startup only) flush the queue first.
+    STOP = object()
+
+    def __init__(self, preset_name, directory=STATE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, re.sub(r"[^\w.-]", "_", preset_name) + ".sqlite3")
+        self.lock = threading.Lock(); self.queue = queue.SimpleQueue(); self.thread = None
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL"); self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS status (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS handled (kind TEXT, message_id INTEGER, PRIMARY KEY (kind, message_id))")
+        self.db.commit()
+
+    def save_status(self, **fields):
+        fields["saved_at"] = time.time()
+        self.put(("status", [(k, json.dumps(v)) for k, v in fields.items()]))
+
+    def load_status(self):
+        self.flush()
+        with self.lock: rows = self.db.execute("SELECT key, value FROM status").fetchall()
+        return {k: json.loads(v) for k, v in rows}
+
+    def add_handled(self, kind, message_id):
+        self.put(("handled", [(kind, message_id)]))
+
+    def put(self, item):
+        if self.thread is None: self.start()
+        self.queue.put(item)
+
+    def flush(self, timeout=5.0):
+        # Blocks until everything queued so far is committed
+        if self.thread is None: return
+        done = threading.Event(); self.queue.put(done); done.wait(timeout)
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None: return
+            self.thread = threading.Thread(target=self._run, name=f"mudae-state-{os.path.basename(self.path)}", daemon=True); self.thread.start()
+            atexit.register(self.close)
+
+    def close(self, timeout=2.0):
+        if self.thread is None: return
+        self.queue.put(self.STOP); self.thread.join(timeout)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            items = [self.queue.get()]
+            while len(items) < STATE_WRITE_BATCH_SIZE: # Whatever queued up during the last commit goes in one transaction
+                try: items.append(self.queue.get_nowait())
+                except queue.Empty: break
+            stopping = any(item is self.STOP for item in items)
+            rows = {"status": [], "handled": []}; flushed = []
+            for item in items:
+                if isinstance(item, threading.Event): flushed.append(item)
+                elif item is not self.STOP: rows[item[0]].extend(item[1])
+            try:
+                with self.lock, self.db:
+                    self.db.executemany("INSERT OR REPLACE INTO status (key, value) VALUES (?, ?)", rows["status"])
+                    self.db.executemany("INSERT OR IGNORE INTO handled (kind, message_id) VALUES (?, ?)", rows["handled"])
+            except sqlite3.Error as e: print_log(f"[{BOT_NAME}] State write failed for {os.path.basename(self.path)}: {e}", "System", "ERROR")
+            for done in flushed: done.set()
+
+    def load_handled(self, max_age):
+        # Snowflakes grow with time, so everything below the cutoff ID is older than max_age
+        cutoff_id = int((time.time() - max_age) * 1000 - DISCORD_EPOCH_MS) << 22
+        self.flush()
+        with self.lock:
+            self.db.execute("DELETE FROM handled WHERE message_id < ?", (cutoff_id,)); self.db.commit()
+            rows = self.db.execute("SELECT kind, message_id FROM handled").fetchall()
+        handled = {}
+        for kind, message_id in rows: handled.setdefault(kind, set()).add(message_id)
+        return handled
+
+state_stores = {}; state_stores_lock = threading.Lock()
+
+def get_state_store(preset_name):
+    with state_stores_lock:
+        if preset_name not in state_stores: state_stores[preset_name] = PresetStateStore(preset_name)
+        return state_stores[preset_name]
+
+class RollHistory:
+    # Observed rolls, queued from the event loop and written by one thread per process; the loop never touches SQLite
+    STOP = object()
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS rolls (message_id INTEGER PRIMARY KEY, channel_id INTEGER NOT NULL, guild_id INTEGER, rolled_at REAL NOT NULL, "
+        "character TEXT NOT NULL, series TEXT, kakera INTEGER NOT NULL DEFAULT 0, roller_id INTEGER, roller TEXT, observed_by TEXT, "
+        "claimable INTEGER NOT NULL DEFAULT 0, claimed INTEGER NOT NULL DEFAULT 0, claim_action TEXT, claimed_at REAL, kakera_clicked INTEGER NOT NULL DEFAULT 0, "
+        "kakera_button INTEGER NOT NULL DEFAULT 0, own_roll INTEGER NOT NULL DEFAULT 0)",
+        "CREATE INDEX IF NOT EXISTS rolls_character ON rolls (character COLLATE NOCASE, rolled_at)",
+        "CREATE INDEX IF NOT EXISTS rolls_series ON rolls (series COLLATE NOCASE, rolled_at)",
+        # Covers "top kakera in channel X since T" without touching the table
+        "CREATE INDEX IF NOT EXISTS rolls_channel_time ON rolls (channel_id, rolled_at, kakera, character)",
+        "CREATE INDEX IF NOT EXISTS rolls_time ON rolls (rolled_at, kakera, character)")
+    ADDED_COLUMNS = ("kakera_button", "own_roll") # Not in files written before they existed; added on open
+    INSERT = ("INSERT OR IGNORE INTO rolls (message_id, channel_id, guild_id, rolled_at, character, series, kakera, roller_id, roller, observed_by, claimable, "
+              "kakera_button, own_roll) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+    def __init__(self, path=None):
+        self.path = path; self.queue = queue.SimpleQueue(); self.thread = None; self.lock = threading.Lock()
+
+    def record(self, message, record, observed_by, roller=None, own_roll=False):
+        if self.thread is None: self.start()
+        roller_id, roller_name = roller or (None, None); guild = getattr(message, "guild", None)
+        self.queue.put(("roll", (message.id, message.channel.id, guild.id if guild else None, snowflake_time(message.id), record.char_name, record.series,
+                                 record.kakera, roller_id, roller_name, observed_by, int(record.claim_button is not None),
+                                 int(record.kakera_button is not None), int(own_roll))))
+
+    def clicked(self, message_id, action):
+        if self.thread is None: self.start()
+        if action == "kakera": self.queue.put(("kakera", (message_id,)))
+        else: self.queue.put(("claim", (action, time.time(), message_id)))
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None: return
+            self.thread = threading.Thread(target=self._run, name="mudae-roll-history", daemon=True); self.thread.start()
+            atexit.register(self.close)
+
+    def close(self, timeout=2.0):
+        if self.thread is None: return
+        self.queue.put(self.STOP); self.thread.join(timeout)
+
+    def _run(self):
+        db = open_roll_history(self.path or ROLL_HISTORY_PATH); stopping = False
+        while not stopping:
+            items = [self.queue.get()]; deadline = time.monotonic() + ROLL_HISTORY_FLUSH_INTERVAL
+            while len(items) < ROLL_HISTORY_BATCH_SIZE and items[-1] is not self.STOP:
+                try: items.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty: break
+            stopping = items[-1] is self.STOP
+            rows = {"roll": [], "claim": [], "kakera": []}
+            for item in items:
+                if item is not self.STOP: rows[item[0]].append(item[1])
+            try:
+                with db: # One transaction per batch; inserts first so clicks in the same batch find their row
+                    db.executemany(self.INSERT, rows["roll"])
+                    db.executemany("UPDATE rolls SET claimed = 1, claim_action = ?, claimed_at = ? WHERE message_id = ?", rows["claim"])
+                    db.executemany("UPDATE rolls SET kakera_clicked = 1 WHERE message_id = ?", rows["kakera"])
+            except sqlite3.Error as e: print_log(f"[{BOT_NAME}] Roll history write failed ({len(items)} rows dropped): {e}", "System", "ERROR")
+        db.close()
+
+def open_roll_history(path, readonly=False):
+    if readonly: return sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, timeout=30) # Shard workers share the file; WAL lets readers (the history CLI) run alongside
+    db.execute("PRAGMA journal_mode=WAL"); db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(RollHistory.SCHEMA[0])
+    columns = {row[1] for row in db.execute("PRAGMA table_info(rolls)")}
+    for column in RollHistory.ADDED_COLUMNS:
+        if column not in columns: db.execute(f"ALTER TABLE rolls ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+    for statement in RollHistory.SCHEMA[1:]: db.execute(statement)
+    db.commit(); return db
+
+roll_history = RollHistory()
+
+def plan_resume(saved, key_mode, now=None):
+    # Mirrors check_status's order: claim wait first (unless key mode), then rolls. None = run a fresh $tu.
+    now = now or time.time()
+    claim_reset_at = saved.get("claim_reset_at"); rolls_reset_at = saved.get("rolls_reset_at")
+    if not saved.get("claim_right_available") and not key_mode:
+        return "wait_claim" if claim_reset_at and claim_reset_at > now else None
+    if "rolls_left" not in saved or not rolls_reset_at or rolls_reset_at <= now: return None
+    return "wait_rolls" if saved["rolls_left"] == 0 else "roll"
+
+
+
+# Reset scheduler: one timer thread holds every preset's claim/roll reset deadline on a clock that keeps
+# counting through suspend and ignores wall-clock jumps. Each wake is keyed on its own deadline; wakes due
+# together are released in one pass, and each preset then waits its own delay_seconds on its own loop.
+def boottime():
+    return time.clock_gettime(time.CLOCK_BOOTTIME) if hasattr(time, "CLOCK_BOOTTIME") else time.monotonic()
+
+def reset_minute_boottime(minutes):
+    # Mudae's reset lands on a wall-clock minute; convert that minute once, then only the boot clock is read
+    wall_now = time.time(); target = datetime.datetime.fromtimestamp(wall_now) + datetime.timedelta(minutes=minutes)
+    return boottime() + (target.replace(second=0, microsecond=0).timestamp() - wall_now)
+
+ScheduledWake = collections.namedtuple("ScheduledWake", "preset_name kind reset_at delay loop future")
+
+class ResetScheduler:
+    def __init__(self, max_sleep=SCHEDULER_MAX_SLEEP):
+        self.cond = threading.Condition(); self.thread = None; self.max_sleep = max_sleep
+        self.heap = [] # (reset_at, sequence, wake); cancelled wakes stay until they come due or the heap is compacted
+        self.wakes = {} # future -> wake, for every wake still scheduled
+        self.sequence = itertools.count()
+
+    def schedule(self, preset_name, kind, reset_at, delay=0):
+        loop = asyncio.get_running_loop(); future = loop.create_future()
+        with self.cond:
+            self.wakes[future] = wake = ScheduledWake(preset_name, kind, reset_at, delay, loop, future)
+            heapq.heappush(self.heap, (reset_at, next(self.sequence), wake)); self.cond.notify()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="mudae-reset-scheduler", daemon=True); self.thread.start()
+        return future
+
+    def cancel(self, future):
+        with self.cond:
+            if self.wakes.pop(future, None) is None: return
+            if not self.wakes or len(self.heap) > 2 * len(self.wakes) + 16: # Mostly cancelled entries: rebuild from the live wakes
+                self.heap = [entry for entry in self.heap if entry[2].future in self.wakes]; heapq.heapify(self.heap)
+
+    async def wait(self, preset_name, kind, reset_at, delay):
+        future = self.schedule(preset_name, kind, reset_at, delay)
+        try: await future
+        finally: self.cancel(future)
+        await asyncio.sleep(delay) # The preset's own delay_seconds, on its own loop
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > boottime():
+                    self.cond.wait(min(self.heap[0][0] - boottime(), self.max_sleep) if self.heap else None)
+                due = []
+                while self.heap and self.heap[0][0] <= boottime():
+                    wake = heapq.heappop(self.heap)[2]
+                    if self.wakes.pop(wake.future, None) is not None: due.append(wake)
+            for wake in due:
+                try: wake.loop.call_soon_threadsafe(self._release, wake)
+                except RuntimeError: pass # Loop already closed (preset stopped)
+
+    @staticmethod
+    def _release(wake):
+        if not wake.future.done(): wake.future.set_result(True)
+
+    def snapshot(self):
+        now = boottime(); wall_now = time.time()
+        with self.cond: wakes = sorted(self.wakes.values(), key=lambda w: w.reset_at)
+        return [{"preset": w.preset_name, "kind": w.kind, "slot_wakeups": sum(1 for x in wakes if round(x.reset_at / 60) == round(w.reset_at / 60)),
+                 "reset_at": datetime.datetime.fromtimestamp(wall_now + w.reset_at - now).isoformat(timespec="seconds"),
+                 "wake_in_seconds": round(w.reset_at + w.delay - now, 1)} for w in wakes]
+
+reset_scheduler = ResetScheduler()
+
+
+
+# Quota model: what the last $tu said, plus what the bot has done since (rolls whose replies arrived, claims)
+# and the reset intervals learned from consecutive $tu replies. plan() answers for $tu while it is confident.
+QuotaPlan = collections.namedtuple("QuotaPlan", "claim_available claim_reset_at rolls_left rolls_reset_at")
+
+class QuotaTracker:
+    def __init__(self):
+        self.claim_available = None; self.claim_reset_at = None; self.claim_interval = None
+        self.rolls_left = None; self.rolls_reset_at = None; self.rolls_interval = None; self.rolls_per_reset = None
+        self.verified_at = None; self.last_roll_at = None
+        self.stale_reason = "startup" # Set whenever the next cycle must start with a $tu
+
+    def invalidate(self, reason):
+        self.stale_reason = reason
+
+    @staticmethod
+    def _learn_interval(interval, old_deadline, new_deadline):
+        # Consecutive reset deadlines differ by a multiple of the server's reset interval; keep the smallest seen
+        if old_deadline is None or new_deadline is None or boottime() < old_deadline: return interval
+        step = round((new_deadline - old_deadline) / 60) * 60
+        return step if step > 0 and (interval is None or step < interval) else interval
+
+    def observe_claim(self, available, minutes):
+        claim_reset_at = reset_minute_boottime(minutes) if minutes is not None else None
+        self.claim_interval = self._learn_interval(self.claim_interval, self.claim_reset_at, claim_reset_at)
+        self.claim_available = available; self.claim_reset_at = claim_reset_at
+        if claim_reset_at is None: self.invalidate("claim reset unknown")
+
+    def observe_rolls(self, rolls_left, minutes):
+        rolls_reset_at = reset_minute_boottime(minutes) if minutes else None
+        if self.rolls_reset_at is not None and boottime() >= self.rolls_reset_at and (self.last_roll_at is None or self.last_roll_at < self.rolls_reset_at):
+            self.rolls_per_reset = max(self.rolls_per_reset or 0, rolls_left) # No rolls since the reset: a full allowance
+        self.rolls_interval = self._learn_interval(self.rolls_interval, self.rolls_reset_at, rolls_reset_at)
+        self.rolls_left = rolls_left; self.rolls_reset_at = rolls_reset_at
+        self.verified_at = boottime()
+        self.stale_reason = None if rolls_reset_at is not None and self.claim_reset_at is not None else "reset time unknown"
+
+    def rolls_done(self, sent, received):
+        self.last_roll_at = boottime()
+        if self.rolls_left is not None: self.rolls_left = max(0, self.rolls_left - received)
+        if received != sent: self.invalidate(f"{received}/{sent} roll replies")
+
+    def claim_made(self):
+        # A click is not proof Mudae accepted the claim; have the next cycle confirm it with $tu
+        self.claim_available = False; self.invalidate("claim made")
+
+    def plan(self):
+        if self.stale_reason: return None
+        now = boottime()
+        if now - self.verified_at > QUOTA_MAX_AGE: self.invalidate("verification too old"); return None
+        while self.claim_reset_at <= now:
+            if not self.claim_interval: self.invalidate("claim interval not learned yet"); return None
+            self.claim_available = True; self.claim_reset_at += self.claim_interval
+        while self.rolls_reset_at <= now:
+            if not self.rolls_interval or not self.rolls_per_reset: self.invalidate("roll interval/allowance not learned yet"); return None
+            self.rolls_left = self.rolls_per_reset; self.rolls_reset_at += self.rolls_interval
+        return QuotaPlan(self.claim_available, self.claim_reset_at, self.rolls_left, self.rolls_reset_at)
+
+
+
+# Outbound queue: one lane per channel for everything the bot sends or clicks. The highest-priority waiter goes
+# next, as soon as the route's rate-limit bucket (as tracked by discord.py) has room; 429s widen the spacing.
+current_outbound = contextvars.ContextVar("current_outbound", default=None) # (queue, kind) of the send in flight
+
+def route_ratelimit(http, method, path, channel_id=None):
+    # The bucket HTTPClient.request uses for this route, or None until a response has carried rate-limit headers
+    buckets = getattr(http, "_buckets", None)
+    if not buckets: return None
+    route_key = f"{method} {path}"
+    return buckets.get(f"{http._bucket_hashes.get(route_key, route_key)}:{'' if channel_id is None else channel_id}")
+
+class OutboundQueue:
+    def __init__(self, client, channel_id, fallback_interval, log_function):
+        self.client = client; self.channel_id = channel_id; self.log_function = log_function
+        self.fallback_interval = fallback_interval # Roll spacing while the message bucket is still unknown
+        self.backoff = 0.0; self.busy = False; self.last_any = float("-inf"); self.last_sent = {}
+        self._waiters = []; self._seq = itertools.count(); self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set(); self._changed = asyncio.Event()
+
+    def pace(self, kind, loop):
+        # Seconds until a send of this kind fits: own spacing runs on boottime(), bucket expiry on the loop clock
+        _, method, path, per_channel = OUTBOUND_KINDS[kind]; now = boottime()
+        wait = self.last_any + self.backoff - now
+        bucket = route_ratelimit(getattr(self.client, "http", None), method, path, self.channel_id if per_channel else None)
+        if bucket is None:
+            if kind == "roll": wait = max(wait, self.last_sent.get(kind, float("-inf")) + self.fallback_interval - now)
+        elif bucket.remaining <= 0 and bucket.expires is not None: wait = max(wait, bucket.expires - loop.time())
+        return wait
+
+    def slow_down(self):
+        self.backoff = min(OUTBOUND_MAX_BACKOFF, max(self.backoff * 2, OUTBOUND_BACKOFF_MIN))
+
+    def rate_limited(self, kind, retry_after, route):
+        self.slow_down(); self.client.metrics.inc("rate_limited_total", kind=kind)
+        self.log_function(f"[{self.client.muda_name}] 429 on {kind} ({route}). Retry in {retry_after:.2f}s; spacing now {self.backoff:.2f}s", self.client.preset_name, "WARN")
+
+    async def submit(self, kind, action):
+        loop = asyncio.get_running_loop(); queued_at = loop.time()
+        entry = (OUTBOUND_KINDS[kind][0], next(self._seq), kind); heapq.heappush(self._waiters, entry); self._notify()
+        try:
+            while True:
+                changed = self._changed
+                if self.busy or self._waiters[0] is not entry: await changed.wait(); continue
+                wait = self.pace(kind, loop)
+                if wait <= 0: break
+                await asyncio.sleep(wait) # A higher-priority arrival may take the lane meanwhile
+        except BaseException:
+            self._waiters.remove(entry); heapq.heapify(self._waiters); self._notify(); raise
+        heapq.heappop(self._waiters); self.busy = True
+        self.client.metrics.observe("outbound_wait_seconds", loop.time() - queued_at, kind=kind)
+        token = current_outbound.set((self, kind))
+        try: result = await action()
+        except discord.errors.HTTPException as e:
+            if e.status == 429 or e.status >= 500: self.slow_down()
+            raise
+        finally:
+            current_outbound.reset(token); self.busy = False; self.last_any = self.last_sent[kind] = boottime(); self._notify()
+        self.backoff = max(0.0, self.backoff - OUTBOUND_BACKOFF_STEP)
+        return result
+
+class RateLimitReporter(logging.Handler):
+    # discord.py sleeps through 429s itself and only logs a warning; hand each one to the queue whose send hit it
+    def emit(self, record):
+        if not isinstance(record.msg, str) or not record.msg.startswith("We are being rate limited.") or len(record.args or ()) < 3: return
+        method, url, retry_after = record.args[:3]; route = f"{method} {url.split('/api/', 1)[-1]}"
+        owner = current_outbound.get()
+        if owner: owner[0].rate_limited(owner[1], retry_after, route)
+        else: print_log(f"[{BOT_NAME}] 429 on {route}. Retry in {retry_after:.2f}s", current_preset.get() or "System", "WARN")
+
+rate_limit_reporter = RateLimitReporter(logging.WARNING)
+
+
+# Claim arbiter: every path that wants to spend the claim right submits a candidate instead of clicking. The first
+# candidate opens a window of claim_window seconds; then the best one is claimed and the rest are dropped with a reason.
+# Mudae edits a roll once it is claimed (owner footer, buttons removed); on_raw_message_edit withdraws such candidates.
+CLAIMED_FOOTER_RE = re.compile(r"^\s*(?:belongs to|pertence a)\b", re.IGNORECASE)
+
+def edit_drop_reason(data, message):
+    # Why a roll edited by Mudae can no longer be claimed, or None; only fields present in the update are trusted
+    embed = message.embeds[0] if message.embeds else None
+    footer = (embed.footer.text or "") if embed is not None and "embeds" in data else ""
+    if CLAIMED_FOOTER_RE.match(footer): return f"claimed ({footer.strip()[:60]})"
+    if "components" in data and not any(getattr(getattr(btn, "emoji", None), "name", None) in CLAIM_EMOJI_SET for comp in message.components for btn in getattr(comp, "children", ())):
+        return "claim button removed"
+    return None
+
+CLAIM_SOURCES = ("wishlist", "series", "kakera", "roll") # Ranking, best first; "roll" is the post-roll min_kakera claim
+ClaimCandidate = collections.namedtuple("ClaimCandidate", "message record source fire_at future")
+
+class ClaimArbiter:
+    def __init__(self, client, window, claim, log_function):
+        self.client = client; self.window = window; self.claim = claim; self.log_function = log_function
+        self.candidates = []; self.drops = collections.deque(maxlen=100) # (time, character, source, reason) of recent drops
+        self.pending = {} # message id -> undecided candidates on that message
+        self.unclaimable = DedupCache(max_size=1000) # Messages an edit showed as claimed / without a claim button
+        self.clicking = None # Candidate whose click is in flight; the edit it causes must not withdraw it
+        self._lock = asyncio.Lock(); self._tasks = set()
+
+    def submit(self, message, record, source, delay=0):
+        # Future resolving to True if this candidate got the claim; it is not clicked before its own delay has passed
+        candidate = ClaimCandidate(message, record, source, boottime() + delay, asyncio.get_running_loop().create_future())
+        self.client.metrics.inc("claim_candidates_total", source=source)
+        if message.id in self.unclaimable: self._drop(candidate, "edited", "already claimed or buttons removed"); return candidate.future
+        self.candidates.append(candidate); self.pending.setdefault(message.id, []).append(candidate)
+        if len(self.candidates) == 1:
+            task = asyncio.ensure_future(self._arbitrate()); self._tasks.add(task); task.add_done_callback(self._tasks.discard)
+        return candidate.future
+
+    def withdraw(self, message_id, reason):
+        self.unclaimable.add(message_id)
+        for candidate in self.pending.pop(message_id, ()):
+            if candidate is not self.clicking and not candidate.future.done(): self._drop(candidate, "edited", reason)
+
+    def _drop(self, candidate, reason, detail):
+        name = candidate.record.char_name or "Unknown"
+        self.drops.append((time.time(), name, candidate.source, detail)); self.client.metrics.inc("claim_candidates_dropped_total", source=candidate.source, reason=reason)
+        self.log_function(f"[{self.client.muda_name}] Claim arbiter dropped {name} ({candidate.source}): {detail}", self.client.preset_name, "INFO")
+        candidate.future.set_result(False)
+
+    async def _arbitrate(self):
+        candidates = self.candidates # Keeps filling until the window closes
+        try:
+            await asyncio.sleep(self.window); self.candidates = []
+            candidates.sort(key=lambda c: (CLAIM_SOURCES.index(c.source), -c.record.kakera, c.fire_at))
+            async with self._lock: # The previous window may still be waiting out its winner's delay
+                winner = None
+                for candidate in candidates:
+                    quota = self.client.quota
+                    if candidate.future.done(): continue # Withdrawn by an edit
+                    if winner: self._drop(candidate, "outscored", f"lost to {winner.record.char_name} ({winner.source})"); continue
+                    if quota.claim_available is False and quota.claim_reset_at is not None and boottime() < quota.claim_reset_at:
+                        self._drop(candidate, "no_claim_right", "claim right already spent until reset"); continue
+                    if candidate.fire_at > boottime(): await asyncio.wait([candidate.future], timeout=candidate.fire_at - boottime())
+                    if candidate.future.done(): continue
+                    self.clicking = candidate
+                    try: claimed = await self.claim(candidate)
+                    finally: self.clicking = None
+                    if claimed: winner = candidate; candidate.future.set_result(True)
+                    else: self._drop(candidate, "claim_failed", "click failed")
+        finally:
+            if self.candidates is candidates: self.candidates = []
+            for candidate in candidates:
+                if not candidate.future.done(): candidate.future.set_result(False) # Not cancel(): the awaiting handler would see its own task cancelled
+                waiting = self.pending.get(candidate.message.id)
+                if waiting and candidate in waiting:
+                    waiting.remove(candidate)
+                    if not waiting: del self.pending[candidate.message.id]
+
+
+# Metrics registry: counters, gauges and histograms per preset, kept across bot restarts and exported
+# as Prometheus text on localhost and/or a periodic JSON snapshot.
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets); self.counts = [0] * (len(self.buckets) + 1); self.sum = 0.0; self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1; self.sum += value; self.count += 1
+
+    def cumulative(self):
+        total = 0; result = []
+        for bound, n in zip(self.buckets + (float("inf"),), self.counts): total += n; result.append((bound, total))
+        return result
+
+class MetricsRegistry:
+    def __init__(self, preset_name):
+        self.preset_name = preset_name; self.lock = threading.Lock()
+        self.counters = {}; self.gauges = {}; self.histograms = {} # (name, sorted label items) -> value
+        self.collectors = [] # callables returning {(name, labels): value} gauges, read at export time
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock: self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock: self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        hist = self.histogram(name, buckets, **labels)
+        with self.lock: hist.observe(value)
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS, **labels):
+        # Hot paths keep the returned Histogram and call observe on it under self.lock, skipping the key lookup
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None: hist = self.histograms[key] = Histogram(buckets)
+            return hist
+
+    def collected_gauges(self):
+        gauges = dict(self.gauges)
+        for collector in list(self.collectors):
+            try: gauges.update(collector())
+            except Exception: pass
+        return gauges
+
+    def snapshot(self):
+        def label_text(name, labels): return name + ("{" + ",".join(f"{k}={v}" for k, v in labels) + "}" if labels else "")
+        with self.lock:
+            counters = {label_text(*k): v for k, v in self.counters.items()}
+            histograms = {label_text(*k): {"count": h.count, "sum": round(h.sum, 4), "buckets": {("+Inf" if b == float("inf") else str(b)): n for b, n in h.cumulative()}}
+                          for k, h in self.histograms.items()}
+        gauges = {label_text(*k): v for k, v in self.collected_gauges().items()}
+        return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+metrics_registries = {}; metrics_registries_lock = threading.Lock()
+
+def get_metrics_registry(preset_name):
+    with metrics_registries_lock:
+        if preset_name not in metrics_registries: metrics_registries[preset_name] = MetricsRegistry(preset_name)
+        return metrics_registries[preset_name]
+
+def render_prometheus():
+    def fmt_labels(items): return "{" + ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in items) + "}"
+    families = {} # metric name -> (type, [lines])
+    with metrics_registries_lock: registries = list(metrics_registries.values())
+    for reg in registries:
+        base = (("preset", reg.preset_name),)
+        with reg.lock:
+            counters = list(reg.counters.items())
+            histograms = [(k, h.cumulative(), h.sum, h.count) for k, h in reg.histograms.items()]
+        for (name, labels), value in counters:
+            families.setdefault(f"mudae_{name}", ("counter", []))[1].append(f"mudae_{name}{fmt_labels(base + labels)} {value}")
+        for (name, labels), value in reg.collected_gauges().items():
+            families.setdefault(f"mudae_{name}", ("gauge", []))[1].append(f"mudae_{name}{fmt_labels(base + labels)} {value}")
+        for (name, labels), cumulative, total, count in histograms:
+            lines = families.setdefault(f"mudae_{name}", ("histogram", []))[1]
+            for bound, n in cumulative:
+                lines.append(f"mudae_{name}_bucket{fmt_labels(base + labels + (('le', '+Inf' if bound == float('inf') else bound),))} {n}")
+            lines.append(f"mudae_{name}_sum{fmt_labels(base + labels)} {total}"); lines.append(f"mudae_{name}_count{fmt_labels(base + labels)} {count}")
+    out = []
+    for name, (kind, lines) in sorted(families.items()): out.append(f"# TYPE {name} {kind}"); out.extend(lines)
+    return "\n".join(out) + "\n"
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/schedule": body = json.dumps(reset_scheduler.snapshot(), indent=2).encode("utf-8"); content_type = "application/json"
+        elif path == "/shards": body = json.dumps(shard_status_snapshot(), indent=2).encode("utf-8"); content_type = "application/json"
+        elif path in ("/", "/metrics"): body = render_prometheus().encode("utf-8"); content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else: self.send_error(404); return
+        self.send_response(200); self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body))); self.end_headers(); self.wfile.write(body)
+
+    def log_message(self, format, *args): pass
+
+def write_metrics_snapshots(path, interval):
+    while True:
+        time.sleep(interval)
+        with metrics_registries_lock: registries = list(metrics_registries.values())
+        snapshot = {"generated_at": datetime.datetime.now().isoformat(timespec="seconds"), "presets": {r.preset_name: r.snapshot() for r in registries}}
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as f: json.dump(snapshot, f, indent=2)
+            os.replace(path + ".tmp", path)
+        except Exception as e: print_log(f"[{BOT_NAME}] Metrics snapshot write failed: {e}", "System", "ERROR")
+
+def start_metrics_exporters(http_port=None, json_path=None):
+    http_port = METRICS_HTTP_PORT if http_port is None else http_port
+    json_path = METRICS_JSON_PATH if json_path is None else json_path
+    if http_port:
+        try:
+            server = http.server.ThreadingHTTPServer(("127.0.0.1", http_port), MetricsRequestHandler)
+            threading.Thread(target=server.serve_forever, name="mudae-metrics-http", daemon=True).start()
+            print_log(f"[{BOT_NAME}] Metrics: http://127.0.0.1:{http_port}/metrics", "System", "INFO")
+        except OSError as e: print_log(f"[{BOT_NAME}] Metrics endpoint failed on port {http_port}: {e}", "System", "ERROR")
+    if json_path:
+        threading.Thread(target=write_metrics_snapshots, args=(json_path, METRICS_JSON_INTERVAL), name="mudae-metrics-json", daemon=True).start()
+
+
+# Loop watchdog and sampling profiler. One thread per process watches the heartbeat of every bot loop
+# and, while a profile runs, samples those loops' stacks; nothing runs on the loops themselves except the heartbeat.
+class LoopProbe:
+    def __init__(self, loop, thread):
+        self.loop = loop; self.thread_id = thread.ident; self.thread_name = thread.name
+        self.registries = {} # preset name -> MetricsRegistry of each preset running on this loop
+        self.heartbeat = time.monotonic(); self.stalled_since = None
+        self.reset_samples()
+
+    def reset_samples(self):
+        self.samples = 0; self.idle_samples = 0; self.self_counts = collections.Counter(); self.cum_counts = collections.Counter()
+
+    def preset_label(self):
+        return ", ".join(sorted(self.registries)) or "no presets"
+
+    def sample(self, frame):
+        self.samples += 1
+        if frame.f_code.co_name in ("select", "poll", "control") and frame.f_code.co_filename.endswith("selectors.py"): self.idle_samples += 1; return
+        self.self_counts[(frame.f_code.co_filename, frame.f_code.co_firstlineno, frame.f_code.co_name)] += 1; seen = set()
+        while frame is not None:
+            key = (frame.f_code.co_filename, frame.f_code.co_firstlineno, frame.f_code.co_name)
+            if key not in seen: seen.add(key); self.cum_counts[key] += 1
+            frame = frame.f_back
+
+def loop_heartbeat(probe, interval, scheduled):
+    # A plain call_later chain rather than a task: it costs one timer callback per interval and owns no coroutine
+    now = time.monotonic(); lag = max(0.0, now - scheduled - interval); probe.heartbeat = now
+    for registry in list(probe.registries.values()): registry.observe("loop_lag_seconds", lag, HANDLER_BUCKETS)
+    if probe.stalled_since is not None:
+        print_log(f"[{BOT_NAME}] Event loop of {probe.preset_label()} resumed after {now - probe.stalled_since:.2f}s", probe.preset_label(), "RESET")
+        probe.stalled_since = None
+    probe.loop.call_later(interval, loop_heartbeat, probe, interval, now)
+
+class LoopWatchdog:
+    def __init__(self, interval=LOOP_HEARTBEAT_INTERVAL, threshold=LOOP_LAG_THRESHOLD):
+        self.interval = interval; self.threshold = threshold
+        self.probes = {}; self.lock = threading.Lock(); self.thread = None # loop -> LoopProbe
+        self.profile_requested = None; self.profile_started = None; self.profile_until = None
+        self.trigger_mtime = None
+
+    def watch(self, client):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            probe = self.probes.get(loop); new = probe is None
+            if new: probe = self.probes[loop] = LoopProbe(loop, threading.current_thread())
+            probe.registries[client.preset_name] = client.metrics
+            if self.thread is None:
+                self.trigger_mtime = self._trigger_mtime() # A trigger file left from an earlier run does not start a profile
+                self.thread = threading.Thread(target=self._run, name="mudae-loop-watchdog", daemon=True); self.thread.start()
+        if new: loop.call_later(self.interval, loop_heartbeat, probe, self.interval, time.monotonic())
+
+    def request_profile(self, duration=None):
+        # Safe from a signal handler: only sets a flag that the watchdog thread picks up
+        self.profile_requested = duration or PROFILE_DURATION
+
+    def _trigger_mtime(self):
+        try: return os.path.getmtime(PROFILE_TRIGGER_FILE)
+        except OSError: return None
+
+    def _check_trigger(self):
+        mtime = self._trigger_mtime()
+        if mtime is None or mtime == self.trigger_mtime: return
+        self.trigger_mtime = mtime
+        try:
+            with open(PROFILE_TRIGGER_FILE, "r", encoding="utf-8") as f: duration = float(f.read().strip() or 0)
+        except (OSError, ValueError): duration = 0
+        self.request_profile(duration)
+
+    def _run(self):
+        next_trigger_check = 0
+        while True:
+            time.sleep(PROFILE_SAMPLE_INTERVAL if self.profile_until is not None else self.interval / 2)
+            now = time.monotonic()
+            with self.lock:
+                for loop in [loop for loop in self.probes if loop.is_closed()]: del self.probes[loop]
+                probes = list(self.probes.values())
+            if self.profile_requested and self.profile_until is None: self._start_profile(probes, now)
+            stalled = [p for p in probes if p.stalled_since is None and now - p.heartbeat > self.interval + self.threshold and p.loop.is_running()]
+            frames = sys._current_frames() if stalled or self.profile_until is not None else {}
+            if self.profile_until is not None:
+                for probe in probes:
+                    if probe.thread_id in frames: probe.sample(frames[probe.thread_id])
+                if now >= self.profile_until: self._write_profile(probes, now)
+            for probe in stalled: self._report_stall(probe, frames.get(probe.thread_id), now)
+            if now >= next_trigger_check: next_trigger_check = now + 1; self._check_trigger()
+
+    def _report_stall(self, probe, frame, now):
+        probe.stalled_since = probe.heartbeat + self.interval # When the late heartbeat was due
+        for registry in list(probe.registries.values()): registry.inc("loop_stalls_total")
+        stack = "".join(traceback.format_stack(frame, limit=STALL_STACK_DEPTH)).rstrip() if frame is not None else "  (stack unavailable)"
+        print_log(f"[{BOT_NAME}] Event loop of {probe.preset_label()} blocked for {now - probe.stalled_since:.2f}s, currently in:\n{stack}", probe.preset_label(), "ERROR")
+
+    def _start_profile(self, probes, now):
+        duration = self.profile_requested; self.profile_requested = None
+        for probe in probes: probe.reset_samples()
+        self.profile_started = now; self.profile_until = now + duration
+        print_log(f"[{BOT_NAME}] Profiling {len(probes)} event loop(s) for {duration:g}s...", "System", "CHECK")
+
+    def _write_profile(self, probes, now):
+        lines = [f"Sampling profile, pid {os.getpid()}, {now - self.profile_started:.1f}s at {PROFILE_SAMPLE_INTERVAL * 1000:g} ms intervals",
+                 "Counts are samples: self = innermost frame, cum = anywhere on the stack. Idle samples (loop waiting for I/O) are left out.", ""]
+        for probe in probes:
+            busy = probe.samples - probe.idle_samples
+            lines.append(f"Loop thread {probe.thread_name} ({probe.preset_label()}): {probe.samples} samples, {busy} busy ({busy / max(1, probe.samples):.1%})")
+            lines.append(f"{'self':>8} {'self%':>7} {'cum':>8} {'cum%':>7}  filename:lineno(function)")
+            for key, count in probe.self_counts.most_common(PROFILE_TOP):
+                filename, lineno, name = key; cum = probe.cum_counts[key]
+                lines.append(f"{count:>8} {count / max(1, busy):>7.1%} {cum:>8} {cum / max(1, busy):>7.1%}  {os.path.basename(filename)}:{lineno}({name})")
+            lines.append("")
+        self.profile_until = None
+        path = os.path.join(PROFILE_DIR, f"profile-{os.getpid()}-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.txt")
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f: f.write("\n".join(lines))
+            print_log(f"[{BOT_NAME}] Profile written to {path}", "System", "CHECK")
+        except OSError as e: print_log(f"[{BOT_NAME}] Profile write failed: {e}", "System", "ERROR")
 
+loop_watchdog = LoopWatchdog()
 
-def print_log(message, preset_name, log_type="INFO"):
-    log_message_formatted = color_log(message, preset_name, log_type)
-    write_log_to_file(log_message_formatted)
+def request_profile(signum=None, frame=None):
+    loop_watchdog.request_profile()
+
+def install_profile_signal():
+    if hasattr(signal, "SIGUSR1"): signal.signal(signal.SIGUSR1, request_profile) # Not available on Windows; use PROFILE_TRIGGER_FILE there
 
+@types.coroutine
+def run_timed(coro, on_done):
+    # Drives coro step by step so the time it holds the loop (busy) is measured apart from the time it awaits
+    started = time.perf_counter(); busy = longest = 0.0; value = error = None
+    try:
+        while True:
+            step_started = time.perf_counter()
+            try: yielded = coro.throw(error) if error is not None else coro.send(value)
+            except StopIteration as stop: return stop.value
+            finally: step = time.perf_counter() - step_started; busy += step; longest = max(longest, step)
+            value = error = None
+            try: value = yield yielded
+            except BaseException as e: error = e
+    finally: on_done(time.perf_counter() - started, busy, longest)
 
-def run_bot(token, prefix, target_channel_id, roll_command, min_kakera, delay_seconds, mudae_prefix,
+
+def create_bot(token, prefix, target_channel_id, roll_command, min_kakera, delay_seconds, mudae_prefix,
             log_function, preset_name, key_mode, start_delay, snipe_mode, snipe_delay,
             snipe_ignore_min_kakera_reset, wishlist,
             series_snipe_mode, series_snipe_delay, series_wishlist, roll_speed,
             kakera_snipe_mode_preset, kakera_snipe_threshold_preset,
             enable_reactive_self_snipe_preset, rolling_enabled,
-            kakera_reaction_snipe_mode_preset, kakera_reaction_snipe_delay_preset):
+            kakera_reaction_snipe_mode_preset, kakera_reaction_snipe_delay_preset,
+            wishlist_fold_accents=False, persist_state=True, claim_window=0.5, record_rolls=True, lean=False, watch_channels=None):
 
-    client = commands.Bot(command_prefix=prefix, chunk_guilds_at_startup=False, self_bot=True)
+    # lean: no message cache (on_message never reads it back), no member cache beyond the account itself and no guild
+    # subscriptions (member lists, presences, threads); on_ready subscribes to the target channel's guild only
+    cache_options = dict(max_messages=None, member_cache_flags=discord.MemberCacheFlags.none(), guild_subscriptions=False) if lean else {}
+    client = commands.Bot(command_prefix=prefix, chunk_guilds_at_startup=False, self_bot=True, **cache_options)
 
     discord_logger = logging.getLogger('discord')
     discord_logger.propagate = False
     handlers = [h for h in discord_logger.handlers if isinstance(h, logging.StreamHandler)]
     for h in handlers: discord_logger.removeHandler(h)
+    http_logger = logging.getLogger('discord.http')
+    if rate_limit_reporter not in http_logger.handlers: http_logger.addHandler(rate_limit_reporter)
 
     client.preset_name = preset_name; client.min_kakera = min_kakera
     client.snipe_mode = snipe_mode; client.snipe_delay = snipe_delay
@@ -89,13 +1263,12 @@ def run_bot(token, prefix, target_channel_id, roll_command, min_kakera, delay_se
     client.wishlist = [w.lower() for w in wishlist]
     client.series_snipe_mode = series_snipe_mode; client.series_snipe_delay = series_snipe_delay
     client.series_wishlist = [sw.lower() for sw in series_wishlist]
+    client.wishlist_index = WishlistIndex(wishlist, series_wishlist, wishlist_fold_accents)
     client.muda_name = BOT_NAME; client.claim_right_available = False
     client.target_channel_id = target_channel_id; client.roll_speed = roll_speed
-    client.mudae_prefix = mudae_prefix; client.key_mode = key_mode
+    client.mudae_prefix = mudae_prefix; client.key_mode = key_mode; client.roll_command = roll_command
     client.delay_seconds = delay_seconds
-    client.sniped_messages = set(); client.snipe_happened = False
-    client.series_sniped_messages = set(); client.series_snipe_happened = False
-    client.kakera_value_sniped_messages = set()
+    client.snipe_happened = False; client.series_snipe_happened = False
     client.is_actively_rolling = False; client.interrupt_rolling = False
     client.current_min_kakera_for_roll_claim = client.min_kakera
     client.kakera_snipe_mode_active = kakera_snipe_mode_preset
@@ -105,11 +1278,98 @@ def run_bot(token, prefix, target_channel_id, roll_command, min_kakera, delay_se
 
     client.kakera_reaction_snipe_mode_active = kakera_reaction_snipe_mode_preset
     client.kakera_reaction_snipe_delay_value = kakera_reaction_snipe_delay_preset
-    client.kakera_reaction_sniped_messages = set()
-
+    # channel id -> ChannelState for every watched channel; on_message routes on it, target_channel_id is where the bot rolls
+    client.channel_states = {channel_id: ChannelState(channel_id, overrides).configure(client) for channel_id, overrides in (watch_channels or [(target_channel_id, {})])}
+    client.response_waiter = ResponseWaiter()
+    client.roll_session = None
+    client.roll_state = None; client.roll_state_since = None; client.roll_state_context = {}
+    client.roll_state_history = collections.deque(maxlen=50) # (time, state) of recent transitions
+    client.quota = QuotaTracker()
+    client.outbound_queues = {} # channel id -> OutboundQueue
+    client.restart_requested = False # Set by the presets.json watcher when the preset must log in again
+    client.created_at = time.monotonic(); client.first_ready_at = None
+    client.claim_arbiter = ClaimArbiter(client, claim_window, lambda c: claim_character(client, c.message.channel, c.message, record=c.record), log_function)
+    client.state_store = get_state_store(preset_name) if persist_state else None
+    client.lean = lean
+    client.record_rolls = record_rolls; client.last_roll_command = {} # channel id -> (monotonic time, user id, user name) of the last roll command
+    client.metrics = get_metrics_registry(preset_name)
+    client.metrics.collectors = [lambda: {(f"dedup_{stat}", (("cache", kind), ("channel", channel_id))): value for (kind, channel_id), stats in dedup_stats(client).items() for stat, value in stats.items()},
+                                 lambda: {("roll_state", (("state", state),)): int(client.roll_state == state) for state in ROLL_STATES},
+                                 lambda: {("outbound_backoff_seconds", (("channel", channel_id),)): q.backoff for channel_id, q in client.outbound_queues.items()}]
+    running_clients[preset_name] = client
+    if client.state_store:
+        for kind, message_ids in client.state_store.load_handled(DEDUP_TTL).items():
+            if kind not in HANDLED_MESSAGE_KINDS: continue
+            for state in client.channel_states.values(): getattr(state, kind).update(message_ids) # Message IDs are unique across channels
+
+    def save_status(**fields):
+        if client.state_store: client.state_store.save_status(**fields)
+
+    def mark_handled(state, kind, message_id):
+        getattr(state, kind).add(message_id)
+        if client.state_store: client.state_store.add_handled(kind, message_id)
+
+    def record_roll(message, record, own_roll=False):
+        if not client.record_rolls or not ROLL_HISTORY_PATH or not record.char_name: return
+        if own_roll and client.user: roller = (client.user.id, client.user.name)
+        else:
+            user = getattr(getattr(message, "interaction", None), "user", None) # Slash-command rolls name their roller
+            last = client.last_roll_command.get(message.channel.id)
+            if user is not None: roller = (user.id, user.name)
+            elif last and time.monotonic() - last[0] <= ROLLER_MATCH_WINDOW: roller = last[1:] # Prefix rolls: the latest roll command in the channel
+            else: roller = None
+        roll_history.record(message, record, preset_name, roller, own_roll)
+
+    def outbound(channel):
+        if channel.id not in client.outbound_queues: client.outbound_queues[channel.id] = OutboundQueue(client, channel.id, client.roll_speed, log_function)
+        return client.outbound_queues[channel.id]
+
+    def timed_handler(name):
+        # Per-call wall time and loop-busy time; one step holding the loop past LOOP_LAG_THRESHOLD is logged
+        wall_hist = client.metrics.histogram("handler_seconds", HANDLER_BUCKETS, handler=name)
+        busy_hist = client.metrics.histogram("handler_busy_seconds", HANDLER_BUCKETS, handler=name)
+        def record(wall, busy, longest):
+            with client.metrics.lock: wall_hist.observe(wall); busy_hist.observe(busy)
+            if longest > LOOP_LAG_THRESHOLD:
+                client.metrics.inc("slow_handler_steps_total", handler=name)
+                log_function(f"[{client.muda_name}] {name} held the event loop for {longest:.2f}s in one step (busy {busy:.2f}s of {wall:.2f}s)", preset_name, "ERROR")
+        def decorate(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs): return await run_timed(func(*args, **kwargs), record)
+            return wrapper
+        return decorate
+
+    async def subscribe_guild(guild):
+        # lean: typing only, the least Discord accepts; large guilds deliver no messages to unsubscribed sessions
+        if not client.lean or guild.id in client.subscribed_guilds: return
+        try: await guild.subscribe(typing=True, activities=False, threads=False, member_updates=False); client.subscribed_guilds.add(guild.id)
+        except Exception as e: log_function(f"[{client.muda_name}] Warn: Guild subscribe failed ({e}); messages from large servers may be missed", preset_name, "ERROR")
+
+    async def watch_channel(channel_id):
+        # Checks a watched channel other than the rolling one (at ready, or when a reload adds it); a failed check unwatches it
+        state = client.channel_states.get(channel_id)
+        if state is None: return None
+        watched = client.get_channel(channel_id)
+        if not isinstance(watched, discord.TextChannel):
+            log_function(f"[{client.muda_name}] Warn: No text channel {channel_id}; it is not watched", preset_name, "ERROR"); client.channel_states.pop(channel_id, None); return None
+        permissions = watched.permissions_for(watched.guild.me)
+        if not permissions.read_message_history:
+            log_function(f"[{client.muda_name}] Warn: No history perm in {watched.name}; it is not watched", preset_name, "ERROR"); client.channel_states.pop(channel_id, None); return None
+        if not permissions.add_reactions: log_function(f"[{client.muda_name}] Warn: No reaction perm in {watched.name}", preset_name, "ERROR")
+        await subscribe_guild(watched.guild)
+        overrides = ", ".join(f"{key}={value}" for key, value in state.overrides.items()) or "preset settings"
+        log_function(f"[{client.muda_name}] Also watching: {watched.name} ({channel_id}, {overrides})", preset_name, "INFO")
+        return watched
+
+    client.watch_channel = watch_channel; client.subscribed_guilds = set()
 
     @client.event
     async def on_ready():
+        loop_watchdog.watch(client)
+        if client.first_ready_at is None:
+            client.first_ready_at = time.monotonic(); since_start = client.first_ready_at - process_started_at; login = client.first_ready_at - client.created_at
+            client.metrics.set_gauge("time_to_first_ready_seconds", round(since_start, 3)); client.metrics.set_gauge("login_seconds", round(login, 3))
+            log_function(f"[{client.muda_name}] Ready {since_start:.2f}s after process start (login {login:.2f}s)", preset_name, "INFO")
         log_function(f"[{client.muda_name}] Bot ready: {client.user}", preset_name, "INFO")
         log_function(f"[{client.muda_name}] Target Channel: {target_channel_id}", preset_name, "INFO")
         log_function(f"[{client.muda_name}] Rolling Enabled: {'On' if client.rolling_enabled else 'Off (SNIPE-ONLY MODE)'}", preset_name, "INFO")
@@ -138,6 +1398,7 @@ def run_bot(token, prefix, target_channel_id, roll_command, min_kakera, delay_se
         log_function(f"[{client.muda_name}] Ext. Kakera Reaction Snipe: {'On' if client.kakera_reaction_snipe_mode_active else 'Off'}", preset_name, "INFO")
         if client.kakera_reaction_snipe_mode_active:
             log_function(f"[{client.muda_name}]   Ext. Kakera React. Snipe Delay: {client.kakera_reaction_snipe_delay_value}s", preset_name, "INFO")
+        log_function(f"[{client.muda_name}] Claim Window: {claim_window}s (candidates collected before one is claimed)", preset_name, "INFO")
 
         if client.rolling_enabled:
             log_function(f"[{client.muda_name}] Reactive Self-Roll Snipe: {'On' if client.enable_reactive_self_snipe else 'Off'}", preset_name, "INFO")
@@ -157,6 +1418,12 @@ def run_bot(token, prefix, target_channel_id, roll_command, min_kakera, delay_se
 
         if not can_read_history: log_function(f"[{client.muda_name}] Err: No history perm in {channel.name}", preset_name, "ERROR"); await client.close(); return
         if not can_react: log_function(f"[{client.muda_name}] Warn: No reaction perm in {channel.name}", preset_name, "ERROR")
+        client.subscribed_guilds = set() # A new session starts without subscriptions
+        await subscribe_guild(channel.guild)
+        for channel_id in [c for c in client.channel_states if c != target_channel_id]: await watch_channel(channel_id)
+        guilds = {client.get_channel(channel_id).guild.id for channel_id in client.channel_states}
+        if len(guilds) > 1: log_function(f"[{client.muda_name}] Warn: Watched channels span {len(guilds)} servers; snipes in all of them share the claim right $tu reports in {channel.name}", preset_name, "ERROR")
+        if client.lean: log_function(f"[{client.muda_name}] Lean mode: caches limited to {len(client.channel_states)} watched channel(s)", preset_name, "INFO")
 
         if client.rolling_enabled:
             if not can_send: log_function(f"[{client.muda_name}] Err: No send perm in {channel.name} (Rolling Enabled)", preset_name, "ERROR"); await client.close(); return
@@ -169,50 +1436,106 @@ def run_bot(token, prefix, target_channel_id, roll_command, min_kakera, delay_se
 
         if client.rolling_enabled:
             try:
+                saved = client.state_store.load_status() if client.state_store else {}
+                resume_phase = plan_resume(saved, client.key_mode)
+                if resume_phase:
+                    log_function(f"[{client.muda_name}] Resuming from saved state ({resume_phase}). Skipping initial commands and $tu.", preset_name, "INFO")
+                    await run_roll_lifecycle(client, channel, *resume_from_state(client, saved, resume_phase)); return
                 log_function(f"[{client.muda_name}] Initial commands (rolling enabled)...", preset_name, "INFO")
-                await channel.send(f"{client.mudae_prefix}limroul 1 1 1 1"); await asyncio.sleep(1.0)
-                await channel.send(f"{client.mudae_prefix}dk"); await asyncio.sleep(1.0)
-                await channel.send(f"{client.mudae_prefix}daily"); await asyncio.sleep(1.0)
-                await check_status(client, channel, client.mudae_prefix)
+                await outbound(channel).submit("command", lambda: channel.send(f"{client.mudae_prefix}limroul 1 1 1 1")); await asyncio.sleep(1.0)
+                await outbound(channel).submit("command", lambda: channel.send(f"{client.mudae_prefix}dk")); await asyncio.sleep(1.0)
+                await outbound(channel).submit("command", lambda: channel.send(f"{client.mudae_prefix}daily")); await asyncio.sleep(1.0)
+                await run_roll_lifecycle(client, channel)
             except discord.errors.Forbidden as e: log_function(f"[{client.muda_name}] Err: Forbidden in setup (rolling) {e}", preset_name, "ERROR"); await client.close()
             except Exception as e: log_function(f"[{client.muda_name}] Err: Unexpected in setup (rolling) {e}", preset_name, "ERROR"); await client.close()
         else:
             log_function(f"[{client.muda_name}] Snipe-Only Mode active. No initial commands will be sent. No status checks performed. Listening for snipes...", preset_name, "INFO")
 
 
+    def resume_from_state(client, saved, phase):
+        # Maps a plan_resume phase to the lifecycle state (and its context) to start in
+        now = time.time(); client.claim_right_available = bool(saved.get("claim_right_available"))
+        if phase == "wait_claim": return "wait_claim_reset", {"reset_at": boottime() + saved["claim_reset_at"] - now}
+        if phase == "wait_rolls": return "wait_roll_reset", {"reset_at": boottime() + saved["rolls_reset_at"] - now}
+        claim_reset_at = saved.get("claim_reset_at")
+        reset_soon = claim_reset_at is not None and claim_reset_at - now <= 3600
+        if client.claim_right_available and reset_soon and client.snipe_ignore_min_kakera_reset: client.current_min_kakera_for_roll_claim = 0
+        else: client.current_min_kakera_for_roll_claim = client.min_kakera
+        return "rolling", dict(rolls_left=saved["rolls_left"], ignore_limit_for_post_roll=client.current_min_kakera_for_roll_claim == 0,
+                               key_mode_only_kakera_for_post_roll=client.key_mode and not client.claim_right_available)
+
+
+    def set_roll_state(state, context):
+        client.roll_state = state; client.roll_state_since = time.time(); client.roll_state_context = context
+        client.roll_state_history.append((client.roll_state_since, state)); client.metrics.inc("state_transitions_total", state=state)
+
+    async def run_roll_lifecycle(client, channel, state="checking", context=None):
+        # Flat driver for the rolling lifecycle: each handler returns the next (state, context) instead of
+        # awaiting the next step itself, so the task's stack stays the same depth however long it runs.
+        # Handlers returning None go back to "checking".
+        handlers = {
+            "checking": lambda ctx: plan_from_quota(client, channel),
+            "rolling": lambda ctx: start_roll_commands(client, channel, **ctx),
+            "collecting": lambda ctx: collect_roll_results(client, channel, **ctx),
+            "wait_claim_reset": lambda ctx: wait_for_reset(ctx.get("minutes"), client.delay_seconds, log_function, preset_name, ctx.get("reset_at")),
+            "wait_roll_reset": lambda ctx: wait_for_rolls_reset(ctx.get("minutes"), client.delay_seconds, log_function, preset_name, ctx.get("reset_at")),
+        }
+        context = context or {}
+        try:
+            while True:
+                set_roll_state(state, context)
+                state, context = await handlers[state](context) or ("checking", {})
+        finally: client.roll_state = None; client.roll_state_context = {}; client.roll_session = None
+
+
+    async def plan_from_quota(client, channel):
+        # Mirrors check_status's decisions from the quota model; only a low-confidence model costs a $tu
+        plan = client.quota.plan()
+        if plan is None:
+            log_function(f"[{client.muda_name}] Quota model unsure ({client.quota.stale_reason}). Checking $tu.", preset_name, "CHECK")
+            return await check_status(client, channel, client.mudae_prefix)
+        client.metrics.inc("tu_skipped_total"); now = boottime()
+        claim_minutes = (plan.claim_reset_at - now) / 60; rolls_minutes = (plan.rolls_reset_at - now) / 60
+        log_function(f"[{client.muda_name}] Quota model: Claim: {'Yes' if plan.claim_available else 'No'} (reset ~{claim_minutes:.0f}m), Rolls left: {plan.rolls_left} (reset ~{rolls_minutes:.0f}m). Skip $tu.", preset_name, "CHECK")
+        client.claim_right_available = plan.claim_available
+        if plan.claim_available and claim_minutes <= 60 and client.snipe_ignore_min_kakera_reset: client.current_min_kakera_for_roll_claim = 0
+        else: client.current_min_kakera_for_roll_claim = client.min_kakera
+        if not plan.claim_available and not client.key_mode: return "wait_claim_reset", {"reset_at": plan.claim_reset_at}
+        if plan.rolls_left == 0: return "wait_roll_reset", {"reset_at": plan.rolls_reset_at}
+        return "rolling", dict(rolls_left=plan.rolls_left, ignore_limit_for_post_roll=client.current_min_kakera_for_roll_claim == 0,
+                               key_mode_only_kakera_for_post_roll=client.key_mode and not client.claim_right_available)
+
+
+    @timed_handler("check_status")
     async def check_status(client, channel, mudae_prefix):
         log_function(f"[{client.muda_name}] Checking $tu (rolling enabled)...", client.preset_name, "CHECK")
         error_count = 0; max_retries = 5
-        tu_message_content = None
+        tu_status = None
+
+        def is_tu_reply(msg):
+            return msg.author.id == TARGET_BOT_ID and bool(msg.content) and match_tu_response(msg.content, client.user.name) is not None
 
         while True:
-            await channel.send(f"{mudae_prefix}tu"); await asyncio.sleep(2.5)
-            tu_message_content = None
-            async for msg in channel.history(limit=10):
-                if msg.author.id == TARGET_BOT_ID and msg.content:
-                    content_lower_check = msg.content.lower()
-
-                    # MODIFIED: Using robust regex to check for singular or plural "roll(s)"
-                    roll_check_en = re.search(r"\brolls?\s+left\b", content_lower_check)
-                    claim_check_en = ("you __can__ claim" in content_lower_check or "can't claim for another" in content_lower_check)
-                    is_tu_message_en = roll_check_en and claim_check_en
-
-                    roll_check_pt = re.search(r"\brolls?\s+restantes\b", content_lower_check)
-                    claim_check_pt = ("você __pode__ se casar agora mesmo!" in content_lower_check or "calma aí, falta um tempo antes que você possa se casar novamente" in content_lower_check)
-                    is_tu_message_pt = roll_check_pt and claim_check_pt
-
-                    if is_tu_message_en or is_tu_message_pt:
-                        tu_message_content = msg.content
-                        log_function(f"[{client.muda_name}] Found $tu response.", preset_name, "INFO")
-                        break
-                    
-                    # MODIFIED: Also using the regex in the fallback check for consistency
-                    elif client.user.name.lower() in content_lower_check.splitlines()[0].lower() and (roll_check_en or roll_check_pt):
-                        tu_message_content = msg.content
-                        log_function(f"[{client.muda_name}] Found $tu response (user name match).", preset_name, "INFO")
-                        break
-
-            if not tu_message_content:
+            tu_status = None
+            tu_future = client.response_waiter.expect(channel.id, is_tu_reply)
+            try:
+                tu_sent_at = time.monotonic()
+                await outbound(channel).submit("command", lambda: channel.send(f"{mudae_prefix}tu")); client.metrics.inc("commands_sent_total", command="tu")
+                tu_reply = await client.response_waiter.wait(channel.id, tu_future, TU_RESPONSE_TIMEOUT)
+                if tu_reply is not None: client.metrics.observe("tu_rtt_seconds", time.monotonic() - tu_sent_at)
+            finally: client.response_waiter.discard(channel.id, tu_future)
+            if tu_reply is None:
+                # Reply not seen on the gateway in time (e.g. reconnect); fall back to one history scan.
+                log_function(f"[{client.muda_name}] No $tu reply within {TU_RESPONSE_TIMEOUT}s. Checking history.", preset_name, "CHECK")
+                client.metrics.inc("rest_fallbacks_total", kind="tu_history")
+                async for msg in channel.history(limit=10):
+                    if is_tu_reply(msg): tu_reply = msg; break
+            if tu_reply is not None:
+                tu_status = parse_tu(tu_reply.content)
+                if match_tu_response(tu_reply.content, client.user.name, tu_status) == "name": log_function(f"[{client.muda_name}] Found $tu response (user name match).", preset_name, "INFO")
+                else: log_function(f"[{client.muda_name}] Found $tu response.", preset_name, "INFO")
+
+            if not tu_status:
                 error_count += 1; log_function(f"[{client.muda_name}] Err $tu ({error_count}/{max_retries}): Response not found/identified.", preset_name, "ERROR")
                 if error_count >= max_retries: log_function(f"[{client.muda_name}] Max $tu retries. Wait 30m.", preset_name, "ERROR"); await asyncio.sleep(1800); error_count = 0
                 else: log_function(f"[{client.muda_name}] Retry $tu in 7s.", preset_name, "ERROR"); await asyncio.sleep(7)
@@ -220,117 +1543,69 @@ def run_bot(token, prefix, target_channel_id, roll_command, min_kakera, delay_se
             else:
                 break
 
-        content_lower = tu_message_content.lower()
         claim_reset_proceed = False
-        lang_log_suffix = ""
-
-        match_can_claim_en = re.search(r"you __can__ claim.*?next claim reset .*?\*\*(\d+h)?\s*(\d+)\*\* min\.?", content_lower)
-        match_can_claim_pt = re.search(r"você __pode__ se casar agora mesmo!.*?a próxima reinicialização é em .*?\*\*(\d+h)?\s*(\d+)\*\* min\.?", content_lower)
-        match_cant_claim_en = re.search(r"can't claim for another \*\*(\d+h)?\s*(\d+)\*\* min\.?", content_lower)
-        match_cant_claim_pt = re.search(r"calma aí, falta um tempo antes que você possa se casar novamente \*\*(\d+h)?\s*(\d+)\*\* min\.?", content_lower)
-
-        match_c = None; match_c_wait = None
-
-        if match_can_claim_en: client.claim_right_available = True; match_c = match_can_claim_en; lang_log_suffix = " (EN)"
-        elif match_can_claim_pt: client.claim_right_available = True; match_c = match_can_claim_pt; lang_log_suffix = " (PT)"
-        elif match_cant_claim_en: client.claim_right_available = False; match_c_wait = match_cant_claim_en; lang_log_suffix = " (EN)"
-        elif match_cant_claim_pt: client.claim_right_available = False; match_c_wait = match_cant_claim_pt; lang_log_suffix = " (PT)"
+        lang_log_suffix = f" ({tu_status.lang.upper()})" if tu_status.lang else ""
+        reset_minutes = tu_status.claim_reset
 
-        if match_c:
-            h_s = match_c.group(1); h = int(h_s[:-1]) if h_s else 0; m = int(match_c.group(2))
+        if tu_status.claim_available and reset_minutes is not None:
+            client.claim_right_available = True; h, m = divmod(reset_minutes, 60)
             log_function(f"[{client.muda_name}] Claim: Yes. Reset: {h}h {m}m.{lang_log_suffix}", preset_name, "INFO")
-            if (h * 60 + m) * 60 <= 3600 and client.snipe_ignore_min_kakera_reset: client.current_min_kakera_for_roll_claim = 0
+            save_status(claim_right_available=True, claim_reset_at=reset_deadline(reset_minutes)); client.quota.observe_claim(True, reset_minutes)
+            if reset_minutes * 60 <= 3600 and client.snipe_ignore_min_kakera_reset: client.current_min_kakera_for_roll_claim = 0
             else: client.current_min_kakera_for_roll_claim = client.min_kakera
             claim_reset_proceed = True
-        elif match_c_wait:
-            h_s = match_c_wait.group(1); h = int(h_s[:-1]) if h_s else 0; m = int(match_c_wait.group(2))
+        elif tu_status.claim_available is False and reset_minutes is not None:
+            client.claim_right_available = False; h, m = divmod(reset_minutes, 60)
             log_function(f"[{client.muda_name}] Claim: No. Reset: {h}h {m}m.{lang_log_suffix}", preset_name, "INFO")
+            save_status(claim_right_available=False, claim_reset_at=reset_deadline(reset_minutes)); client.quota.observe_claim(False, reset_minutes)
             client.current_min_kakera_for_roll_claim = client.min_kakera
             if client.key_mode:
                 log_function(f"[{client.muda_name}] KeyMode on. Check rolls.", preset_name, "INFO"); claim_reset_proceed = True
             else:
                 log_function(f"[{client.muda_name}] Wait claim reset...", preset_name, "RESET")
-                await wait_for_reset((h * 60 + m), client.delay_seconds, log_function, preset_name) # Pass minutes directly
-                await check_status(client, channel, mudae_prefix); return
+                return "wait_claim_reset", {"minutes": reset_minutes}
         else:
             log_function(f"[{client.muda_name}] Ambiguous/Unknown claim status in $tu. Assume No. Check rolls.", preset_name, "WARN")
             client.claim_right_available = False; client.current_min_kakera_for_roll_claim = client.min_kakera
+            save_status(claim_right_available=False, claim_reset_at=None); client.quota.observe_claim(False, None)
             claim_reset_proceed = True
 
         if claim_reset_proceed:
-            await check_rolls_left_tu(client, channel, mudae_prefix, log_function, preset_name,
-                                        tu_message_content_for_rolls=tu_message_content,
+            return await check_rolls_left_tu(client, channel, mudae_prefix, log_function, preset_name,
+                                        tu_status=tu_status,
                                         ignore_limit_for_post_roll=(client.current_min_kakera_for_roll_claim == 0),
                                         key_mode_only_kakera_for_post_roll=(client.key_mode and not client.claim_right_available))
-            return
 
         log_function(f"[{client.muda_name}] Unexp. state in $tu parse. Retry check_status.", preset_name, "ERROR")
         await asyncio.sleep(7)
-        await check_status(client, channel, mudae_prefix)
-        return
+        return "checking", {}
 
 
     async def check_rolls_left_tu(client, channel, mudae_prefix, log_function, preset_name,
-                                  tu_message_content_for_rolls, ignore_limit_for_post_roll, key_mode_only_kakera_for_post_roll):
+                                  tu_status, ignore_limit_for_post_roll, key_mode_only_kakera_for_post_roll):
         log_function(f"[{client.muda_name}] Parsing rolls from $tu (rolling enabled)...", preset_name, "CHECK")
-        content_lower = tu_message_content_for_rolls.lower()
-
-        rolls_left = 0; reset_time_r = 0; lang_log_suffix_rolls = ""; parsed_rolls_info = False
-
-        # MODIFIED REGEXES: Restructured to make the optional reset part more robustly captured.
-        # The separator (like period, space, newline) is now part of the optional group.
-        match_rolls_en = re.search(
-            r"you have \*\*(\d+)\*\* rolls?(?: \(.+?\))? left"  # Group 1 for rolls_left
-            r"(?:"                                             # Start of optional non-capturing group for reset info
-                r"[.\s\n]*?"                                   # Non-greedy separator (dot, whitespace, newline)
-                r"next rolls? reset in \*\*(\d+)\*\* min\.?"   # Group 2 for reset_minutes
-            r")?",                                             # End of optional non-capturing group
-            content_lower,
-            re.DOTALL
-        )
-        match_rolls_pt = re.search(
-            r"você tem \*\*(\d+)\*\* rolls? restantes\.?"      # Group 1 for rolls_left
-            r"(?:"                                            # Start of optional non-capturing group for reset info
-                r"[.\s\n]*?"                                  # Non-greedy separator
-                r"a próxima reinicialização é em \*\*(\d+)\*\* min\.?"  # Group 2 for reset_minutes
-            r")?",                                            # End of optional non-capturing group
-            content_lower,
-            re.DOTALL
-        )
-
-        roll_match_obj = None; reset_minutes_str = None
-
-        if match_rolls_en:
-            roll_match_obj = match_rolls_en # Assign the match object
-            rolls_left = int(roll_match_obj.group(1))
-            reset_minutes_str = roll_match_obj.group(2) # This is group 2 from the modified regex
-            lang_log_suffix_rolls = " (EN)"; parsed_rolls_info = True
-        elif match_rolls_pt:
-            roll_match_obj = match_rolls_pt # Assign the match object
-            rolls_left = int(roll_match_obj.group(1))
-            reset_minutes_str = roll_match_obj.group(2) # This is group 2 from the modified regex
-            lang_log_suffix_rolls = " (PT)"; parsed_rolls_info = True
+        rolls_left = tu_status.rolls_left or 0; reset_time_r = 0; parsed_rolls_info = tu_status.rolls_left is not None
+        lang_log_suffix_rolls = f" ({tu_status.lang.upper()})" if tu_status.lang else ""
 
         if parsed_rolls_info:
-            if reset_minutes_str: # This checks if group(2) captured something
-                try: reset_time_r = int(reset_minutes_str)
-                except ValueError: log_function(f"[{client.muda_name}] Warn: Roll reset time parse fail (value error).{lang_log_suffix_rolls}", preset_name, "ERROR"); reset_time_r = 0
-            else: # reset_minutes_str is None (optional group for reset time didn't match)
+            if tu_status.rolls_reset is not None: reset_time_r = tu_status.rolls_reset
+            else:
                 log_function(f"[{client.muda_name}] Warn: Roll reset time phrase not found in $tu.{lang_log_suffix_rolls}", preset_name, "WARN")
                 reset_time_r = 0
+            save_status(rolls_left=rolls_left, rolls_reset_at=reset_deadline(reset_time_r) if reset_time_r > 0 else None)
+            client.quota.observe_rolls(rolls_left, reset_time_r)
 
             if rolls_left == 0:
                 log_function(f"[{client.muda_name}] No rolls. Reset: {reset_time_r} min.{lang_log_suffix_rolls}", preset_name, "RESET")
                 if reset_time_r <= 0: log_function(f"[{client.muda_name}] Roll reset time is {reset_time_r} min, using default 60 min for wait.", preset_name, "INFO"); reset_time_r = 60
-                await wait_for_rolls_reset(reset_time_r, client.delay_seconds, log_function, preset_name)
-                await check_status(client, channel, mudae_prefix); return
+                return "wait_roll_reset", {"minutes": reset_time_r}
             else:
                 log_function(f"[{client.muda_name}] Rolls left: {rolls_left}. Next reset in {reset_time_r} min.{lang_log_suffix_rolls}", preset_name, "INFO")
-                await start_roll_commands(client, channel, rolls_left, ignore_limit_for_post_roll, key_mode_only_kakera_for_post_roll)
-                return
+                return "rolling", dict(rolls_left=rolls_left, ignore_limit_for_post_roll=ignore_limit_for_post_roll,
+                                       key_mode_only_kakera_for_post_roll=key_mode_only_kakera_for_post_roll)
         else:
-            log_function(f"[{client.muda_name}] CRITICAL: Roll parse fail from $tu. Re-check status.", preset_name, "ERROR")
-            await asyncio.sleep(30); await check_status(client, channel, mudae_prefix); return
+            log_function(f"[{client.muda_name}] CRITICAL: Roll parse fail from $tu. Re-check status.", preset_name, "ERROR"); client.quota.invalidate("roll parse failed")
+            await asyncio.sleep(30); return "checking", {}
 
 
     async def start_roll_commands(client, channel, rolls_left, ignore_limit_for_post_roll, key_mode_only_kakera_for_post_roll):
@@ -339,82 +1614,89 @@ def run_bot(token, prefix, target_channel_id, roll_command, min_kakera, delay_se
         else: log_text += " (Reactive Snipe OFF)"
         log_function(f"[{client.muda_name}] {log_text}", client.preset_name, "INFO")
         start_time = datetime.datetime.now(datetime.timezone.utc)
-        client.is_actively_rolling = True; client.interrupt_rolling = False
+        session = RollSession(channel.id); client.roll_session = session; sent_count = 0
+        client.is_actively_rolling = True; client.interrupt_rolling = False; rolling_started_at = time.monotonic()
         for i in range(rolls_left):
             if client.interrupt_rolling:
                 log_function(f"[{client.muda_name}] Rolling interrupted. {i}/{rolls_left} sent.", client.preset_name, "INFO")
                 client.interrupt_rolling = False; break
-            try: await channel.send(f"{client.mudae_prefix}{roll_command}"); await asyncio.sleep(client.roll_speed)
-            except discord.errors.HTTPException as e: log_function(f"[{client.muda_name}] Error sending roll: {e}. Skip.", preset_name, "ERROR"); await asyncio.sleep(1)
+            try: await outbound(channel).submit("roll", lambda: channel.send(f"{client.mudae_prefix}{client.roll_command}")); sent_count += 1; client.metrics.inc("rolls_sent_total")
+            except discord.errors.HTTPException as e:
+                log_function(f"[{client.muda_name}] Error sending roll: {e}. Skip.", preset_name, "ERROR"); client.metrics.inc("http_errors_total", status=e.status, op="roll"); client.quota.invalidate("roll send failed")
         client.is_actively_rolling = False
+        rolling_seconds = time.monotonic() - rolling_started_at
+        if sent_count and rolling_seconds > 0: client.metrics.set_gauge("roll_rate_per_minute", round(sent_count * 60 / rolling_seconds, 2))
+        session.finish_sending(sent_count); save_status(rolls_left=max(0, rolls_left - sent_count))
+        return "collecting", dict(session=session, sent_count=sent_count, start_time=start_time, ignore_limit_for_post_roll=ignore_limit_for_post_roll,
+                                  key_mode_only_kakera_for_post_roll=key_mode_only_kakera_for_post_roll)
+
+
+    async def collect_roll_results(client, channel, session, sent_count, start_time, ignore_limit_for_post_roll, key_mode_only_kakera_for_post_roll):
         log_function(f"[{client.muda_name}] Rolls sent/interrupted. Wait Mudae msgs...", client.preset_name, "INFO")
-        await asyncio.sleep(5)
-        mudae_messages_to_process = []; fetch_limit = rolls_left * 2 + 10; processed_count = 0
+        try: await asyncio.wait_for(session.complete.wait(), ROLL_COLLECT_TIMEOUT)
+        except asyncio.TimeoutError: log_function(f"[{client.muda_name}] Got {len(session.entries)}/{sent_count} roll replies within {ROLL_COLLECT_TIMEOUT}s.", client.preset_name, "INFO")
+        client.roll_session = None; client.quota.rolls_done(sent_count, len(session.entries))
         try:
-            async for msg in channel.history(limit=fetch_limit, after=start_time, oldest_first=False):
-                processed_count += 1
-                if msg.author.id == TARGET_BOT_ID and msg.embeds and msg.embeds[0].author and msg.embeds[0].author.name:
-                         mudae_messages_to_process.append(msg)
-            mudae_messages_to_process.reverse()
-            log_function(f"[{client.muda_name}] Fetched {processed_count} msgs. Processing {len(mudae_messages_to_process)} post-roll.", client.preset_name, "INFO")
-            if mudae_messages_to_process:
-                 await handle_mudae_messages(client, channel, mudae_messages_to_process, ignore_limit_for_post_roll, key_mode_only_kakera_for_post_roll)
+            if not session.entries and sent_count:
+                # Nothing arrived on the gateway (e.g. reconnect mid-batch); fall back to one history fetch.
+                log_function(f"[{client.muda_name}] No roll embeds seen live. Fetching history.", client.preset_name, "CHECK")
+                client.metrics.inc("rest_fallbacks_total", kind="roll_history"); client.quota.invalidate("roll replies missed")
+                async for msg in channel.history(limit=sent_count * 2 + 10, after=start_time, oldest_first=False):
+                    if msg.author.id == TARGET_BOT_ID and msg.embeds:
+                        record = classify_embed(msg)
+                        if record.char_name: session.add(msg, record); record_roll(msg, record, own_roll=True)
+                session.entries.reverse()
+            log_function(f"[{client.muda_name}] Collected {len(session.entries)} roll embeds. Processing post-roll.", client.preset_name, "INFO")
+            if session.entries:
+                 await handle_mudae_messages(client, channel, session, ignore_limit_for_post_roll, key_mode_only_kakera_for_post_roll)
             else: log_function(f"[{client.muda_name}] No further char msgs for post-roll.", client.preset_name, "INFO")
-        except Exception as e: log_function(f"[{client.muda_name}] Err fetch/process post-roll: {e}", preset_name, "ERROR")
+        except Exception as e: log_function(f"[{client.muda_name}] Err fetch/process post-roll: {e}", preset_name, "ERROR"); client.quota.invalidate("post-roll error")
         await asyncio.sleep(2)
         if client.snipe_happened or client.series_snipe_happened:
             log_function(f"[{client.muda_name}] Claim/Snipe occurred. Re-check status.", client.preset_name, "INFO")
             client.snipe_happened = False; client.series_snipe_happened = False
         else: log_function(f"[{client.muda_name}] Rolls done. Re-check status.", client.preset_name, "INFO")
-        await asyncio.sleep(1); await check_status(client, channel, client.mudae_prefix)
+        await asyncio.sleep(1); return "checking", {}
 
 
-    async def handle_mudae_messages(client, channel, mudae_messages, ignore_limit_param, key_mode_only_kakera_param):
+    @timed_handler("handle_mudae_messages")
+    async def handle_mudae_messages(client, channel, session, ignore_limit_param, key_mode_only_kakera_param):
         kakera_claims = []; char_claims_post = []; wl_claims_post = []
         min_kak_post = 0 if ignore_limit_param else client.min_kakera
         log_function(f"[{client.muda_name}] Post-Roll Handle. MinKak(gen):{min_kak_post} (IgnLmtP:{ignore_limit_param},KeyMNoClaimP:{key_mode_only_kakera_param})", preset_name, "CHECK")
-        for msg in mudae_messages:
-            if not msg.embeds or not msg.embeds[0].author or not msg.embeds[0].author.name: continue
-            if msg.components:
-                for comp in msg.components:
-                    for btn in comp.children:
-                        if hasattr(btn.emoji,'name') and btn.emoji.name in KAKERA_EMOJIS: kakera_claims.append(msg); break
+        for msg, record in session.entries:
+            if msg.id in session.claimed_ids: continue # Already taken by the reactive self-snipe
+            if record.kakera_button and session.take_kakera(msg.id): kakera_claims.append((msg, record)) # Live clicks already took the rest
             if client.claim_right_available or key_mode_only_kakera_param: # key_mode_only_kakera_param allows populating for RT even if claim is off
-                char_n=msg.embeds[0].author.name.lower(); desc=msg.embeds[0].description or ""; k_v=0
-                match_k=re.search(r"\*\*([\d,]+)\*\*<:kakera:",desc);
-                if match_k:
-                    try: k_v=int(match_k.group(1).replace(",",""))
-                    except ValueError: pass
-                is_wl = any(w == char_n for w in client.wishlist)
-                has_claim_b = any(hasattr(b.emoji,'name') and b.emoji.name in CLAIM_EMOJIS for c in msg.components for b in c.children)
-                if has_claim_b:
-                    if is_wl: wl_claims_post.append((msg,char_n,k_v))
-                    elif k_v >= min_kak_post: char_claims_post.append((msg,char_n,k_v))
-
-        for msg_k in kakera_claims: await claim_character(client,channel,msg_k,is_kakera=True); await asyncio.sleep(0.3)
+                if record.claim_button:
+                    is_wl = client.wishlist_index.has_name(record.char_name)
+                    if is_wl: wl_claims_post.append((msg,record.char_name_l,record.kakera,record))
+                    elif record.kakera >= min_kak_post: char_claims_post.append((msg,record.char_name_l,record.kakera,record))
+
+        for msg_k, record_k in kakera_claims: await claim_character(client,channel,msg_k,is_kakera=True,record=record_k)
 
         claimed_post=False; msg_claimed_id=-1
         if client.claim_right_available and wl_claims_post:
-            msg_c,n,v=wl_claims_post[0]; log_function(f"[{client.muda_name}] (Post) Gen. WL: {n}", preset_name, "CLAIM")
-            if await claim_character(client,channel,msg_c,is_kakera=False): claimed_post=True;client.claim_right_available=False;msg_claimed_id=msg_c.id
+            msg_c,n,v,rec=wl_claims_post[0]; log_function(f"[{client.muda_name}] (Post) Gen. WL: {n}", preset_name, "CLAIM")
+            if await client.claim_arbiter.submit(msg_c,rec,"wishlist"): claimed_post=True;client.claim_right_available=False;msg_claimed_id=msg_c.id;save_status(claim_right_available=False)
         elif client.claim_right_available and char_claims_post:
-            char_claims_post.sort(key=lambda x:x[2],reverse=True); msg_c,n,v=char_claims_post[0]
+            char_claims_post.sort(key=lambda x:x[2],reverse=True); msg_c,n,v,rec=char_claims_post[0]
             log_function(f"[{client.muda_name}] (Post) Gen. HV: {n} ({v})", preset_name, "CLAIM")
-            if await claim_character(client,channel,msg_c,is_kakera=False): claimed_post=True;client.claim_right_available=False;msg_claimed_id=msg_c.id
+            if await client.claim_arbiter.submit(msg_c,rec,"roll"): claimed_post=True;client.claim_right_available=False;msg_claimed_id=msg_c.id;save_status(claim_right_available=False)
 
         # RT logic: Only consider RT if a claim was made OR if it's key_mode and claim is not available (key_mode_only_kakera_param)
         if key_mode_only_kakera_param or claimed_post:
             rt_targets=[i for i in wl_claims_post if i[0].id!=msg_claimed_id] + [i for i in char_claims_post if i[0].id!=msg_claimed_id]
             rt_targets.sort(key=lambda x:x[2],reverse=True) # Sort by kakera value, highest first
             if rt_targets:
-                msg_rt,n_rt,v_rt=rt_targets[0] # Get the best available character for RT
+                msg_rt,n_rt,v_rt,rec_rt=rt_targets[0] # Get the best available character for RT
 
                 # MODIFIED: RT decision strictly uses client.min_kakera
                 if v_rt >= client.min_kakera:
                     log_function(f"[{client.muda_name}] (Post) RT: {n_rt} ({v_rt}) vs MinKakRT: {client.min_kakera}", preset_name, "CLAIM")
                     try:
-                        await channel.send(f"{client.mudae_prefix}rt"); await asyncio.sleep(0.7)
-                        await claim_character(client,channel,msg_rt,is_rt_claim=True)
+                        await outbound(channel).submit("rt", lambda: channel.send(f"{client.mudae_prefix}rt")); await asyncio.sleep(0.7)
+                        await claim_character(client,channel,msg_rt,is_rt_claim=True,record=rec_rt)
                     except Exception as e:
                         log_function(f"[{client.muda_name}] (Post) RT Err: {e}", preset_name, "ERROR")
                 # Log if RT was skipped due to this stricter check, but would have passed the general min_kak_post
@@ -422,179 +1704,158 @@ def run_bot(token, prefix, target_channel_id, roll_command, min_kakera, delay_se
                      log_function(f"[{client.muda_name}] (Post) RT Skipped: {n_rt} ({v_rt}) < MinKakRT: {client.min_kakera} (but was >= Gen. Post-Roll MinKak: {min_kak_post})", preset_name, "INFO")
 
 
-    async def claim_character(client, channel, msg, is_kakera=False, is_rt_claim=False):
+    async def claim_character(client, channel, msg, is_kakera=False, is_rt_claim=False, record=None):
         if not msg or not msg.embeds: log_function(f"[{client.muda_name}] Invalid msg to claim_character.", preset_name, "ERROR"); return False
-        embed = msg.embeds[0]; char_name = embed.author.name if embed.author and embed.author.name else "Unknown"; log_px = f"[{client.muda_name}]"; log_sx = f": {char_name}"; log_ty = "CLAIM"
-        btns_to_click = CLAIM_EMOJIS; log_action_desc = "Claim"
-        if is_kakera: log_action_desc = "Kakera"; log_ty = "KAKERA"; btns_to_click = KAKERA_EMOJIS
+        if record is None: record = classify_embed(msg)
+        char_name = record.char_name or "Unknown"; log_px = f"[{client.muda_name}]"; log_sx = f": {char_name}"; log_ty = "CLAIM"
+        btn = record.claim_button; log_action_desc = "Claim"
+        if is_kakera: log_action_desc = "Kakera"; log_ty = "KAKERA"; btn = record.kakera_button
         elif is_rt_claim: log_action_desc = "RT Claim"
-        btn_clicked_ok = False
-        if msg.components:
-            for comp in msg.components:
-                if btn_clicked_ok: break
-                for btn in comp.children:
-                    if hasattr(btn.emoji, 'name') and btn.emoji and btn.emoji.name in btns_to_click:
-                        try:
-                            log_function(f"{log_px} {log_action_desc}{log_sx}", client.preset_name, log_ty)
-                            await btn.click(); btn_clicked_ok=True; await asyncio.sleep(1.5); return True
-                        except discord.errors.NotFound: log_function(f"{log_px} {log_action_desc} Fail (NotFound){log_sx}", preset_name, "ERROR"); return False
-                        except discord.errors.HTTPException as e: log_function(f"{log_px} {log_action_desc} Fail (HTTP {e.status}){log_sx}", preset_name, "ERROR"); return False
-                        except Exception as e: log_function(f"{log_px} {log_action_desc} Fail (Unexp {e}){log_sx}", preset_name, "ERROR"); return False
+        btn_clicked_ok = False; action = log_action_desc.lower().replace(" ", "_")
+        if btn:
+            try:
+                log_function(f"{log_px} {log_action_desc}{log_sx}", client.preset_name, log_ty)
+                await outbound(channel).submit("kakera" if is_kakera else "claim", btn.click); btn_clicked_ok=True
+                if not is_kakera: client.quota.claim_made()
+                if client.record_rolls and ROLL_HISTORY_PATH: roll_history.clicked(msg.id, action)
+                client.metrics.observe("claim_latency_seconds", time.monotonic() - record.received_at, action=action); client.metrics.inc("clicks_total", action=action, result="ok")
+                return True
+            except discord.errors.NotFound:
+                log_function(f"{log_px} {log_action_desc} Fail (NotFound){log_sx}", preset_name, "ERROR"); client.metrics.inc("http_errors_total", status=404, op=action); return False
+            except discord.errors.HTTPException as e:
+                log_function(f"{log_px} {log_action_desc} Fail (HTTP {e.status}){log_sx}", preset_name, "ERROR"); client.metrics.inc("http_errors_total", status=e.status, op=action); return False
+            except Exception as e: log_function(f"{log_px} {log_action_desc} Fail (Unexp {e}){log_sx}", preset_name, "ERROR"); client.metrics.inc("clicks_total", action=action, result="error"); return False
         if not btn_clicked_ok and not is_kakera and not is_rt_claim:
             log_function(f"{log_px} No btn for {char_name}. Fallback react.", preset_name, "INFO")
             try:
                 log_function(f"{log_px} {log_action_desc}{log_sx} (react)", client.preset_name, log_ty)
-                await msg.add_reaction("💖"); await asyncio.sleep(1.5); return True
+                await outbound(channel).submit("react", lambda: msg.add_reaction("💖")); client.quota.claim_made()
+                if client.record_rolls and ROLL_HISTORY_PATH: roll_history.clicked(msg.id, "react")
+                client.metrics.observe("claim_latency_seconds", time.monotonic() - record.received_at, action="react"); client.metrics.inc("clicks_total", action="react", result="ok")
+                return True
+            except discord.errors.HTTPException as e:
+                log_function(f"{log_px} {log_action_desc} React Fail{log_sx}: {e}", preset_name, "ERROR"); client.metrics.inc("http_errors_total", status=e.status, op="react"); return False
             except Exception as e: log_function(f"{log_px} {log_action_desc} React Fail{log_sx}: {e}", preset_name, "ERROR"); return False
         elif not btn_clicked_ok: log_function(f"{log_px} No btn for {log_action_desc} on {char_name}", preset_name, "INFO")
         return False
 
-    async def wait_for_reset(reset_time_minutes, base_delay_seconds, log_function, preset_name):
-        now = datetime.datetime.now()
-        estimated_reset_time = now + datetime.timedelta(minutes=reset_time_minutes)
-        target_reset_minute = estimated_reset_time.replace(second=0, microsecond=0)
-        target_wakeup_time = target_reset_minute + datetime.timedelta(seconds=base_delay_seconds)
-        total_wait = (target_wakeup_time - now).total_seconds()
+    async def wait_for_reset(reset_time_minutes, base_delay_seconds, log_function, preset_name, reset_at=None):
+        if reset_at is None: reset_at = reset_minute_boottime(reset_time_minutes)
+        total_wait = reset_at + base_delay_seconds - boottime()
         if total_wait <= 0:
-            total_wait = base_delay_seconds + 1 # Fallback to a short wait
+            reset_at = boottime(); base_delay_seconds = total_wait = base_delay_seconds + 1 # Fallback to a short wait
         end_time = datetime.datetime.now() + datetime.timedelta(seconds=total_wait)
         log_function(f"[{client.muda_name}] Wait claim reset. Total: {total_wait:.2f}s. Resume ~{end_time.strftime('%H:%M:%S')}", preset_name, "RESET")
-        await asyncio.sleep(total_wait)
+        await reset_scheduler.wait(preset_name, "claim", reset_at, base_delay_seconds)
         log_function(f"[{client.muda_name}] Claim wait done.", preset_name, "RESET")
 
 
-    async def wait_for_rolls_reset(reset_time_minutes, base_delay_seconds, log_function, preset_name):
-        now = datetime.datetime.now()
-        actual_reset_time_minutes = reset_time_minutes
-        if reset_time_minutes <= 0:
-            actual_reset_time_minutes = 60 # Default to a full hour if time is invalid
-            log_function(f"[{client.muda_name}] Invalid roll reset time ({reset_time_minutes}m), using default {actual_reset_time_minutes}m.", preset_name, "WARN")
-        estimated_reset_time = now + datetime.timedelta(minutes=actual_reset_time_minutes)
-        target_reset_minute = estimated_reset_time.replace(second=0, microsecond=0)
-        target_wakeup_time = target_reset_minute + datetime.timedelta(seconds=base_delay_seconds)
-        total_wait = (target_wakeup_time - now).total_seconds()
+    async def wait_for_rolls_reset(reset_time_minutes, base_delay_seconds, log_function, preset_name, reset_at=None):
+        if reset_at is not None: actual_reset_time_minutes = (reset_at - boottime()) / 60
+        else:
+            actual_reset_time_minutes = reset_time_minutes
+            if reset_time_minutes <= 0:
+                actual_reset_time_minutes = 60 # Default to a full hour if time is invalid
+                log_function(f"[{client.muda_name}] Invalid roll reset time ({reset_time_minutes}m), using default {actual_reset_time_minutes}m.", preset_name, "WARN")
+            reset_at = reset_minute_boottime(actual_reset_time_minutes)
+        total_wait = reset_at + base_delay_seconds - boottime()
         if total_wait <= 0:
-            total_wait = base_delay_seconds + 1 # Fallback to a short wait
+            reset_at = boottime(); base_delay_seconds = total_wait = base_delay_seconds + 1 # Fallback to a short wait
         end_time = datetime.datetime.now() + datetime.timedelta(seconds=total_wait)
-        log_function(f"[{client.muda_name}] Wait rolls reset (~{actual_reset_time_minutes}m). Total: {total_wait:.2f}s. Resume ~{end_time.strftime('%H:%M:%S')}", preset_name, "RESET")
-        await asyncio.sleep(total_wait)
+        log_function(f"[{client.muda_name}] Wait rolls reset (~{actual_reset_time_minutes:.0f}m). Total: {total_wait:.2f}s. Resume ~{end_time.strftime('%H:%M:%S')}", preset_name, "RESET")
+        await reset_scheduler.wait(preset_name, "rolls", reset_at, base_delay_seconds)
         log_function(f"[{client.muda_name}] Roll wait done.", preset_name, "RESET")
 
     @client.event
+    async def on_raw_message_edit(payload):
+        author_id = payload.data.get("author", {}).get("id")
+        if payload.channel_id not in client.channel_states or (author_id is not None and int(author_id) != TARGET_BOT_ID): return
+        reason = edit_drop_reason(payload.data, payload.message)
+        if reason: client.metrics.inc("mudae_edits_total", result="unclaimable"); client.claim_arbiter.withdraw(payload.message_id, reason)
+
+    @client.event
+    @timed_handler("on_message")
     async def on_message(message):
-        if message.author.id != TARGET_BOT_ID or message.channel.id != client.target_channel_id:
+        state = client.channel_states.get(message.channel.id)
+        if message.author.id != TARGET_BOT_ID or state is None:
+            if state is not None and message.content.startswith(client.mudae_prefix) and message.content[len(client.mudae_prefix):].split(" ", 1)[0].lower() in ROLL_COMMANDS:
+                client.last_roll_command[message.channel.id] = (time.monotonic(), message.author.id, message.author.name)
             if client.rolling_enabled: await client.process_commands(message)
             return
+        if client.response_waiter.pending: client.response_waiter.feed(message)
         if not message.embeds: return
-        embed = message.embeds[0]; process_further = True
-
-        if client.rolling_enabled and client.enable_reactive_self_snipe and client.is_actively_rolling and client.claim_right_available:
-            if embed.author and embed.author.name:
-                char_name_l = embed.author.name.lower(); desc = embed.description or ""; series_l=(desc.splitlines()[0] if desc else "").lower(); k_val=0
-                match_k = re.search(r"\*\*([\d,]+)\*\*<:kakera:", desc);
-                if match_k:
-                    try: k_val = int(match_k.group(1).replace(",",""))
-                    except ValueError: pass
-                is_wl = any(w == char_name_l for w in client.wishlist)
-                is_series_wl = client.series_wishlist and any(sw in series_l for sw in client.series_wishlist)
-                is_k_snipe_criterion = client.kakera_snipe_mode_active and k_val >= client.kakera_snipe_threshold
-
-                if is_wl or is_series_wl or is_k_snipe_criterion:
-                    has_claim_btn = any(hasattr(b.emoji,'name') and b.emoji.name in CLAIM_EMOJIS for comp in message.components for b in comp.children)
-                    if has_claim_btn:
-                        if await claim_character(client, message.channel, message, is_kakera=False):
-                            client.claim_right_available=False; client.interrupt_rolling=True; client.snipe_happened=True; process_further=False
-                            if any(hasattr(b.emoji,'name') and b.emoji.name in KAKERA_EMOJIS for comp in message.components for b in comp.children):
-                                await asyncio.sleep(0.2); await claim_character(client, message.channel, message, is_kakera=True)
+        record = classify_embed(message); process_further = True
+        session = client.roll_session; in_roll_session = False
+        if session is not None and message.channel.id == session.channel_id and record.char_name:
+            in_roll_session = session.add(message, record)
+        record_roll(message, record, in_roll_session)
+        rolling_here = client.is_actively_rolling and message.channel.id == client.target_channel_id # Own rolls can't be told apart from others' there
+
+        if client.rolling_enabled and client.enable_reactive_self_snipe and rolling_here and client.claim_right_available:
+            if record.char_name:
+                is_wl = client.wishlist_index.has_name(record.char_name)
+                is_series_wl = client.wishlist_index.matches_series(record.series)
+                is_k_snipe_criterion = state.kakera_snipe_mode_active and record.kakera >= state.kakera_snipe_threshold
+
+                if (is_wl or is_series_wl or is_k_snipe_criterion) and record.claim_button:
+                    source = "wishlist" if is_wl else "series" if is_series_wl else "kakera"
+                    client.interrupt_rolling = True # Stop rolling now, not after the claim window; resumed below if the arbiter says no
+                    if not await client.claim_arbiter.submit(message, record, source):
+                        if client.claim_right_available: client.interrupt_rolling = False # Nothing was claimed in that window
+                    else:
+                        client.claim_right_available=False; client.interrupt_rolling=True; client.snipe_happened=True; process_further=False
+                        save_status(claim_right_available=False)
+                        if in_roll_session: session.claimed_ids.add(message.id)
+                        if record.kakera_button and (not in_roll_session or session.take_kakera(message.id)):
+                            await claim_character(client, message.channel, message, is_kakera=True, record=record)
 
         if process_further:
-            if client.series_snipe_mode and client.series_wishlist and message.id not in client.series_sniped_messages and not client.is_actively_rolling:
-                desc = embed.description or "";
-                if desc:
-                    first_line = desc.splitlines()[0].lower()
-                    if any(kw in first_line for kw in client.series_wishlist):
-                        if any(hasattr(b.emoji,'name') and b.emoji.name in CLAIM_EMOJIS for comp in message.components for b in comp.children):
-                            client.series_sniped_messages.add(message.id); s_name = embed.author.name if embed.author else desc.splitlines()[0]
-                            log_function(f"[{client.muda_name}] Ext.Series Snipe: {s_name} (Delay {client.series_snipe_delay}s)", preset_name, "CLAIM")
-                            await asyncio.sleep(client.series_snipe_delay)
-                            if await claim_character(client, message.channel, message): client.series_snipe_happened=True; process_further=False
-
-            if process_further and client.snipe_mode and client.wishlist and message.id not in client.sniped_messages and not client.is_actively_rolling:
-                if embed.author and embed.author.name:
-                    char_name_l = embed.author.name.lower()
-                    is_snipe_ext = any(w == char_name_l for w in client.wishlist)
-                    if is_snipe_ext:
-                        if any(hasattr(b.emoji,'name') and b.emoji.name in CLAIM_EMOJIS for comp in message.components for b in comp.children):
-                            client.sniped_messages.add(message.id)
-                            log_function(f"[{client.muda_name}] Ext.Char Snipe: {embed.author.name} (Delay {client.snipe_delay}s)", preset_name, "CLAIM")
-                            await asyncio.sleep(client.snipe_delay)
-                            if await claim_character(client, message.channel, message): client.snipe_happened=True; process_further=False
-
-            if process_further and client.kakera_snipe_mode_active and message.id not in client.kakera_value_sniped_messages and not client.is_actively_rolling:
-                if embed.author and embed.author.name:
-                    desc = embed.description or ""; k_val=0
-                    match_k_ext = re.search(r"\*\*([\d,]+)\*\*<:kakera:", desc)
-                    if match_k_ext:
-                        try: k_val = int(match_k_ext.group(1).replace(",",""))
-                        except ValueError: pass
-
-                    if k_val >= client.kakera_snipe_threshold:
-                        if any(hasattr(b.emoji,'name') and b.emoji.name in CLAIM_EMOJIS for comp in message.components for b in comp.children):
-                            client.kakera_value_sniped_messages.add(message.id)
-                            log_function(f"[{client.muda_name}] Ext.Kakera Val. Snipe: {embed.author.name} ({k_val}) (Delay {client.snipe_delay}s)", preset_name, "CLAIM")
-                            await asyncio.sleep(client.snipe_delay)
-                            if await claim_character(client, message.channel, message):
-                                client.snipe_happened = True
-                                process_further = False
-
-            if process_further and client.kakera_reaction_snipe_mode_active and message.id not in client.kakera_reaction_sniped_messages and not client.is_actively_rolling:
-                has_kakera_button_for_external_snipe = False
-                if message.components:
-                    for comp in message.components:
-                        for btn in comp.children:
-                            if hasattr(btn.emoji, 'name') and btn.emoji.name in KAKERA_EMOJIS:
-                                has_kakera_button_for_external_snipe = True
-                                break
-                        if has_kakera_button_for_external_snipe:
-                            break
-
-                if has_kakera_button_for_external_snipe:
-                    client.kakera_reaction_sniped_messages.add(message.id)
-                    log_subject_name = "Kakera Event"
-                    if embed.author and embed.author.name:
-                        log_subject_name = embed.author.name
-                    elif embed.description:
-                        log_subject_name = embed.description.splitlines()[0][:30]
-
-                    log_function(f"[{client.muda_name}] Ext.KakeraReact Snipe: {log_subject_name} (Delay {client.kakera_reaction_snipe_delay_value}s)", client.preset_name, "KAKERA")
-                    await asyncio.sleep(client.kakera_reaction_snipe_delay_value)
-                    await claim_character(client, message.channel, message, is_kakera=True)
-
-        if client.rolling_enabled and client.enable_reactive_self_snipe and client.is_actively_rolling and process_further: #This part is for self-roll kakera reaction
-            if embed.author and embed.author.name: # Ensure it's a character embed
-                desc = embed.description or ""; k_val=0
-                match_k = re.search(r"\*\*([\d,]+)\*\*<:kakera:", desc)
-                if match_k:
-                    try: k_val = int(match_k.group(1).replace(",",""))
-                    except ValueError: pass
-
-                kakera_button_present = any(hasattr(b.emoji,'name') and b.emoji.name in KAKERA_EMOJIS for comp in message.components for b in comp.children)
-                should_click_kakera = kakera_button_present and \
-                                      (not client.kakera_snipe_mode_active or k_val >= client.kakera_snipe_threshold or client.kakera_snipe_threshold == 0)
-
-                if should_click_kakera:
-                    if await claim_character(client, message.channel, message, is_kakera=True):
-                        pass # Kakera claimed
+            # At most one external snipe per message: the best matching kind goes to the claim arbiter
+            snipe = None
+            if record.claim_button and not rolling_here and not in_roll_session:
+                if state.snipe_mode and client.wishlist and record.char_name and client.wishlist_index.has_name(record.char_name):
+                    snipe = ("wishlist", state.snipe_delay, f"Ext.Char Snipe: {record.char_name}")
+                elif state.series_snipe_mode and client.series_wishlist and record.series and client.wishlist_index.matches_series(record.series):
+                    snipe = ("series", state.series_snipe_delay, f"Ext.Series Snipe: {record.char_name or record.series}")
+                elif state.kakera_snipe_mode_active and record.char_name and record.kakera >= state.kakera_snipe_threshold:
+                    snipe = ("kakera", state.snipe_delay, f"Ext.Kakera Val. Snipe: {record.char_name} ({record.kakera})")
+            if snipe and not getattr(state, SNIPE_MESSAGE_KINDS[snipe[0]]).decide(message.id, any(message.id in getattr(state, kind) for kind in SNIPE_MESSAGE_KINDS.values())):
+                snipe = None # Already sniped as this or another kind (e.g. Mudae edited the embed)
+            if snipe:
+                source, delay, log_text = snipe; mark_handled(state, SNIPE_MESSAGE_KINDS[source], message.id)
+                log_function(f"[{client.muda_name}] {log_text} (Delay {delay}s)", preset_name, "CLAIM")
+                if await client.claim_arbiter.submit(message, record, source, delay):
+                    if source == "series": client.series_snipe_happened = True
+                    else: client.snipe_happened = True
+                    process_further = False
+
+            if process_further and state.kakera_reaction_snipe_mode_active and record.kakera_button and not rolling_here and not in_roll_session and state.kakera_reaction_sniped_messages.decide(message.id):
+                mark_handled(state, "kakera_reaction_sniped_messages", message.id)
+                log_subject_name = record.char_name or (record.series[:30] if record.series else "Kakera Event")
+
+                log_function(f"[{client.muda_name}] Ext.KakeraReact Snipe: {log_subject_name} (Delay {state.kakera_reaction_snipe_delay_value}s)", client.preset_name, "KAKERA")
+                await asyncio.sleep(state.kakera_reaction_snipe_delay_value)
+                await claim_character(client, message.channel, message, is_kakera=True, record=record)
+
+        if in_roll_session and record.kakera_button and session.take_kakera(message.id): # Kakera on our own roll batch is clicked as it arrives
+            await claim_character(client, message.channel, message, is_kakera=True, record=record)
 
         if process_further and client.rolling_enabled: # Only process commands if rolling is enabled for this bot
             await client.process_commands(message)
 
 
-    try: client.run(token)
+    return client
+
+
+def run_bot(**bot_kwargs):
+    client = create_bot(**bot_kwargs)
+    log_function = bot_kwargs["log_function"]; preset_name = bot_kwargs["preset_name"]
+    try: client.run(bot_kwargs["token"])
     except discord.errors.LoginFailure: log_function(f"[{BOT_NAME}] LoginFail '{preset_name}'. Check token.", preset_name, "ERROR")
     except Exception as e: log_function(f"[{BOT_NAME}] Unexp Err '{preset_name}': {e}", preset_name, "ERROR")
+    return client
 
-def bot_lifecycle_wrapper(preset_name, preset_data):
+def build_bot_kwargs(preset_name, preset_data):
     key_mode=preset_data.get("key_mode",False); start_delay=preset_data.get("start_delay",0)
     snipe_mode=preset_data.get("snipe_mode",False); snipe_delay=preset_data.get("snipe_delay",2)
     snipe_ignore_min_kakera_reset=preset_data.get("snipe_ignore_min_kakera_reset",False)
@@ -607,21 +1868,33 @@ def bot_lifecycle_wrapper(preset_name, preset_data):
     rolling_enabled_preset = preset_data.get("rolling", True)
     kakera_reaction_snipe_mode_p = preset_data.get("kakera_reaction_snipe_mode", False)
     kakera_reaction_snipe_delay_p = preset_data.get("kakera_reaction_snipe_delay", 0.75)
+    wishlist_fold_accents = preset_data.get("wishlist_fold_accents", False)
+    persist_state = preset_data.get("persist_state", True)
+    claim_window = preset_data.get("claim_window", 0.5)
+    record_rolls = preset_data.get("record_rolls", True)
+    lean = preset_data.get("lean", False)
+    watch_channels = preset_channels(preset_data["channel_id"])
+
+    return dict(
+        token=preset_data["token"], prefix=preset_data["prefix"], target_channel_id=watch_channels[0][0],
+        roll_command=preset_data["roll_command"], min_kakera=preset_data["min_kakera"], delay_seconds=preset_data["delay_seconds"],
+        mudae_prefix=preset_data["mudae_prefix"], log_function=print_log, preset_name=preset_name, key_mode=key_mode, start_delay=start_delay,
+        snipe_mode=snipe_mode, snipe_delay=snipe_delay, snipe_ignore_min_kakera_reset=snipe_ignore_min_kakera_reset, wishlist=wishlist,
+        series_snipe_mode=series_snipe_mode, series_snipe_delay=series_snipe_delay, series_wishlist=series_wishlist, roll_speed=roll_speed,
+        kakera_snipe_mode_preset=kakera_snipe_mode_preset, kakera_snipe_threshold_preset=kakera_snipe_threshold_preset,
+        enable_reactive_self_snipe_preset=enable_reactive_self_snipe_preset, rolling_enabled=rolling_enabled_preset,
+        kakera_reaction_snipe_mode_preset=kakera_reaction_snipe_mode_p, kakera_reaction_snipe_delay_preset=kakera_reaction_snipe_delay_p,
+        wishlist_fold_accents=wishlist_fold_accents, persist_state=persist_state, claim_window=claim_window,
+        record_rolls=record_rolls, lean=lean, watch_channels=watch_channels
+    )
 
-    restart_delay = 60
+def bot_lifecycle_wrapper(preset_name, preset_data):
     while True:
-        run_bot(
-            preset_data["token"], preset_data["prefix"], preset_data["channel_id"],
-            preset_data["roll_command"], preset_data["min_kakera"], preset_data["delay_seconds"],
-            preset_data["mudae_prefix"], print_log, preset_name, key_mode, start_delay,
-            snipe_mode, snipe_delay, snipe_ignore_min_kakera_reset, wishlist,
-            series_snipe_mode, series_snipe_delay, series_wishlist, roll_speed,
-            kakera_snipe_mode_preset, kakera_snipe_threshold_preset,
-            enable_reactive_self_snipe_preset, rolling_enabled_preset,
-            kakera_reaction_snipe_mode_p, kakera_reaction_snipe_delay_p
-        )
-        print_log(f"Bot instance for '{preset_name}' has stopped. Restarting in {restart_delay} seconds...", preset_name, "RESET")
-        time.sleep(restart_delay)
+        preset_data = presets.get(preset_name, preset_data) # Picks up presets.json reloads
+        client = run_bot(**build_bot_kwargs(preset_name, preset_data))
+        if client.restart_requested: print_log(f"Bot instance for '{preset_name}' restarting with reloaded preset...", preset_name, "RESET"); continue
+        print_log(f"Bot instance for '{preset_name}' has stopped. Restarting in {PRESET_RESTART_DELAY} seconds...", preset_name, "RESET")
+        time.sleep(PRESET_RESTART_DELAY)
 
 
 def start_preset_thread(preset_name, preset_data):
@@ -629,9 +1902,312 @@ def start_preset_thread(preset_name, preset_data):
          print(f"\033[91mSkip preset '{preset_name}' (config err).\033[0m"); return None
      print(f"\033[92mSpawning manager thread for preset: {preset_name}\033[0m")
      thread = threading.Thread(target=bot_lifecycle_wrapper, args=(preset_name, preset_data), daemon=True)
-     thread.start()
+     thread.start(); start_presets_watcher()
      return thread
 
+
+# --- presets.json hot reload: changed fields are applied to the running clients on their own loop ---
+running_clients = weakref.WeakValueDictionary() # preset name -> latest client created for it
+# build_bot_kwargs key -> client attribute for settings that can change under a running bot
+LIVE_PRESET_ATTRS = {
+    "prefix": "command_prefix", "roll_command": "roll_command", "min_kakera": "min_kakera", "delay_seconds": "delay_seconds",
+    "mudae_prefix": "mudae_prefix", "key_mode": "key_mode", "snipe_mode": "snipe_mode", "snipe_delay": "snipe_delay",
+    "snipe_ignore_min_kakera_reset": "snipe_ignore_min_kakera_reset", "series_snipe_mode": "series_snipe_mode",
+    "series_snipe_delay": "series_snipe_delay", "roll_speed": "roll_speed", "kakera_snipe_mode_preset": "kakera_snipe_mode_active",
+    "kakera_snipe_threshold_preset": "kakera_snipe_threshold", "enable_reactive_self_snipe_preset": "enable_reactive_self_snipe",
+    "kakera_reaction_snipe_mode_preset": "kakera_reaction_snipe_mode_active", "kakera_reaction_snipe_delay_preset": "kakera_reaction_snipe_delay_value",
+    "record_rolls": "record_rolls"}
+# Changes to these need a new login (or, for rolling, a different on_ready path)
+RESTART_PRESET_KEYS = ("token", "target_channel_id", "rolling_enabled", "persist_state", "lean")
+
+def apply_preset_changes(client, bot_kwargs, changed):
+    for key in changed:
+        if key in LIVE_PRESET_ATTRS: setattr(client, LIVE_PRESET_ATTRS[key], bot_kwargs[key])
+    if {"wishlist", "series_wishlist", "wishlist_fold_accents"} & set(changed):
+        client.wishlist = [w.lower() for w in bot_kwargs["wishlist"]]; client.series_wishlist = [sw.lower() for sw in bot_kwargs["series_wishlist"]]
+        client.wishlist_index = WishlistIndex(bot_kwargs["wishlist"], bot_kwargs["series_wishlist"], bot_kwargs["wishlist_fold_accents"])
+    if "roll_speed" in changed:
+        for outbound_queue in client.outbound_queues.values(): outbound_queue.fallback_interval = bot_kwargs["roll_speed"]
+    if "claim_window" in changed: client.claim_arbiter.window = bot_kwargs["claim_window"]
+    added = []
+    if "watch_channels" in changed: # Channels added or removed start or stop being watched; kept ones keep their caches
+        added = [channel_id for channel_id, _ in bot_kwargs["watch_channels"] if channel_id not in client.channel_states]
+        client.channel_states = {channel_id: client.channel_states.get(channel_id) or ChannelState(channel_id) for channel_id, _ in bot_kwargs["watch_channels"]}
+        for channel_id, overrides in bot_kwargs["watch_channels"]: client.channel_states[channel_id].overrides = dict(overrides)
+    for state in client.channel_states.values(): state.configure(client) # Preset-wide snipe settings may have changed under the overrides
+    if added and client.first_ready_at is not None: # Before ready, on_ready checks every channel itself
+        for channel_id in added: asyncio.ensure_future(client.watch_channel(channel_id))
+
+def reload_presets(previous, path=PRESETS_FILE):
+    # Returns the presets now in effect; a preset that fails validate_preset keeps its previous settings
+    global presets
+    try: loaded = load_presets(path)
+    except (OSError, ValueError) as e:
+        print_log(f"[{BOT_NAME}] presets.json reload failed: {e}. Keeping current settings.", "System", "ERROR"); return previous
+    updates = []
+    for preset_name, preset_data in list(loaded.items()):
+        client = running_clients.get(preset_name)
+        if client is None or client.is_closed() or preset_data == previous.get(preset_name, preset_data): continue
+        if not validate_preset(preset_name, preset_data):
+            print_log(f"[{BOT_NAME}] Reloaded preset '{preset_name}' is invalid. Keeping current settings.", preset_name, "ERROR")
+            loaded[preset_name] = previous[preset_name]; continue
+        old_kwargs = build_bot_kwargs(preset_name, previous[preset_name]); new_kwargs = build_bot_kwargs(preset_name, preset_data)
+        changed = [key for key in new_kwargs if new_kwargs[key] != old_kwargs[key]]
+        changed_keys = ", ".join(sorted(key for key in previous[preset_name].keys() | preset_data.keys() if previous[preset_name].get(key) != preset_data.get(key)))
+        if changed: updates.append((preset_name, client, new_kwargs, changed, changed_keys))
+    for preset_name in previous.keys() - loaded.keys():
+        if preset_name in running_clients: print_log(f"[{BOT_NAME}] Preset '{preset_name}' removed from presets.json; it keeps running with its last settings.", preset_name, "WARN")
+    presets = loaded # Before any restart, so the restarted bot is built from the new settings
+    for preset_name, client, new_kwargs, changed, changed_keys in updates:
+        loop = client.loop if isinstance(client.loop, asyncio.AbstractEventLoop) else None
+        if any(key in RESTART_PRESET_KEYS for key in changed):
+            print_log(f"[{BOT_NAME}] presets.json: {changed_keys} changed. Restarting preset...", preset_name, "RESET")
+            client.restart_requested = True
+            if loop: asyncio.run_coroutine_threadsafe(client.close(), loop)
+        else:
+            print_log(f"[{BOT_NAME}] presets.json: applying {changed_keys} live.", preset_name, "INFO")
+            if loop: loop.call_soon_threadsafe(apply_preset_changes, client, new_kwargs, changed)
+            else: apply_preset_changes(client, new_kwargs, changed)
+    return loaded
+
+presets_watcher = None; presets_watcher_lock = threading.Lock()
+
+def watch_presets(path, interval=PRESETS_WATCH_INTERVAL):
+    def mtime():
+        try: return os.stat(path).st_mtime_ns
+        except OSError: return None
+    current = dict(presets); last_mtime = mtime()
+    while True:
+        time.sleep(interval)
+        new_mtime = mtime()
+        if new_mtime is None or new_mtime == last_mtime: continue
+        last_mtime = new_mtime; current = reload_presets(current, path)
+
+def start_presets_watcher(path=None):
+    global presets_watcher
+    path = path or presets_path
+    with presets_watcher_lock:
+        if presets_watcher is None:
+            presets_watcher = threading.Thread(target=watch_presets, args=(path,), name="mudae-presets-watcher", daemon=True); presets_watcher.start()
+
+
+# --- Shared-loop supervisor: all selected presets run as tasks on one event loop ---
+current_preset = contextvars.ContextVar("current_preset", default=None)
+task_owners = weakref.WeakKeyDictionary() # task -> preset name, filled by preset_task_factory
+shared_loop = None; shared_loop_presets = set(); shared_loop_lock = threading.Lock()
+
+def preset_task_factory(loop, coro, **kwargs):
+    # Child tasks copy the creating task's context, so every task discord.py spawns for a client
+    # (gateway, keep-alive, event dispatch) is attributed to the preset that started it.
+    task = asyncio.Task(coro, loop=loop, **kwargs)
+    owner = current_preset.get()
+    if owner: task_owners[task] = owner
+    return task
+
+def process_rss_mb():
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"): return int(line.split()[1]) / 1024
+    except OSError: pass
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+    except Exception: return None
+
+def preset_task_counts(loop):
+    counts = {}
+    for task in asyncio.all_tasks(loop):
+        owner = task_owners.get(task)
+        if owner: counts[owner] = counts.get(owner, 0) + 1
+    return counts
+
+async def report_shared_loop_usage(interval=SHARED_LOOP_REPORT_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        counts = preset_task_counts(asyncio.get_running_loop())
+        if not counts: continue
+        rss = process_rss_mb()
+        # RSS is process-wide on a shared loop; the per-preset figure is an even split of it.
+        rss_text = f"RSS {rss:.1f} MB (~{rss / len(counts):.1f} MB/preset)" if rss is not None else "RSS n/a"
+        tasks_text = ", ".join(f"{name}: {n} tasks" for name, n in sorted(counts.items()))
+        print_log(f"[{BOT_NAME}] Shared loop: {len(counts)} presets, {rss_text} | {tasks_text}", "Supervisor", "CHECK")
+
+async def preset_supervisor(preset_name, preset_data, start_offset=0):
+    current_preset.set(preset_name)
+    shared_loop_presets.add(preset_name)
+    try:
+        if start_offset: await asyncio.sleep(start_offset) # Staggered login
+        while True:
+            preset_data = presets.get(preset_name, preset_data) # Picks up presets.json reloads
+            bot_kwargs = build_bot_kwargs(preset_name, preset_data)
+            client = create_bot(**bot_kwargs)
+            try: await client.start(bot_kwargs["token"])
+            except discord.errors.LoginFailure: print_log(f"[{BOT_NAME}] LoginFail '{preset_name}'. Check token.", preset_name, "ERROR")
+            except Exception as e: print_log(f"[{BOT_NAME}] Unexp Err '{preset_name}': {e}", preset_name, "ERROR")
+            finally:
+                if not client.is_closed(): await client.close()
+            if client.restart_requested: print_log(f"Bot instance for '{preset_name}' restarting with reloaded preset...", preset_name, "RESET"); continue
+            print_log(f"Bot instance for '{preset_name}' has stopped. Restarting in {PRESET_RESTART_DELAY} seconds...", preset_name, "RESET")
+            await asyncio.sleep(PRESET_RESTART_DELAY)
+    finally: shared_loop_presets.discard(preset_name)
+
+async def run_presets_shared(preset_items, start_offsets=()):
+    start_offsets = list(start_offsets) + [0] * (len(preset_items) - len(start_offsets))
+    await asyncio.gather(*(preset_supervisor(name, data, offset) for (name, data), offset in zip(preset_items, start_offsets)))
+
+def get_shared_loop():
+    global shared_loop
+    with shared_loop_lock:
+        if shared_loop is None:
+            shared_loop = asyncio.new_event_loop(); shared_loop.set_task_factory(preset_task_factory)
+            threading.Thread(target=shared_loop.run_forever, name="mudae-shared-loop", daemon=True).start()
+            asyncio.run_coroutine_threadsafe(report_shared_loop_usage(), shared_loop)
+        return shared_loop
+
+def start_presets_shared(preset_items, stagger=0):
+    valid_items = []
+    for preset_name, preset_data in preset_items:
+        if not validate_preset(preset_name, preset_data): print(f"\033[91mSkip preset '{preset_name}' (config err).\033[0m"); continue
+        print(f"\033[92mScheduling preset on shared loop: {preset_name}\033[0m"); valid_items.append((preset_name, preset_data))
+    if not valid_items: return None
+    start_presets_watcher()
+    return asyncio.run_coroutine_threadsafe(run_presets_shared(valid_items, [i * stagger for i in range(len(valid_items))]), get_shared_loop())
+
+
+# --- Sharded mode: presets spread over worker processes, each running its share on one shared loop ---
+# Workers send log lines and periodic status back over one pipe each; the supervisor (this process)
+# writes the logs and restarts a worker that exits without touching the others.
+shard_supervisors = []
+
+class IPCLogSink:
+    # Worker-side stand-in for LogSink: lines go to the supervisor, whose LogSink writes them. Like LogSink the loop
+    # only enqueues; one writer thread does the blocking pipe sends. Status frames are coalesced: while one is
+    # waiting to be sent, a newer one replaces it, so a slow supervisor never builds a backlog of metrics snapshots.
+    STOP = object(); STATUS = object()
+
+    def __init__(self, conn):
+        self.conn = conn; self.lock = threading.Lock(); self.queue = queue.SimpleQueue(); self.thread = None
+        self.status = None # Latest status frame not yet sent
+
+    def emit(self, message, preset_name, log_type="INFO", created=None):
+        self.put(("log", created or time.time(), preset_name, log_type, message))
+
+    def send_status(self, item):
+        with self.lock: queued = self.status is not None; self.status = item
+        if not queued: self.put(self.STATUS)
+
+    def put(self, item):
+        if self.thread is None: self.start()
+        self.queue.put(item)
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None: return
+            self.thread = threading.Thread(target=self._run, name="mudae-ipc-writer", daemon=True); self.thread.start()
+            atexit.register(self.close)
+
+    def close(self, timeout=2.0):
+        if self.thread is None: return
+        self.queue.put(self.STOP); self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is self.STOP: return
+            if item is self.STATUS:
+                with self.lock: item, self.status = self.status, None
+            try: self.conn.send(item)
+            except (OSError, ValueError): return # Supervisor gone; the process is about to be terminated
+
+async def report_shard_status(shard_id, sink, interval=SHARD_STATUS_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        with metrics_registries_lock: registries = list(metrics_registries.values())
+        sink.send_status(("status", shard_id, {"pid": os.getpid(), "rss_mb": process_rss_mb(), "tasks": preset_task_counts(asyncio.get_running_loop()),
+                                               "metrics": {registry.preset_name: registry.snapshot() for registry in registries}}))
+
+async def run_shard(shard_id, preset_items, start_offsets, sink):
+    asyncio.get_running_loop().set_task_factory(preset_task_factory)
+    reporter = asyncio.ensure_future(report_shard_status(shard_id, sink))
+    try: await run_presets_shared(preset_items, start_offsets)
+    finally: reporter.cancel()
+
+def shard_worker_main(shard_id, preset_items, start_offsets, presets_file, conn):
+    global log_sink, presets, presets_path
+    log_sink = IPCLogSink(conn); presets = dict(preset_items); presets_path = presets_file
+    install_profile_signal()
+    start_presets_watcher() # Each worker reloads its own presets
+    try: asyncio.run(run_shard(shard_id, preset_items, start_offsets, log_sink))
+    except KeyboardInterrupt: pass
+    finally: log_sink.close() # multiprocessing children skip atexit; send what is still queued
+
+class ShardSupervisor:
+    def __init__(self, preset_items, workers=SHARD_WORKERS, stagger=0):
+        count = max(1, min(workers or os.cpu_count() or 1, len(preset_items)))
+        self.ctx = multiprocessing.get_context("spawn")
+        self.shards = [preset_items[i::count] for i in range(count)] # Round-robin keeps shard sizes within one preset
+        self.start_offsets = [[k * stagger for k in range(i, len(preset_items), count)] for i in range(count)] # Logins stay staggered across workers
+        self.processes = [None] * count; self.conns = [None] * count
+        self.crashes = [0] * count; self.restart_at = [None] * count; self.status = {}
+
+    def start(self):
+        for shard_id in range(len(self.shards)): self._spawn(shard_id)
+        threading.Thread(target=self._run, name="mudae-shard-supervisor", daemon=True).start()
+
+    def preset_count(self):
+        return sum(len(items) for items in self.shards)
+
+    def _spawn(self, shard_id):
+        parent_conn, child_conn = self.ctx.Pipe(duplex=False)
+        process = self.ctx.Process(target=shard_worker_main, args=(shard_id, self.shards[shard_id], self.start_offsets[shard_id], presets_path, child_conn), name=f"mudae-shard-{shard_id}", daemon=True)
+        process.start(); child_conn.close()
+        self.processes[shard_id] = process; self.conns[shard_id] = parent_conn; self.restart_at[shard_id] = None
+        print_log(f"[{BOT_NAME}] Shard {shard_id} started (pid {process.pid}): {', '.join(name for name, _ in self.shards[shard_id])}", "Supervisor", "INFO")
+
+    def _receive(self, shard_id, conn):
+        try: item = conn.recv()
+        except (EOFError, OSError): conn.close(); self.conns[shard_id] = None; return # Worker exited; _check_workers restarts it
+        if item[0] == "log": _, created, preset_name, log_type, message = item; log_sink.emit(message, preset_name, log_type, created)
+        elif item[0] == "status": self.status[shard_id] = dict(item[2], received_at=time.time())
+        if item[0] == "status" and self.crashes[shard_id]: self.crashes[shard_id] = 0 # Reported in: it survived startup
+
+    def _check_workers(self):
+        now = time.monotonic()
+        for shard_id, process in enumerate(self.processes):
+            if self.restart_at[shard_id] is not None:
+                if now >= self.restart_at[shard_id]: self._spawn(shard_id)
+                continue
+            if process.is_alive(): continue
+            delay = min(PRESET_RESTART_DELAY, SHARD_RESTART_DELAY * 2 ** self.crashes[shard_id]); self.crashes[shard_id] += 1
+            self.restart_at[shard_id] = now + delay; self.status.pop(shard_id, None)
+            print_log(f"[{BOT_NAME}] Shard {shard_id} (pid {process.pid}) exited with code {process.exitcode}. Restarting in {delay}s...", "Supervisor", "ERROR")
+
+    def _run(self):
+        while True:
+            conns = {conn: shard_id for shard_id, conn in enumerate(self.conns) if conn is not None}
+            if not conns: time.sleep(1)
+            else:
+                for conn in multiprocessing.connection.wait(list(conns), timeout=1): self._receive(conns[conn], conn)
+            self._check_workers()
+
+def shard_status_snapshot():
+    return [{"shard": shard_id, "presets": [name for name, _ in supervisor.shards[shard_id]], "alive": process.is_alive(), "pid": process.pid,
+             "crashes": supervisor.crashes[shard_id], **supervisor.status.get(shard_id, {})}
+            for supervisor in list(shard_supervisors) for shard_id, process in enumerate(supervisor.processes)]
+
+def start_presets_sharded(preset_items, workers=SHARD_WORKERS, stagger=0):
+    valid_items = []
+    for preset_name, preset_data in preset_items:
+        if not validate_preset(preset_name, preset_data): print(f"\033[91mSkip preset '{preset_name}' (config err).\033[0m"); continue
+        valid_items.append((preset_name, preset_data))
+    if not valid_items: return None
+    supervisor = ShardSupervisor(valid_items, workers, stagger)
+    print(f"\033[92mSharding {len(valid_items)} presets over {len(supervisor.shards)} worker processes\033[0m")
+    supervisor.start(); shard_supervisors.append(supervisor)
+    return supervisor
+
 def show_banner():
     banner = r"""
   __  __ _    _ _____          _____  ______ __  __  ____ _______ ______
@@ -648,7 +2224,18 @@ def validate_preset(preset_name, preset_data):
     miss_k = [k for k in req_k if k not in preset_data]
     if miss_k: print(f"\033[91mErr '{preset_name}': Missing: {','.join(miss_k)}\033[0m"); return False
     if not isinstance(preset_data["token"],str) or not preset_data["token"]: print(f"\033[91mErr '{preset_name}': 'token' bad.\033[0m"); return False
-    if not isinstance(preset_data["channel_id"],int): print(f"\033[91mErr '{preset_name}': 'channel_id' bad.\033[0m"); return False
+    if not isinstance(preset_data["channel_id"],(int,list)) or preset_data["channel_id"] == []: print(f"\033[91mErr '{preset_name}': 'channel_id' bad.\033[0m"); return False
+    if isinstance(preset_data["channel_id"], list):
+        for entry in preset_data["channel_id"]:
+            if not isinstance(entry, (int, dict)) or (isinstance(entry, dict) and not isinstance(entry.get("id"), int)):
+                print(f"\033[91mErr '{preset_name}': 'channel_id' entries must be channel IDs or objects with an 'id'.\033[0m"); return False
+            unknown = [key for key in (entry if isinstance(entry, dict) else ()) if key != "id" and key not in CHANNEL_SETTINGS]
+            if unknown: print(f"\033[91mWarn in preset '{preset_name}': channel {entry['id']} has settings that can't be set per channel: {', '.join(unknown)}\033[0m")
+            bad = [key for key in (entry if isinstance(entry, dict) else ()) if key in CHANNEL_SETTINGS and not (
+                isinstance(entry[key], bool) if key.endswith("_mode") else isinstance(entry[key], (int, float)) and not isinstance(entry[key], bool) and entry[key] >= 0)]
+            if bad: print(f"\033[91mWarn in preset '{preset_name}': channel {entry['id']}: {', '.join(bad)} should be true/false for modes, a number >= 0 otherwise.\033[0m")
+        channel_ids = [channel_id for channel_id, _ in preset_channels(preset_data["channel_id"])]
+        if len(set(channel_ids)) != len(channel_ids): print(f"\033[91mErr '{preset_name}': 'channel_id' lists a channel twice.\033[0m"); return False
     if not isinstance(preset_data["min_kakera"],int) or preset_data["min_kakera"]<0: print(f"\033[91mErr '{preset_name}': 'min_kakera' bad (number >= 0).\033[0m"); return False
     if not isinstance(preset_data["delay_seconds"],(int,float)) or preset_data["delay_seconds"]<0: print(f"\033[91mErr '{preset_name}': 'delay_seconds' bad (number >= 0).\033[0m"); return False
     if "rolling" in preset_data and not isinstance(preset_data["rolling"], bool):
@@ -667,13 +2254,25 @@ def validate_preset(preset_name, preset_data):
         print(f"\033[91mWarn in preset '{preset_name}': 'kakera_reaction_snipe_mode' should be true or false.\033[0m")
     if "kakera_reaction_snipe_delay" in preset_data and (not isinstance(preset_data["kakera_reaction_snipe_delay"], (int, float)) or preset_data["kakera_reaction_snipe_delay"] < 0):
         print(f"\033[91mWarn in preset '{preset_name}': 'kakera_reaction_snipe_delay' should be a non-negative number.\033[0m")
+    if "wishlist_fold_accents" in preset_data and not isinstance(preset_data["wishlist_fold_accents"], bool):
+        print(f"\033[91mWarn in preset '{preset_name}': 'wishlist_fold_accents' should be true or false.\033[0m")
+    if "persist_state" in preset_data and not isinstance(preset_data["persist_state"], bool):
+        print(f"\033[91mWarn in preset '{preset_name}': 'persist_state' should be true or false.\033[0m")
+    if "claim_window" in preset_data and (not isinstance(preset_data["claim_window"], (int, float)) or preset_data["claim_window"] < 0):
+        print(f"\033[91mWarn in preset '{preset_name}': 'claim_window' should be a non-negative number.\033[0m")
+    if "record_rolls" in preset_data and not isinstance(preset_data["record_rolls"], bool):
+        print(f"\033[91mWarn in preset '{preset_name}': 'record_rolls' should be true or false.\033[0m")
+    if "lean" in preset_data and not isinstance(preset_data["lean"], bool):
+        print(f"\033[91mWarn in preset '{preset_name}': 'lean' should be true or false.\033[0m")
     return True
 
 def main_menu():
+    import inquirer # Interactive-only dependency; headless runs never import it
     show_banner(); active_threads = []
     while True:
         active_threads = [t for t in active_threads if t.is_alive()]
-        questions = [inquirer.List('option',message=f"Select ({len(active_threads)} bots running):",choices=['Select and Run Preset','Select and Run Multiple Presets','Exit'])]
+        running_count = len(active_threads) + len(shared_loop_presets) + sum(supervisor.preset_count() for supervisor in shard_supervisors)
+        questions = [inquirer.List('option',message=f"Select ({running_count} bots running):",choices=['Select and Run Preset','Select and Run Multiple Presets','Run Multiple Presets on Shared Loop','Run Multiple Presets Sharded Across Processes','Exit'])]
         try:
             answers = inquirer.prompt(questions)
             if not answers: print("\nExiting..."); break
@@ -693,12 +2292,121 @@ def main_menu():
                     for preset_name in multi_preset_answers['presets']:
                         thread = start_preset_thread(preset_name, presets[preset_name])
                         if thread: active_threads.append(thread)
+            elif option == 'Run Multiple Presets on Shared Loop':
+                preset_list = list(presets.keys())
+                if not preset_list: print("\033[91mNo presets in presets.json.\033[0m"); continue
+                multi_preset_answers = inquirer.prompt([inquirer.Checkbox('presets',message="Select presets to run on one shared event loop (use Spacebar, then Enter):",choices=preset_list)])
+                if multi_preset_answers:
+                    start_presets_shared([(preset_name, presets[preset_name]) for preset_name in multi_preset_answers['presets']])
+            elif option == 'Run Multiple Presets Sharded Across Processes':
+                preset_list = list(presets.keys())
+                if not preset_list: print("\033[91mNo presets in presets.json.\033[0m"); continue
+                multi_preset_answers = inquirer.prompt([inquirer.Checkbox('presets',message="Select presets to spread over worker processes (use Spacebar, then Enter):",choices=preset_list)])
+                if multi_preset_answers:
+                    start_presets_sharded([(preset_name, presets[preset_name]) for preset_name in multi_preset_answers['presets']])
             elif option == 'Exit': print("\033[1;32mExiting MudaRemote...\033[0m"); break
         except KeyboardInterrupt: print("\nCtrl+C detected. Exiting..."); break
         except Exception as e: print(f"\033[91mAn error occurred in the main menu: {e}\033[0m")
 
-if __name__ == "__main__":
+def run_headless(preset_names, mode="threads", stagger=0, workers=SHARD_WORKERS):
+    # Non-interactive start (systemd, containers): runs until the process is stopped
+    if preset_names in ([], ["all"]): preset_names = list(presets)
+    unknown = [name for name in preset_names if name not in presets]
+    if unknown: print(f"\033[91mUnknown preset(s): {', '.join(unknown)}. Available: {', '.join(presets)}\033[0m"); return 2
+    preset_items = [(name, presets[name]) for name in preset_names]
+    print_log(f"[{BOT_NAME}] Headless start: {len(preset_items)} presets, mode={mode}, stagger={stagger}s", "System", "INFO")
+    if mode == "shared":
+        future = start_presets_shared(preset_items, stagger)
+        if future is None: return 1
+        future.result(); return 0
+    if mode == "sharded":
+        if start_presets_sharded(preset_items, workers, stagger) is None: return 1
+        while True: time.sleep(3600)
+    threads = []
+    for i, (preset_name, preset_data) in enumerate(preset_items):
+        if i and stagger: time.sleep(stagger)
+        thread = start_preset_thread(preset_name, preset_data)
+        if thread: threads.append(thread)
+    if not threads: return 1
+    while any(thread.is_alive() for thread in threads): time.sleep(1)
+    return 0
+
+def print_table(headers, rows):
+    rows = [["" if value is None else str(value) for value in row] for row in rows]
+    widths = [max([len(header)] + [len(row[i]) for row in rows]) for i, header in enumerate(headers)]
+    print("  ".join(header.ljust(width) for header, width in zip(headers, widths)).rstrip())
+    for row in rows: print("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+
+def run_history_command(args):
+    # Read-only queries against the roll history; safe while bots are writing to it
+    path = args.db or ROLL_HISTORY_PATH
+    if not path or not os.path.exists(path): print(f"\033[91mNo roll history at {path}. It is created once a bot has seen a roll.\033[0m"); return 1
+    db = open_roll_history(path, readonly=True); since = time.time() - args.days * 86400 if args.days else 0
+    def when(timestamp): return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")
     try:
-        with open("logs.txt", "a", encoding='utf-8') as f: f.write(f"\n--- MudaRemote Log Start: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---\n")
-    except Exception as e: print(f"\033[91mCould not initialize log file: {e}\033[0m")
-    main_menu()
+        if args.history_command == "top":
+            column = "series" if args.series else "character"
+            # Time-range indexes cover these columns; without a channel the planner would otherwise walk rolls_character
+            source = "rolls" if args.series else "rolls INDEXED BY rolls_channel_time" if args.channel else "rolls INDEXED BY rolls_time"
+            where = "rolled_at >= ?" + (" AND channel_id = ?" if args.channel else ""); params = [since] + ([args.channel] if args.channel else [])
+            rows = db.execute(f"SELECT {column}, MAX(kakera), COUNT(*), MAX(rolled_at) FROM {source} WHERE {where} GROUP BY {column} COLLATE NOCASE "
+                              f"ORDER BY MAX(kakera) DESC, COUNT(*) DESC LIMIT ?", params + [args.limit]).fetchall()
+            print_table([column.capitalize(), "Max kakera", "Seen", "Last seen"], [(name, kakera, seen, when(last)) for name, kakera, seen, last in rows])
+        elif args.history_command == "find":
+            column = "series" if args.series else "character"
+            rows = db.execute(f"SELECT rolled_at, channel_id, character, series, kakera, roller, claimed, claim_action FROM rolls WHERE {column} LIKE ? ESCAPE '\\' AND rolled_at >= ? "
+                              f"ORDER BY rolled_at DESC LIMIT ?", (re.sub(r"([\\%_])", r"\\\1", args.name) + "%", since, args.limit)).fetchall()
+            print_table(["Rolled", "Channel", "Character", "Series", "Kakera", "Roller", "Claimed"],
+                        [(when(t), channel, character, series, kakera, roller, action if claimed else "") for t, channel, character, series, kakera, roller, claimed, action in rows])
+        else:
+            total, first, last, claimed = db.execute("SELECT COUNT(*), MIN(rolled_at), MAX(rolled_at), SUM(claimed) FROM rolls WHERE rolled_at >= ?", (since,)).fetchone()
+            print(f"{total} rolls" + (f" from {when(first)} to {when(last)}, {claimed or 0} claimed by us" if total else ""))
+            rows = db.execute("SELECT channel_id, COUNT(*), MAX(kakera), SUM(claimed), SUM(kakera_clicked) FROM rolls WHERE rolled_at >= ? GROUP BY channel_id ORDER BY 2 DESC", (since,)).fetchall()
+            if rows: print(); print_table(["Channel", "Rolls", "Max kakera", "Claimed", "Kakera clicked"], rows)
+    except sqlite3.Error as e: print(f"\033[91mRoll history query failed: {e}\033[0m"); return 1
+    finally: db.close()
+    return 0
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="MudaRemote. Without a command, the interactive menu starts.")
+    parser.add_argument("--config", default=PRESETS_FILE, help="Presets file (default: presets.json)")
+    sub = parser.add_subparsers(dest="command")
+    run = sub.add_parser("run", help="Start presets without the interactive menu")
+    run.add_argument("presets", nargs="*", default=["all"], help="Preset names, or 'all' (default)")
+    run.add_argument("--mode", choices=("threads", "shared", "sharded"), default="threads", help="One thread per preset, one shared event loop, or worker processes")
+    run.add_argument("--stagger", type=float, default=0, help="Seconds between preset logins")
+    run.add_argument("--workers", type=int, default=SHARD_WORKERS, help="Worker processes for --mode sharded (0 = one per CPU core)")
+    history = sub.add_parser("history", help="Query the roll history database")
+    history.add_argument("--db", help="Roll history file (default: state/roll_history.sqlite3)")
+    history_sub = history.add_subparsers(dest="history_command", required=True)
+    top = history_sub.add_parser("top", help="Highest-kakera characters (or series) seen")
+    top.add_argument("--channel", type=int, help="Only rolls in this channel ID")
+    top.add_argument("--days", type=float, default=7, help="Look back this many days (0 = all time, default 7)")
+    top.add_argument("--series", action="store_true", help="Group by series instead of character")
+    top.add_argument("--limit", type=int, default=20)
+    find = history_sub.add_parser("find", help="Rolls of a character (or series) by name prefix, newest first")
+    find.add_argument("name")
+    find.add_argument("--series", action="store_true", help="Match the series instead of the character")
+    find.add_argument("--days", type=float, default=0, help="Look back this many days (0 = all time)")
+    find.add_argument("--limit", type=int, default=50)
+    stats = history_sub.add_parser("stats", help="Roll counts per channel")
+    stats.add_argument("--days", type=float, default=0, help="Look back this many days (0 = all time)")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args(); presets_path = args.config
+    if args.command == "history": sys.exit(run_history_command(args))
+    try: presets = load_presets(presets_path)
+    except FileNotFoundError:
+        print(f"{presets_path} file not found. Please create it and enter the necessary information.")
+        sys.exit(1)
+    except json.JSONDecodeError:
+        print(f"Error decoding {presets_path}. Please check the file format.")
+        sys.exit(1)
+    print_log("--- MudaRemote Log Start ---", "System", "INFO") # Through the log sink, so it lands in the configured file and format
+    start_metrics_exporters(); install_profile_signal()
+    if args.command == "run":
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # systemd/docker stop: exit normally so queued logs are flushed
+        try: sys.exit(run_headless(args.presets, args.mode, args.stagger, args.workers))
+        except KeyboardInterrupt: print("\nCtrl+C detected. Exiting...")
+    else: main_menu()
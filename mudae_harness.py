@@ -0,0 +1,674 @@
+import sys
+import asyncio
+import argparse
+import gc
+import itertools
+import json
+import math
+import os
+import random
+import time
+import tracemalloc
+import types
+import discord
+import mudae_bot as mb
+
+# Local stand-in for Discord and Mudae. A FakeChannel/FakeMudae pair answers the bot's commands with
+# synthetic (or recorded) $tu replies, roll embeds and buttons, and a Recorder keeps every send, click
+# and reaction the bot makes with a timestamp. No token or network is needed.
+
+HARNESS_CHANNEL_ID = 5000
+HARNESS_USER_ID = 4242
+# Delay (seconds) between a command reaching FakeMudae and its reply being dispatched to the bot
+MUDAE_LATENCY = 0.02
+# Real seconds between the reset scheduler's checks of the virtual clock when the harness speeds time up
+SCHEDULER_POLL = 0.002
+# Reconstructed $tu replies with the fields the bot must read from them (see load_tu_fixtures)
+TU_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tu_fixtures.jsonl")
+
+TU_TEMPLATES = {
+    "en": {
+        "can": "**{user}**, you __can__ claim right now! The next claim reset is in **{claim_h}h {claim_m}** min.",
+        "cant": "**{user}**, you can't claim for another **{claim_h}h {claim_m}** min.",
+        "rolls": "You have **{rolls}** rolls left. Next rolls reset in **{rolls_m}** min.",
+    },
+    "pt": {
+        "can": "**{user}**, você __pode__ se casar agora mesmo! A próxima reinicialização é em **{claim_h}h {claim_m}** min.",
+        "cant": "**{user}**, calma aí, falta um tempo antes que você possa se casar novamente **{claim_h}h {claim_m}** min.",
+        "rolls": "Você tem **{rolls}** rolls restantes. A próxima reinicialização é em **{rolls_m}** min.",
+    },
+}
+
+SERIES_POOL = ["Kimetsu no Yaiba", "Re:Zero kara Hajimeru Isekai Seikatsu", "Chainsaw Man", "Darling in the FranXX",
+               "Pokémon", "Shingeki no Kyojin", "Jujutsu Kaisen", "One Piece", "Naruto", "Spy x Family"]
+
+# Preset used when presets.json is missing or has no usable entry
+DEFAULT_PRESET = {
+    "token": "harness", "prefix": "$$", "channel_id": HARNESS_CHANNEL_ID, "roll_command": "wa", "delay_seconds": 1,
+    "mudae_prefix": "$", "min_kakera": 100, "rolling": True, "key_mode": False, "start_delay": 0, "roll_speed": 0.4,
+    "snipe_mode": True, "wishlist": ["Nezuko Kamado", "Rem"], "snipe_delay": 2,
+    "series_snipe_mode": True, "series_wishlist": ["Kimetsu no Yaiba", "Re:Zero"], "series_snipe_delay": 2,
+    "reactive_snipe_on_own_rolls": True, "kakera_snipe_mode": True, "kakera_snipe_threshold": 150,
+    "kakera_reaction_snipe_mode": True, "kakera_reaction_snipe_delay": 0.75,
+}
+
+
+def next_snowflake(_counter=itertools.count()):
+    # Current-time snowflakes (on the harness's virtual clock when one is active), so the bot's TTL-based dedup caches treat them as fresh messages
+    return ((int(mb.time.time() * 1000) - mb.DISCORD_EPOCH_MS) << 22) | (next(_counter) & 0x3FFFFF)
+
+
+class ScaledAsyncio(types.ModuleType):
+    # Stands in for mudae_bot's `asyncio` so the bot's fixed sleeps (post-roll, snipe delays, roll_speed pacing)
+    # run time_scale times as long; wait_for timeouts and everything else are untouched
+    def __init__(self, time_scale):
+        super().__init__("asyncio"); self.time_scale = time_scale
+
+    def __getattr__(self, name):
+        return getattr(asyncio, name)
+
+    async def sleep(self, delay, result=None):
+        return await asyncio.sleep(delay * self.time_scale, result)
+
+    async def wait(self, fs, timeout=None, **kwargs):
+        # The claim arbiter waits out snipe delays with asyncio.wait so an edit can cut them short
+        return await asyncio.wait(fs, timeout=None if timeout is None else timeout * self.time_scale, **kwargs)
+
+
+class VirtualClock:
+    # Replaces mb.boottime, and through VirtualTime mb.time.time: both advance 1/time_scale times as fast as the real
+    # clock, in step with the scaled sleeps, so reset minutes derived from the wall clock move with the boot clock
+    def __init__(self, time_scale, clock, wall_start=None):
+        self.time_scale = time_scale; self.clock = clock; self.real_start = time.monotonic(); self.start = clock()
+        self.wall_start = time.time() if wall_start is None else wall_start
+
+    def elapsed(self):
+        return (time.monotonic() - self.real_start) / self.time_scale
+
+    def __call__(self):
+        return self.start + self.elapsed()
+
+    def wall(self):
+        return self.wall_start + self.elapsed()
+
+
+class VirtualTime(types.ModuleType):
+    # Stands in for mudae_bot's `time` module; only time() changes
+    def __init__(self, clock):
+        super().__init__("time"); self.clock = clock
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def time(self):
+        return self.clock.wall()
+
+
+class Recorder:
+    def __init__(self):
+        self.started = time.perf_counter(); self.events = []; self.changed = asyncio.Event()
+
+    def record(self, kind, **detail):
+        detail["t"] = time.perf_counter() - self.started; detail["kind"] = kind
+        self.events.append(detail); self.changed.set()
+
+    def of(self, kind):
+        return [e for e in self.events if e["kind"] == kind]
+
+    def sent_commands(self):
+        return [e["content"] for e in self.of("send")]
+
+    def click_latencies(self):
+        # Embed-to-click latency: the message reaching the bot to the click/reaction on it, by button type
+        delivered = {e["message_id"]: e["t"] for e in self.of("deliver")}
+        result = {}
+        for e in self.events:
+            if e["kind"] in ("click", "react") and e["message_id"] in delivered:
+                result.setdefault(e.get("button", "react"), []).append(e["t"] - delivered[e["message_id"]])
+        return result
+
+
+class FakeUser:
+    def __init__(self, user_id, name, bot=False):
+        self.id = user_id; self.name = name; self.display_name = name; self.bot = bot
+
+    def __str__(self):
+        return self.name
+
+
+class FakeButton:
+    def __init__(self, message, emoji_name, kind):
+        self.message = message; self.emoji = types.SimpleNamespace(name=emoji_name); self.kind = kind
+
+    async def click(self):
+        channel = self.message.channel
+        channel.recorder.record("click", message_id=self.message.id, button=self.kind, emoji=self.emoji.name)
+        if channel.mudae: channel.mudae.on_click(self)
+
+
+class FakeMessage:
+    def __init__(self, channel, author, content="", embed=None, buttons=()):
+        self.id = next_snowflake(); self.channel = channel; self.author = author; self.content = content
+        self.embeds = [embed] if embed is not None else []
+        self.created_at = discord.utils.snowflake_time(self.id)
+        kinds = {e: "claim" for e in mb.CLAIM_EMOJIS}; kinds.update({e: "kakera" for e in mb.KAKERA_EMOJIS})
+        self.components = [types.SimpleNamespace(children=[FakeButton(self, b, kinds.get(b, "other")) for b in buttons])] if buttons else []
+
+    async def add_reaction(self, emoji):
+        self.channel.recorder.record("react", message_id=self.id, emoji=str(emoji))
+
+
+class FakeChannel(discord.TextChannel):
+    # Passes on_ready's isinstance check; only the attributes and calls the bot uses are implemented
+    def __init__(self, client, recorder, channel_id=HARNESS_CHANNEL_ID, name="harness"):
+        self.id = channel_id; self.name = name; self.guild = types.SimpleNamespace(id=1, me=client.user, subscribe=self.subscribe)
+        self.client = client; self.recorder = recorder; self.mudae = None; self.messages = []
+
+    def permissions_for(self, obj):
+        return discord.Permissions.all()
+
+    async def subscribe(self, **features):
+        self.recorder.record("subscribe", guild_id=self.guild.id, **features)
+
+    async def send(self, content=None, **kwargs):
+        message = FakeMessage(self, self.client.user, content or "")
+        self.messages.append(message); self.recorder.record("send", message_id=message.id, content=message.content)
+        if self.mudae: self.mudae.on_command(message)
+        return message
+
+    def deliver(self, message):
+        # Gateway side: store the message and dispatch on_message to the bot as its own task
+        self.messages.append(message)
+        self.recorder.record("deliver", message_id=message.id, author=message.author.id, embed=bool(message.embeds))
+        self.client.dispatch("message", message)
+
+    def deliver_edit(self, message, data):
+        # Gateway side of a Mudae edit: on_raw_message_edit gets the raw update fields and the updated message
+        self.recorder.record("edit", message_id=message.id, fields=sorted(data))
+        self.client.dispatch("raw_message_edit", types.SimpleNamespace(message_id=message.id, channel_id=self.id, guild_id=self.guild.id, data=data,
+                                                                       message=message, cached_message=None))
+
+    async def history(self, *, limit=100, before=None, after=None, around=None, oldest_first=None):
+        self.recorder.record("history", limit=limit)
+        messages = self.messages
+        if after is not None: messages = [m for m in messages if m.created_at > after]
+        messages = messages if oldest_first else list(reversed(messages))
+        for message in messages[:limit]: yield message
+
+
+class FakeMudae:
+    # Scripted Mudae: answers $tu from its own claim/roll state, answers roll commands with embeds,
+    # reacts to claim and kakera clicks. Rolls come from `rolls` (recorded) or a seeded generator.
+    def __init__(self, channel, roll_command="wa", prefix="$", lang="en", claim_available=True, rolls_left=10,
+                 claim_reset_minutes=135, rolls_reset_minutes=35, wishlist=(), wish_rate=0.1, kakera_rate=0.3,
+                 rolls=None, seed=0, latency=MUDAE_LATENCY, auto_reset=False, claim_interval_minutes=180, rolls_interval_minutes=60):
+        self.channel = channel; self.user = FakeUser(mb.TARGET_BOT_ID, "Mudae", bot=True)
+        self.roll_command = roll_command; self.prefix = prefix; self.lang = lang; self.latency = latency
+        self.claim_available = claim_available; self.rolls_left = rolls_left
+        self.claim_reset_minutes = claim_reset_minutes; self.rolls_reset_minutes = rolls_reset_minutes
+        self.wishlist = list(wishlist); self.wish_rate = wish_rate; self.kakera_rate = kakera_rate
+        self.rolls = iter(rolls) if rolls is not None else None; self.random = random.Random(seed); self.counter = itertools.count(1)
+        self.claimed = set()
+        # auto_reset: the claim right and the roll allowance come back when their reset deadlines pass on
+        # mb.boottime(), then the next deadline is one interval later (like Mudae's fixed reset schedule)
+        self.auto_reset = auto_reset; self.rolls_per_reset = rolls_left
+        self.claim_interval = claim_interval_minutes * 60; self.rolls_interval = rolls_interval_minutes * 60
+        self.claim_deadline = mb.reset_minute_boottime(claim_reset_minutes); self.rolls_deadline = mb.reset_minute_boottime(rolls_reset_minutes)
+
+    def tick(self):
+        if not self.auto_reset: return
+        now = mb.boottime()
+        while now >= self.claim_deadline: self.claim_available = True; self.claim_deadline += self.claim_interval
+        while now >= self.rolls_deadline: self.rolls_left = self.rolls_per_reset; self.rolls_deadline += self.rolls_interval
+
+    def minutes_until(self, deadline):
+        # Whole minutes as Mudae shows them; the deadline is re-anchored to the minute the bot will derive
+        minutes = max(1, math.ceil((deadline - mb.boottime()) / 60))
+        return minutes, mb.reset_minute_boottime(minutes)
+
+    def reply_later(self, message):
+        asyncio.get_running_loop().call_later(self.latency, self.channel.deliver, message)
+
+    def mark_claimed(self, message, owner_name):
+        # What Mudae does to a roll once someone marries it: owner footer, buttons gone
+        embed = message.embeds[0]; embed.set_footer(text=f"Belongs to {owner_name}"); message.components = []
+        data = {"id": str(message.id), "author": {"id": str(mb.TARGET_BOT_ID)}, "embeds": [embed.to_dict()], "components": []}
+        asyncio.get_running_loop().call_later(self.latency, self.channel.deliver_edit, message, data)
+
+    def tu_text(self, user_name):
+        claim_minutes, rolls_minutes = self.claim_reset_minutes, self.rolls_reset_minutes
+        if self.auto_reset:
+            claim_minutes, self.claim_deadline = self.minutes_until(self.claim_deadline)
+            rolls_minutes, self.rolls_deadline = self.minutes_until(self.rolls_deadline)
+        t = TU_TEMPLATES[self.lang]; h, m = divmod(claim_minutes, 60)
+        fields = dict(user=user_name, claim_h=h, claim_m=m, rolls=self.rolls_left, rolls_m=rolls_minutes)
+        return (t["can"] if self.claim_available else t["cant"]).format(**fields) + "\n" + t["rolls"].format(**fields)
+
+    def make_roll(self):
+        if self.rolls is not None:
+            spec = next(self.rolls, None)
+            if spec is not None: return spec
+        n = next(self.counter)
+        name = self.random.choice(self.wishlist) if self.wishlist and self.random.random() < self.wish_rate else f"Character {n}"
+        buttons = [mb.CLAIM_EMOJIS[0]]
+        if self.random.random() < self.kakera_rate: buttons.append(self.random.choice(mb.KAKERA_EMOJIS))
+        return {"name": name, "series": self.random.choice(SERIES_POOL), "kakera": self.random.randint(30, 800), "buttons": buttons}
+
+    def roll_message(self, spec):
+        return FakeMessage(self.channel, self.user, spec.get("content", ""), embed=roll_embed(spec), buttons=spec.get("buttons", ()))
+
+    def on_command(self, message):
+        text = message.content
+        if not text.startswith(self.prefix): return
+        command = text[len(self.prefix):].split(" ")[0].lower(); self.tick()
+        if command == "tu":
+            self.reply_later(FakeMessage(self.channel, self.user, self.tu_text(message.author.name)))
+        elif command == self.roll_command:
+            if self.rolls_left <= 0:
+                self.reply_later(FakeMessage(self.channel, self.user, f"**{message.author.name}**, the roulette is limited to 10 uses per hour."))
+                return
+            self.rolls_left -= 1; self.reply_later(self.roll_message(self.make_roll()))
+
+    def on_click(self, button):
+        message = button.message; self.tick()
+        if button.kind == "claim" and self.claim_available and message.id not in self.claimed:
+            self.claim_available = False; self.claimed.add(message.id)
+            name = message.embeds[0].author.name
+            self.reply_later(FakeMessage(self.channel, self.user, f"💖 **{self.channel.client.user.name}** and **{name}** are now married! 💖"))
+            self.mark_claimed(message, self.channel.client.user.name)
+        elif button.kind == "kakera":
+            self.reply_later(FakeMessage(self.channel, self.user, f"**{self.channel.client.user.name}** +{self.random.randint(50, 300)} <:kakera:469835869059153940>kakera"))
+
+
+def roll_embed(spec):
+    embed = discord.Embed(description=spec.get("description") or f"{spec.get('series', '')}\n**{spec.get('kakera', 0):,}**<:kakera:469835869059153940>")
+    if spec.get("name"): embed.set_author(name=spec["name"])
+    return embed
+
+
+def load_tu_fixtures(path=TU_FIXTURES):
+    # JSON lines: {"source": "captured" (a real Mudae reply) or "reconstructed" (written from Mudae's reply format),
+    #              "lang", "note", "user", "content", "match": match_tu_response result,
+    #              "expect": {"claim_available", "claim_reset", "rolls_left", "rolls_reset"} or null when it is not a $tu reply}
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_recording(path):
+    # JSON lines: {"after": seconds since previous, "name", "series", "kakera" | "description", "buttons", "content",
+    #              "claimed_by": someone else marrying the roll, "claimed_after": seconds after it appeared}
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class GatewayReplay:
+    # Raw gateway payloads (READY, messages, presences, typing) fed through discord.py's own parsers, so the client's
+    # caches fill the way they do on a live account. Guild 0 holds the target channel; Mudae rolls there come without
+    # buttons (already claimed), so the bot classifies them but never calls the network.
+    TIMESTAMP = "2024-01-01T00:00:00+00:00"
+
+    def __init__(self, client, guilds=20, channels=30, members=200, emojis=50, seed=0):
+        self.client = client; self.state = client._connection; self.random = random.Random(seed)
+        self.guilds = []; ids = itertools.count(10 ** 17)
+        for g in range(guilds):
+            guild_id = next(ids)
+            channel_ids = [HARNESS_CHANNEL_ID if g == 0 and c == 0 else next(ids) for c in range(channels)]
+            self.guilds.append({"id": guild_id, "channels": channel_ids, "members": [next(ids) for _ in range(members)], "emojis": [next(ids) for _ in range(emojis)]})
+
+    @staticmethod
+    def user(user_id, name=None, bot=False):
+        return {"id": str(user_id), "username": name or f"user{user_id}", "discriminator": "0", "avatar": None, "global_name": name, "bot": bot}
+
+    def member(self, user_id):
+        return {"user_id": str(user_id), "roles": [], "joined_at": self.TIMESTAMP, "deaf": False, "mute": False}
+
+    def ready(self):
+        guilds = []; users = [self.user(mb.TARGET_BOT_ID, "Mudae", bot=True)]
+        for g in self.guilds:
+            guild_id = str(g["id"]); users += [self.user(m) for m in g["members"]]
+            guilds.append({"id": guild_id, "name": f"Guild {guild_id}", "owner_id": str(g["members"][0]), "member_count": len(g["members"]) + 1,
+                           "features": [], "stickers": [], "threads": [], "stage_instances": [], "guild_scheduled_events": [],
+                           "channels": [{"id": str(c), "type": 0, "name": f"channel-{i}", "position": i, "permission_overwrites": [], "guild_id": guild_id}
+                                        for i, c in enumerate(g["channels"])],
+                           "roles": [{"id": guild_id, "name": "@everyone", "permissions": str(discord.Permissions.all().value), "position": 0, "color": 0,
+                                      "hoist": False, "managed": False, "mentionable": False}],
+                           "emojis": [{"id": str(e), "name": f"emoji{e % 1000}", "roles": [], "require_colons": True, "managed": False, "animated": False,
+                                       "available": True} for e in g["emojis"]]})
+        self.state.parsers["READY"]({"v": 9, "user": self.user(HARNESS_USER_ID, "HarnessUser"), "guilds": guilds, "users": users, "session_id": "replay",
+                                     "merged_members": [[self.member(HARNESS_USER_ID)] for _ in self.guilds], "relationships": [], "private_channels": [],
+                                     "read_state": {"entries": [], "version": 0}, "user_guild_settings": {"entries": [], "version": 0}, "user_settings_proto": ""})
+        self.state.parsers["READY_SUPPLEMENTAL"]({"guilds": [{"id": str(g["id"]), "voice_states": []} for g in self.guilds],
+                                                  "merged_members": [[self.member(m) for m in g["members"]] for g in self.guilds],
+                                                  "merged_presences": {"guilds": [[{"user_id": str(m), "status": "online", "activities": [], "client_status": {"desktop": "online"}}
+                                                                                   for m in g["members"][::2]] for g in self.guilds], "friends": []},
+                                                  "lazy_private_channels": []})
+        self.state._ready_task.cancel() # on_ready would start the bot's lifecycle; only the caches are of interest
+
+    def message(self, guild, channel_id, author, content="", embeds=()):
+        return {"id": str(next_snowflake()), "channel_id": str(channel_id), "guild_id": str(guild["id"]), "author": author, "content": content,
+                "member": {"roles": [], "joined_at": self.TIMESTAMP, "deaf": False, "mute": False}, "timestamp": self.TIMESTAMP, "edited_timestamp": None,
+                "tts": False, "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [], "embeds": list(embeds), "pinned": False,
+                "type": 0, "components": []}
+
+    def event(self):
+        # One gateway event: mostly chatter across all servers, some presence and typing updates, some Mudae rolls in the target channel
+        pick = self.random.random(); guild = self.random.choice(self.guilds); user_id = self.random.choice(guild["members"])
+        if pick < 0.1:
+            spec = {"name": f"Character {self.random.randint(1, 10 ** 6)}", "series": self.random.choice(SERIES_POOL), "kakera": self.random.randint(30, 800)}
+            self.state.parsers["MESSAGE_CREATE"](self.message(self.guilds[0], HARNESS_CHANNEL_ID, self.user(mb.TARGET_BOT_ID, "Mudae", bot=True), embeds=[roll_embed(spec).to_dict()]))
+        elif pick < 0.6:
+            self.state.parsers["MESSAGE_CREATE"](self.message(guild, self.random.choice(guild["channels"]), self.user(user_id), content=f"message {self.random.random()}"))
+        elif pick < 0.85:
+            self.state.parsers["PRESENCE_UPDATE"]({"user": {"id": str(user_id)}, "guild_id": str(guild["id"]), "status": self.random.choice(("online", "idle", "dnd")),
+                                                   "activities": [], "client_status": {"desktop": "online"}})
+        else:
+            self.state.parsers["TYPING_START"]({"channel_id": str(self.random.choice(guild["channels"])), "guild_id": str(guild["id"]), "user_id": str(user_id),
+                                                "timestamp": int(time.time()), "member": dict(self.member(user_id), user=self.user(user_id))})
+
+    async def traffic(self, events):
+        for i in range(events):
+            self.event()
+            if i % 100 == 99: await asyncio.sleep(0) # Lets the dispatched event handlers run
+
+
+class Harness:
+    def __init__(self, preset_data=None, preset_name="Harness", lang="en", time_scale=1.0, persist_state=False, record_rolls=False, wall_start=None, **mudae_kwargs):
+        # wall_start: epoch seconds the virtual wall clock starts at (default now); only used when time_scale scales the clocks
+        data = dict(DEFAULT_PRESET if preset_data is None else preset_data)
+        data.update(channel_id=HARNESS_CHANNEL_ID, start_delay=0, persist_state=persist_state, record_rolls=record_rolls)
+        self.preset_name = preset_name; self.recorder = Recorder()
+        self.previous_asyncio = mb.asyncio; self.previous_scheduler = mb.reset_scheduler; self.previous_clock = mb.boottime; self.previous_time = mb.time
+        if time_scale != 1.0: mb.asyncio = ScaledAsyncio(time_scale)
+        if 0 < time_scale != 1.0: # The real scheduler on the virtual clock; its thread re-reads that clock every SCHEDULER_POLL real seconds
+            mb.boottime = VirtualClock(time_scale, mb.boottime, wall_start); mb.time = VirtualTime(mb.boottime); mb.reset_scheduler = mb.ResetScheduler(max_sleep=SCHEDULER_POLL)
+        self.client = mb.create_bot(**mb.build_bot_kwargs(preset_name, data))
+        self.client.loop = asyncio.get_running_loop() # Normally set by login(); dispatch() schedules on it
+        self.client._connection.user = FakeUser(HARNESS_USER_ID, "HarnessUser")
+        self.channel = FakeChannel(self.client, self.recorder)
+        self.client.get_channel = lambda channel_id: self.channel if channel_id == HARNESS_CHANNEL_ID else None
+        mudae_kwargs.setdefault("latency", MUDAE_LATENCY * (time_scale or 1.0)) # Mudae answers on the same scaled clock
+        self.mudae = self.channel.mudae = FakeMudae(self.channel, roll_command=data["roll_command"], prefix=data["mudae_prefix"], lang=lang,
+                                                    wishlist=data.get("wishlist", ()), **mudae_kwargs)
+
+    def close(self):
+        mb.asyncio = self.previous_asyncio; mb.reset_scheduler = self.previous_scheduler; mb.boottime = self.previous_clock; mb.time = self.previous_time
+
+    def start(self):
+        self.client.dispatch("ready")
+
+    def external_roll(self, spec):
+        # A Mudae roll that someone else triggered (what the snipe branches react to)
+        message = self.mudae.roll_message(spec); self.channel.deliver(message); return message
+
+    async def replay(self, recording):
+        for spec in recording:
+            await asyncio.sleep(spec.get("after", 0)); message = self.external_roll(spec)
+            if spec.get("claimed_by"): asyncio.get_running_loop().call_later(spec.get("claimed_after", 0), self.mudae.mark_claimed, message, spec["claimed_by"])
+
+    async def run_until(self, predicate, timeout):
+        deadline = time.monotonic() + timeout
+        while not predicate(self.recorder):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: return False
+            self.recorder.changed.clear()
+            try: await asyncio.wait_for(self.recorder.changed.wait(), remaining)
+            except asyncio.TimeoutError: return predicate(self.recorder)
+        return True
+
+    async def stop(self):
+        # Event handler tasks the client dispatched (named "discord.py: on_<event>" by discord.py)
+        tasks = [t for t in asyncio.all_tasks() if t.get_name().startswith("discord.py") and t is not asyncio.current_task()]
+        for task in tasks: task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def harness_preset(name=None, path=mb.PRESETS_FILE):
+    try: presets = mb.load_presets(path)
+    except (OSError, ValueError): presets = {}
+    if name: return name, presets[name]
+    return next(iter(presets.items()), ("Harness", DEFAULT_PRESET))
+
+
+def percentile(values, pct):
+    if not values: return None
+    ordered = sorted(values); return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def latency_summary(values):
+    if not values: return {"n": 0}
+    return {"n": len(values), "p50_ms": round(percentile(values, 50) * 1000, 2), "p95_ms": round(percentile(values, 95) * 1000, 2), "max_ms": round(max(values) * 1000, 2)}
+
+
+# --- Benchmarks ---
+
+async def bench_on_message(preset_data, messages, match_rate):
+    # Throughput of the snipe hot path: external Mudae embeds awaited straight through on_message.
+    # Snipe delays are zeroed so matching embeds cost a full classify + claim click.
+    data = dict(preset_data, snipe_delay=0, series_snipe_delay=0, kakera_reaction_snipe_delay=0)
+    harness = Harness(data, time_scale=0.0, wish_rate=match_rate)
+    try:
+        specs = [harness.mudae.make_roll() for _ in range(messages)]
+        if match_rate == 0:
+            for spec in specs: spec["series"] = "Unlisted Series"; spec["kakera"] = min(spec["kakera"], max(0, harness.client.kakera_snipe_threshold - 1)); spec["buttons"] = spec["buttons"][:1]
+        batch = [harness.mudae.roll_message(spec) for spec in specs]
+        started = time.perf_counter()
+        for message in batch: await harness.client.on_message(message)
+        elapsed = time.perf_counter() - started
+        return {"messages": messages, "match_rate": match_rate, "seconds": round(elapsed, 4), "msgs_per_sec": round(messages / elapsed, 1),
+                "us_per_msg": round(elapsed / messages * 1e6, 2), "clicks": len(harness.recorder.of("click"))}
+    finally: harness.close()
+
+
+async def bench_roll_cycle(preset_data, lang, rolls, time_scale):
+    # One full rolling cycle: on_ready -> $tu -> rolls -> live kakera clicks -> post-roll claim -> next $tu
+    harness = Harness(preset_data, lang=lang, time_scale=time_scale, rolls_left=rolls, kakera_rate=0.5)
+    try:
+        started = time.perf_counter(); harness.start()
+        done = await harness.run_until(lambda r: sum(1 for c in r.sent_commands() if c.endswith("tu")) >= 2, timeout=60)
+        elapsed = time.perf_counter() - started
+        await harness.stop()
+        latencies = harness.recorder.click_latencies()
+        return {"lang": lang, "completed": done, "seconds": round(elapsed, 3), "sent": harness.recorder.sent_commands(),
+                "claim_latency": latency_summary(latencies.get("claim", []) + latencies.get("react", [])),
+                "kakera_latency": latency_summary(latencies.get("kakera", []))}
+    finally: harness.close()
+
+
+def coroutine_depth(task):
+    # Number of coroutines chained through cr_await below the task's own coroutine
+    depth = 0; coro = task.get_coro()
+    while coro is not None and hasattr(coro, "cr_await"): depth += 1; coro = coro.cr_await
+    return depth
+
+
+async def bench_lifecycle(preset_data, cycles, time_scale, wall_start=None):
+    # Many roll/reset cycles back to back: the lifecycle task's coroutine depth and the heap must stay flat,
+    # and once the quota model has learned the reset schedule most cycles need no $tu
+    # Claims are switched off: each claim makes the next cycle confirm it with $tu, which the roll cycle covers
+    preset_data = dict(preset_data, min_kakera=10 ** 9, kakera_snipe_mode=False, wishlist=[], series_wishlist=[])
+    harness = Harness(preset_data, time_scale=time_scale, wall_start=wall_start, rolls_left=5, claim_reset_minutes=1, rolls_reset_minutes=1, auto_reset=True,
+                      claim_interval_minutes=3, rolls_interval_minutes=1)
+    try:
+        client = harness.client; depths = []; heap = []; tu_sent = 0
+        rolling_key = ("state_transitions_total", (("state", "rolling"),)); rolled_before = client.metrics.counters.get(rolling_key, 0)
+        def rolled(): return client.metrics.counters.get(rolling_key, 0) - rolled_before
+        def sample(r):
+            # Taken once per cycle, at the first roll command (the lifecycle task is inside start_roll_commands)
+            nonlocal tu_sent
+            if len(depths) < rolled() and any(c.endswith(harness.mudae.roll_command) for c in r.sent_commands()):
+                task = next((t for t in asyncio.all_tasks() if t.get_name() == "discord.py: on_ready"), None)
+                if task: depths.append(coroutine_depth(task))
+                if len(depths) == 2: gc.collect(); heap.append(tracemalloc.get_traced_memory()[0])
+                tu_sent += sum(1 for c in r.sent_commands() if c.endswith("tu"))
+                r.events.clear(); harness.channel.messages.clear() # Harness bookkeeping would otherwise dominate the heap
+            return rolled() > cycles
+        tracemalloc.start(); harness.start()
+        done = await harness.run_until(sample, timeout=cycles * 10)
+        await harness.stop(); harness.recorder.events.clear(); harness.channel.messages.clear()
+        gc.collect(); heap.append(tracemalloc.get_traced_memory()[0]); tracemalloc.stop()
+        return {"cycles": rolled() - 1, "completed": done, "coroutine_depth": sorted(set(depths)), "tu_per_cycle": round(tu_sent / max(1, len(depths)), 2),
+                "heap_growth_kib_per_cycle": round((heap[-1] - heap[0]) / 1024 / max(1, len(depths) - 2), 2) if len(heap) > 1 else None}
+    finally: harness.close()
+
+
+async def check_lifecycle(preset_data, runs, cycles, time_scale, max_tu_per_cycle):
+    # bench_lifecycle started at `runs` points spread over a wall-clock minute: the share of cycles that still need
+    # a $tu must not depend on where in the minute the reset deadlines fall
+    minute = int(time.time()) // 60 * 60; results = []
+    for run in range(runs):
+        r = await bench_lifecycle(preset_data, cycles, time_scale, wall_start=minute + run * 60 / runs)
+        r["start_second"] = round(run * 60 / runs, 1); r["ok"] = r["completed"] and r["tu_per_cycle"] <= max_tu_per_cycle
+        results.append(r)
+    return results
+
+
+async def bench_memory(preset_data, presets_count, messages):
+    # Python heap per client after each has seen `messages` external rolls (dedup caches included)
+    tracemalloc.start(); base = tracemalloc.take_snapshot()
+    harnesses = []
+    for i in range(presets_count):
+        harness = Harness(dict(preset_data, snipe_delay=0, series_snipe_delay=0, kakera_reaction_snipe_delay=0), preset_name=f"Harness_{i}", time_scale=0.0, seed=i)
+        for _ in range(messages): await harness.client.on_message(harness.mudae.roll_message(harness.mudae.make_roll()))
+        harness.channel.messages.clear(); harnesses.append(harness)
+    allocated = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(base, "filename"))
+    tracemalloc.stop()
+    for harness in harnesses: harness.close()
+    rss = mb.process_rss_mb()
+    return {"presets": presets_count, "messages_each": messages, "kib_per_preset": round(allocated / presets_count / 1024, 1),
+            "process_rss_mb": round(rss, 1) if rss is not None else None}
+
+
+async def bench_gateway_memory(preset_data, presets_count, events, guilds):
+    # Steady-state heap per preset with discord.py's default caches and with lean, after READY and `events` gateway events
+    results = {}
+    for lean in (False, True):
+        gc.collect(); tracemalloc.start(); base = tracemalloc.take_snapshot(); harnesses = []; ready = 0
+        for i in range(presets_count):
+            before = tracemalloc.get_traced_memory()[0]
+            harness = Harness(dict(preset_data, lean=lean), preset_name=f"Gateway_{i}", time_scale=0.0); replay = GatewayReplay(harness.client, guilds=guilds, seed=i)
+            replay.ready(); gc.collect(); ready += tracemalloc.get_traced_memory()[0] - before
+            await replay.traffic(events); harnesses.append(harness)
+        await asyncio.sleep(0); gc.collect()
+        allocated = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(base, "filename")); tracemalloc.stop()
+        state = harnesses[0].client._connection
+        results["lean" if lean else "default"] = {"ready_kib_per_preset": round(ready / presets_count / 1024, 1), "kib_per_preset": round(allocated / presets_count / 1024, 1),
+                                                  "cached_messages": len(state._messages or ()), "cached_members": sum(len(g._members) for g in state.guilds)}
+        for harness in harnesses: harness.close()
+    results.update(presets=presets_count, events_each=events, guilds=guilds)
+    return results
+
+
+def bench_tu_parse(fixtures, iterations):
+    # parse_tu/match_tu_response against the fixtures, then parse time per reply. The fixtures were written to match
+    # Mudae's reply format, so this guards the phrase table against regressions; it does not prove live coverage.
+    failures = []
+    for sample in fixtures:
+        status = mb.parse_tu(sample["content"])
+        got = None if status is None else {field: getattr(status, field) for field in ("claim_available", "claim_reset", "rolls_left", "rolls_reset")}
+        match = mb.match_tu_response(sample["content"], sample.get("user"), status)
+        if got != sample["expect"] or match != sample.get("match"): failures.append({"note": sample.get("note"), "lang": sample.get("lang"), "got": got, "match": match})
+    replies = [sample["content"] for sample in fixtures if sample["expect"] is not None]
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for content in replies: mb.parse_tu(content)
+    elapsed = time.perf_counter() - started
+    return {"samples": len(fixtures), "captured": sum(1 for sample in fixtures if sample.get("source") == "captured"), "failures": failures, "us_per_parse": round(elapsed / max(1, iterations * len(replies)) * 1e6, 2)}
+
+
+async def run_benchmarks(args):
+    preset_name, preset_data = harness_preset(args.preset, args.presets_file)
+    results = {"preset": preset_name, "on_message": [], "roll_cycle": [], "memory": None}
+    for match_rate in (0.0, 0.1):
+        results["on_message"].append(await bench_on_message(preset_data, args.messages, match_rate))
+    for lang in ("en", "pt"):
+        results["roll_cycle"].append(await bench_roll_cycle(preset_data, lang, args.rolls, args.time_scale))
+    results["lifecycle"] = await bench_lifecycle(preset_data, args.cycles, args.time_scale / 50)
+    results["memory"] = await bench_memory(preset_data, args.presets, args.messages)
+    results["gateway_memory"] = await bench_gateway_memory(preset_data, args.gateway_presets, args.gateway_events, args.guilds)
+    results["tu_parse"] = bench_tu_parse(load_tu_fixtures(args.fixtures), args.tu_iterations)
+    return results
+
+
+def print_benchmarks(results):
+    print(f"Preset: {results['preset']}")
+    for r in results["on_message"]:
+        print(f"  on_message   match={r['match_rate']:.0%}: {r['msgs_per_sec']:>10} msg/s  ({r['us_per_msg']} us/msg, {r['clicks']} clicks)")
+    for r in results["roll_cycle"]:
+        print(f"  roll cycle   [{r['lang']}] {'ok' if r['completed'] else 'TIMEOUT'} in {r['seconds']}s  claim {r['claim_latency']}  kakera {r['kakera_latency']}")
+    r = results["lifecycle"]
+    print(f"  lifecycle    {r['cycles']} cycles {'ok' if r['completed'] else 'TIMEOUT'}, coroutine depth {r['coroutine_depth']}, {r['tu_per_cycle']} $tu/cycle, heap growth {r['heap_growth_kib_per_cycle']} KiB/cycle")
+    m = results["memory"]
+    print(f"  memory       {m['kib_per_preset']} KiB/preset over {m['presets']} presets x {m['messages_each']} msgs (RSS {m['process_rss_mb']} MB)")
+    g = results["gateway_memory"]
+    for mode in ("default", "lean"):
+        print(f"  gateway      {mode:<7} {g[mode]['ready_kib_per_preset']} KiB/preset after READY ({g['guilds']} servers), {g[mode]['kib_per_preset']} KiB after {g['events_each']} events "
+              f"({g[mode]['cached_messages']} cached messages, {g[mode]['cached_members']} cached members)")
+    print_tu_parse(results["tu_parse"])
+
+
+def print_tu_parse(r):
+    captured = f", {r['captured']} of them captured from Mudae" if r["captured"] else " (reconstructed, none captured from Mudae)"
+    print(f"  $tu parse    {r['us_per_parse']} us/reply, {r['samples'] - len(r['failures'])}/{r['samples']} fixtures ok{captured}")
+    for failure in r["failures"]: print(f"    FAIL [{failure['lang']}] {failure['note']}: got {failure['got']}, match {failure['match']}")
+
+
+async def run_replay(args):
+    preset_name, preset_data = harness_preset(args.preset, args.presets_file)
+    harness = Harness(dict(preset_data, rolling=False), preset_name=preset_name, time_scale=args.time_scale)
+    try:
+        harness.start(); await harness.replay(load_recording(args.recording))
+        await asyncio.sleep(args.settle); await harness.stop()
+        for event in harness.recorder.events:
+            if event["kind"] != "deliver": print(json.dumps(event, ensure_ascii=False))
+    finally: harness.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline Mudae/Discord harness for MudaRemote")
+    parser.add_argument("--presets-file", default=mb.PRESETS_FILE)
+    parser.add_argument("--preset", help="Preset to load (default: first in the file, or a built-in one)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    bench = sub.add_parser("bench", help="Throughput, embed-to-click latency and memory per preset")
+    bench.add_argument("--messages", type=int, default=2000)
+    bench.add_argument("--rolls", type=int, default=10)
+    bench.add_argument("--cycles", type=int, default=20, help="Roll/reset cycles for the lifecycle benchmark")
+    bench.add_argument("--presets", type=int, default=10, help="Clients created for the memory benchmark")
+    bench.add_argument("--gateway-presets", type=int, default=3, help="Clients created for the gateway replay memory benchmark")
+    bench.add_argument("--gateway-events", type=int, default=5000, help="Gateway events replayed into each of them after READY")
+    bench.add_argument("--guilds", type=int, default=20, help="Servers the replayed account is in")
+    bench.add_argument("--time-scale", type=float, default=0.05, help="Multiplier for the bot's fixed sleeps in the roll cycle")
+    bench.add_argument("--fixtures", default=TU_FIXTURES, help="$tu fixtures for the parse benchmark")
+    bench.add_argument("--tu-iterations", type=int, default=2000, help="Passes over the $tu fixtures when timing the parser")
+    bench.add_argument("--json", help="Also write the results to this file")
+    replay = sub.add_parser("replay", help="Replay recorded Mudae rolls (JSON lines) as external rolls, print the bot's actions")
+    replay.add_argument("recording")
+    replay.add_argument("--time-scale", type=float, default=1.0)
+    replay.add_argument("--settle", type=float, default=3.0, help="Seconds to keep running after the last message")
+    lifecycle = sub.add_parser("lifecycle", help="Check that the quota model skips $tu between cycles wherever in the minute the run starts")
+    lifecycle.add_argument("--runs", type=int, default=10)
+    lifecycle.add_argument("--cycles", type=int, default=20)
+    lifecycle.add_argument("--time-scale", type=float, default=0.001, help="Multiplier for the bot's sleeps and reset waits")
+    lifecycle.add_argument("--max-tu-per-cycle", type=float, default=0.2)
+    tu = sub.add_parser("tu", help="Check the $tu parser against the reconstructed fixtures and time it")
+    tu.add_argument("--fixtures", default=TU_FIXTURES)
+    tu.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's own log lines")
+    args = parser.parse_args(argv)
+    if not args.verbose: mb.log_sink.emit = lambda *a, **k: None # Bot log lines would swamp the report
+    if args.command == "bench":
+        results = asyncio.run(run_benchmarks(args)); print_benchmarks(results)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f: json.dump(results, f, indent=2, ensure_ascii=False)
+    elif args.command == "lifecycle":
+        _, preset_data = harness_preset(args.preset, args.presets_file)
+        results = asyncio.run(check_lifecycle(preset_data, args.runs, args.cycles, args.time_scale, args.max_tu_per_cycle))
+        for r in results: print(f"  lifecycle    start :{r['start_second']:04.1f}  {r['cycles']} cycles, {r['tu_per_cycle']} $tu/cycle  {'ok' if r['ok'] else 'FAIL'}")
+        return 0 if all(r["ok"] for r in results) else 1
+    elif args.command == "tu":
+        result = bench_tu_parse(load_tu_fixtures(args.fixtures), args.iterations); print_tu_parse(result)
+        return 1 if result["failures"] else 0
+    else: asyncio.run(run_replay(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+import sys
+import argparse
+import itertools
+import json
+import os
+import sqlite3
+import numpy as np
+import mudae_bot as mb
+import mudae_harness as mh
+
+# Offline strategy simulator. Rolls recorded in the roll history (state/roll_history.sqlite3) are resampled
+# into simulated days, and the claim decisions of handle_mudae_messages and the snipe branches of on_message
+# are replayed for a whole grid of min_kakera / kakera_snipe_threshold / snipe_ignore_min_kakera_reset /
+# key_mode settings at once: every setting is one row of the same NumPy arrays. All settings see the same
+# sampled rolls, so differences between rows come from the settings and not from luck.
+
+# Mudae defaults: claim right every 3 h, rolls every hour
+CLAIM_INTERVAL_MINUTES = 180
+ROLL_INTERVAL_MINUTES = 60
+# Own rolls further apart than this start a new batch (used to measure the recorded batch size)
+BATCH_GAP_SECONDS = 60
+# Synthetic rolls, used with --synthetic or when the history has fewer than MIN_RECORDED_ROLLS rows
+MIN_RECORDED_ROLLS = 50
+SYNTHETIC_KAKERA = (4.0, 0.8) # lognormal mean/sigma of the kakera value
+SYNTHETIC_WISH_RATE = 0.005
+SYNTHETIC_SERIES_RATE = 0.02
+SYNTHETIC_KAKERA_BUTTON_RATE = 0.1
+SYNTHETIC_EXTERNAL_PER_HOUR = 20
+
+
+def parse_grid(text, kind=float):
+    # "0,50,100" -> [0, 50, 100]; "off" (kakera threshold only) -> inf, i.e. kakera_snipe_mode false
+    values = []
+    for part in text.split(","):
+        part = part.strip().lower()
+        if part in ("off", "none"): values.append(float("inf"))
+        elif kind is bool: values.append(part in ("1", "true", "yes", "on"))
+        else: values.append(kind(part))
+    return values
+
+
+def load_rolls(path, channel_id=None):
+    # -> (own rolls, external rolls, hours of history covered); each roll is a dict of its history row
+    if not path or not os.path.exists(path): return [], [], 0.0
+    db = mb.open_roll_history(path, readonly=True); db.row_factory = sqlite3.Row
+    try:
+        columns = {row[1] for row in db.execute("PRAGMA table_info(rolls)")}
+        extra = ", ".join(c if c in columns else f"0 AS {c}" for c in mb.RollHistory.ADDED_COLUMNS) # Files from before the columns existed
+        where = " WHERE channel_id = ?" if channel_id else ""
+        rows = [dict(r) for r in db.execute(f"SELECT rolled_at, character, series, kakera, claimable, {extra} FROM rolls{where} ORDER BY rolled_at",
+                                             (channel_id,) if channel_id else ())]
+    finally: db.close()
+    if not rows: return [], [], 0.0
+    hours = max(1.0, (rows[-1]["rolled_at"] - rows[0]["rolled_at"]) / 3600)
+    return [r for r in rows if r["own_roll"]], [r for r in rows if not r["own_roll"]], hours
+
+
+def synthetic_rolls(count, rng):
+    kakera = np.round(30 + rng.lognormal(*SYNTHETIC_KAKERA, count)).astype(int)
+    return [{"character": None, "series": "", "kakera": int(k), "claimable": 1, "kakera_button": int(b),
+             "wish": bool(w), "series_wish": bool(s)}
+            for k, b, w, s in zip(kakera, rng.random(count) < SYNTHETIC_KAKERA_BUTTON_RATE,
+                                  rng.random(count) < SYNTHETIC_WISH_RATE, rng.random(count) < SYNTHETIC_SERIES_RATE)]
+
+
+def roll_table(rolls, index):
+    # Column arrays for a roll pool; wishlist/series matches are decided once per recorded roll with the bot's own index
+    table = {"kakera": np.array([r["kakera"] for r in rolls], dtype=np.int64),
+             "claimable": np.array([bool(r["claimable"]) for r in rolls]), "kakera_button": np.array([bool(r["kakera_button"]) for r in rolls])}
+    table["wish"] = np.array([r["wish"] if "wish" in r else index.has_name(r["character"] or "") for r in rolls])
+    table["series_wish"] = np.array([r["series_wish"] if "series_wish" in r else index.matches_series(r["series"] or "") for r in rolls])
+    return table
+
+
+def batch_size(own_rolls):
+    # Mean recorded batch: own rolls closer together than BATCH_GAP_SECONDS belong to one batch
+    if not own_rolls: return None
+    sizes = [1]
+    for previous, current in zip(own_rolls, own_rolls[1:]):
+        if current["rolled_at"] - previous["rolled_at"] > BATCH_GAP_SECONDS: sizes.append(1)
+        else: sizes[-1] += 1
+    return max(1, round(sum(sizes) / len(sizes)))
+
+
+def sample(table, shape, rng, valid=None):
+    picks = rng.integers(0, len(table["kakera"]), size=shape)
+    sampled = {name: column[picks] for name, column in table.items()}
+    if valid is not None: sampled["claimable"] = sampled["claimable"] & valid; sampled["kakera_button"] = sampled["kakera_button"] & valid
+    return sampled
+
+
+def first_true(mask):
+    # (any, index of the first True) along the last axis
+    return mask.any(-1), mask.argmax(-1)
+
+
+def simulate(grid, own, external, preset, rng_seed=0, snipe_success=0.5):
+    # grid: dict of 1-D arrays (length G). own/external: sampled rolls shaped (T, W, R) / (T, W, E), where T is claim
+    # periods and W roll windows per period. The loop over W (a handful of windows) is the only Python loop.
+    G = len(grid["min_kakera"]); T, W, R = own["kakera"].shape
+    rng = np.random.default_rng(rng_seed + 1)
+    min_kakera = grid["min_kakera"][:, None]; threshold = grid["kakera_threshold"][:, None, None]
+    ignore_reset = grid["ignore_reset"][:, None]; key_mode = grid["key_mode"][:, None]
+    available = np.ones((G, T), dtype=bool)
+    totals = {name: np.zeros((G, T)) for name in ("claims", "claimed_kakera", "wish_claims", "kakera_clicks", "rolls")}
+    snipe_won = rng.random(external["kakera"].shape) < snipe_success # Someone else may claim an external roll first
+
+    def pick(values, index): # values[..., index] per (setting, period)
+        return np.take_along_axis(np.broadcast_to(values, index.shape + values.shape[-1:]), index[:, :, None], -1)[:, :, 0]
+
+    def claim(hit, kakera, wish):
+        totals["claims"] += hit; totals["claimed_kakera"] += np.where(hit, kakera, 0); totals["wish_claims"] += hit & wish
+
+    for w in range(W):
+        reset_soon = (W - w) * CLAIM_INTERVAL_MINUTES / W <= 60 # snipe_ignore_min_kakera_reset: claim reset less than an hour away
+        if R:
+            rolling = available | key_mode # Without key_mode the bot waits for the claim reset once the claim is spent
+            k = own["kakera"][None, :, w, :]; claimable = own["claimable"][None, :, w, :]; wish = own["wish"][None, :, w, :]
+            rolled = np.full((G, T), R)
+            if preset["reactive_snipe_on_own_rolls"]:
+                # Reactive self-snipe: the first matching roll is claimed as it arrives and interrupts the batch
+                hit, index = first_true(claimable & (wish | own["series_wish"][None, :, w, :] | (k >= threshold)) & available[:, :, None])
+                claim(hit, pick(k, index), pick(wish, index))
+                rolled = np.where(hit, index + 1, rolled); available = available & ~hit # The bot stops rolling on a hit, key_mode or not
+            # Post-roll: a wishlist character first, else the highest kakera at or above min_kakera (0 near the reset with ignore_reset)
+            post_min = np.where(ignore_reset & reset_soon, 0, min_kakera)[:, :, None]
+            wish_hit, wish_index = first_true(claimable & wish & available[:, :, None])
+            value = np.where(claimable & (k >= post_min) & available[:, :, None], k, -1).max(-1)
+            value_hit = ~wish_hit & (value >= 0)
+            claim(wish_hit, pick(k, wish_index), wish_hit); claim(value_hit, value, False); available = available & ~(wish_hit | value_hit)
+            clicks = (own["kakera_button"][None, :, w, :] & (np.arange(R) < rolled[:, :, None])).sum(-1)
+            totals["kakera_clicks"] += np.where(rolling, clicks, 0); totals["rolls"] += np.where(rolling, rolled, 0)
+        # External rolls later in the window: wishlist / series / kakera-value snipes while the claim is still available
+        ek = external["kakera"][None, :, w, :]; ewish = external["wish"][None, :, w, :]
+        match = external["claimable"][None, :, w, :] & snipe_won[None, :, w, :] & (
+            (preset["snipe_mode"] & ewish) | (preset["series_snipe_mode"] & external["series_wish"][None, :, w, :]) | (ek >= threshold))
+        hit, index = first_true(match & available[:, :, None])
+        claim(hit, pick(ek, index), pick(ewish, index)); available = available & ~hit
+    return {name: total.sum(-1) for name, total in totals.items()}
+
+
+def run(args):
+    preset_name, preset = mh.harness_preset(args.preset, args.presets_file)
+    rng = np.random.default_rng(args.seed)
+    index = mb.WishlistIndex(preset.get("wishlist", []), preset.get("series_wishlist", []), preset.get("wishlist_fold_accents", False))
+    own_rolls, external_rolls, hours = ([], [], 0.0) if args.synthetic else load_rolls(args.db or mb.ROLL_HISTORY_PATH, args.channel)
+    measured_batch = batch_size(own_rolls)
+    source = f"{len(own_rolls)} own and {len(external_rolls)} external rolls over {hours:.0f} h of history"
+    if len(own_rolls) + len(external_rolls) < MIN_RECORDED_ROLLS:
+        source = "synthetic rolls" + ("" if args.synthetic else f" (history has only {len(own_rolls) + len(external_rolls)} rolls)")
+        own_rolls = synthetic_rolls(5000, rng); external_rolls = synthetic_rolls(5000, rng); hours = 5000 / SYNTHETIC_EXTERNAL_PER_HOUR
+    own_table = roll_table(own_rolls or external_rolls, index); external_table = roll_table(external_rolls or own_rolls, index)
+    rolls_per_window = (args.rolls or measured_batch or 10) if preset.get("rolling", True) else 0 # Snipe-only presets never roll
+    windows = max(1, round(CLAIM_INTERVAL_MINUTES / ROLL_INTERVAL_MINUTES)); periods = max(1, round(args.days * 1440 / CLAIM_INTERVAL_MINUTES))
+    external_rate = len(external_rolls) / hours if external_rolls else 0.0
+    per_window = rng.poisson(external_rate * ROLL_INTERVAL_MINUTES / 60, size=(periods, windows))
+    slots = max(1, int(per_window.max()))
+    own = sample(own_table, (periods, windows, rolls_per_window), rng)
+    external = sample(external_table, (periods, windows, slots), rng, valid=np.arange(slots) < per_window[:, :, None])
+
+    combos = list(itertools.product(parse_grid(args.min_kakera), parse_grid(args.kakera_threshold), parse_grid(args.ignore_reset, bool), parse_grid(args.key_mode, bool)))
+    grid = {"min_kakera": np.array([c[0] for c in combos]), "kakera_threshold": np.array([c[1] for c in combos]),
+            "ignore_reset": np.array([c[2] for c in combos]), "key_mode": np.array([c[3] for c in combos])}
+    flags = {"reactive_snipe_on_own_rolls": preset.get("reactive_snipe_on_own_rolls", True) and preset.get("rolling", True),
+             "snipe_mode": bool(preset.get("snipe_mode", False)), "series_snipe_mode": bool(preset.get("series_snipe_mode", False))}
+    totals = simulate(grid, own, external, flags, args.seed, args.snipe_success)
+    days = periods * CLAIM_INTERVAL_MINUTES / 1440
+    current = (preset.get("min_kakera"), preset.get("kakera_snipe_threshold", 0) if preset.get("kakera_snipe_mode") else float("inf"),
+               bool(preset.get("snipe_ignore_min_kakera_reset", False)), bool(preset.get("key_mode", False)))
+    results = []
+    for i, (min_kakera, threshold, ignore_reset, key_mode) in enumerate(combos):
+        claims = totals["claims"][i] / days; claimed = totals["claimed_kakera"][i] / days; clicks = totals["kakera_clicks"][i] / days
+        results.append({"min_kakera": min_kakera, "kakera_snipe_threshold": None if threshold == float("inf") else threshold,
+                        "snipe_ignore_min_kakera_reset": ignore_reset, "key_mode": key_mode, "claims_per_day": round(claims, 2),
+                        "claimed_kakera_per_day": round(claimed, 1), "kakera_per_claim": round(claimed / claims, 1) if claims else 0.0,
+                        "wishlist_claims_per_day": round(totals["wish_claims"][i] / days, 2), "kakera_clicks_per_day": round(clicks, 2),
+                        "rolls_per_day": round(totals["rolls"][i] / days, 1),
+                        "expected_kakera_per_day": round(claimed + clicks * args.kakera_per_click, 1),
+                        "current": (min_kakera, threshold, ignore_reset, key_mode) == current})
+    results.sort(key=lambda r: (r["expected_kakera_per_day"], r["claims_per_day"]), reverse=True)
+    return {"preset": preset_name, "source": source, "days": round(days, 1), "rolls_per_window": rolls_per_window,
+            "external_rolls_per_hour": round(external_rate, 1), "settings": len(combos), "results": results}
+
+
+def print_results(report, top):
+    print(f"Preset: {report['preset']}  |  {report['source']}")
+    print(f"Simulated {report['days']} days, {report['rolls_per_window']} rolls/hour, {report['external_rolls_per_hour']} external rolls/hour, {report['settings']} settings")
+    headers = ["min_kakera", "k_threshold", "ignore_reset", "key_mode", "claims/d", "kakera claimed/d", "kakera/claim", "WL claims/d", "kakera clicks/d", "expected/d"]
+    def row(r, label=None):
+        values = [label or r["min_kakera"], r["kakera_snipe_threshold"] if r["kakera_snipe_threshold"] is not None else "off", r["snipe_ignore_min_kakera_reset"],
+                  r["key_mode"], r["claims_per_day"], r["claimed_kakera_per_day"], r["kakera_per_claim"], r["wishlist_claims_per_day"], r["kakera_clicks_per_day"],
+                  r["expected_kakera_per_day"]]
+        return [f"{v:g}" if isinstance(v, float) else v for v in values]
+    rows = [row(r) for r in report["results"][:top]]
+    current = next((r for r in report["results"] if r["current"]), None)
+    if current: rows.append(row(current, f"current ({current['min_kakera']:g})"))
+    mb.print_table(headers, rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline claim-strategy simulator for MudaRemote presets")
+    parser.add_argument("--presets-file", default=mb.PRESETS_FILE)
+    parser.add_argument("--preset", help="Preset whose wishlists and snipe modes are used (default: first in the file)")
+    parser.add_argument("--db", help="Roll history file (default: state/roll_history.sqlite3)")
+    parser.add_argument("--channel", type=int, help="Only use rolls recorded in this channel ID")
+    parser.add_argument("--synthetic", action="store_true", help="Ignore the history and use synthetic rolls")
+    parser.add_argument("--days", type=float, default=90, help="Simulated days (default 90)")
+    parser.add_argument("--rolls", type=int, help="Own rolls per hour (default: measured from the history, else 10)")
+    parser.add_argument("--min-kakera", default="0,50,100,150,200,300,500", help="Comma-separated values to try")
+    parser.add_argument("--kakera-threshold", default="off,100,150,200,300,500", help="Comma-separated values; 'off' = kakera_snipe_mode false")
+    parser.add_argument("--ignore-reset", default="false,true", help="snipe_ignore_min_kakera_reset values to try")
+    parser.add_argument("--key-mode", default="false,true", help="key_mode values to try")
+    parser.add_argument("--snipe-success", type=float, default=0.5, help="Chance an external snipe is not beaten by another player (default 0.5)")
+    parser.add_argument("--kakera-per-click", type=float, default=0, help="Kakera credited per kakera button click in the expected total (default 0)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--top", type=int, default=15, help="Rows to print")
+    parser.add_argument("--json", help="Also write every setting's result to this file")
+    args = parser.parse_args(argv)
+    report = run(args); print_results(report, args.top)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f: json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())